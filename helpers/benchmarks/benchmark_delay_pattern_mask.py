@@ -0,0 +1,58 @@
+import argparse
+import time
+
+import torch
+
+from parler_tts import apply_delay_pattern_mask, build_delay_pattern_mask, revert_delay_pattern_mask
+
+
+BOS_TOKEN_ID = 1025
+PAD_TOKEN_ID = 1024
+
+
+def build_and_revert(input_ids, output_ids, num_codebooks):
+    # what `generate` does around the sampling loop
+    _, delay_pattern_mask = build_delay_pattern_mask(
+        input_ids, BOS_TOKEN_ID, PAD_TOKEN_ID, output_ids.shape[-1], num_codebooks
+    )
+    output_ids = apply_delay_pattern_mask(output_ids, delay_pattern_mask)
+    return revert_delay_pattern_mask(output_ids, num_codebooks)
+
+
+def benchmark(batch_size, num_codebooks, max_length, device, num_iterations):
+    input_ids = torch.full((batch_size * num_codebooks, 1), BOS_TOKEN_ID, dtype=torch.long, device=device)
+    output_ids = torch.randint(0, PAD_TOKEN_ID, (batch_size * num_codebooks, max_length), device=device)
+
+    # warmup, also fills the cache of delay patterns
+    build_and_revert(input_ids, output_ids, num_codebooks)
+
+    if device.type == "cuda":
+        # raise if anything synchronizes with the host
+        torch.cuda.synchronize()
+        torch.cuda.set_sync_debug_mode("error")
+
+    start = time.perf_counter()
+    for _ in range(num_iterations):
+        build_and_revert(input_ids, output_ids, num_codebooks)
+    if device.type == "cuda":
+        torch.cuda.set_sync_debug_mode("default")
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / num_iterations
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Times the construction and the revert of the delay pattern mask for various numbers of codebooks."
+    )
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--max_length", type=int, default=2600, help="Number of decoding steps, ~30s of audio.")
+    parser.add_argument("--num_codebooks", type=int, nargs="+", default=[4, 9, 16, 32])
+    parser.add_argument("--num_iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    print(f"device={device}, batch_size={args.batch_size}, max_length={args.max_length}")
+    for num_codebooks in args.num_codebooks:
+        duration = benchmark(args.batch_size, num_codebooks, args.max_length, device, args.num_iterations)
+        print(f"num_codebooks={num_codebooks:>3}: {duration * 1e3:.3f} ms per build + revert")
@@ -8,11 +8,25 @@ from .dac_wrapper import DACConfig, DACModel
 from .modeling_parler_tts import (
     ParlerTTSForCausalLM,
     ParlerTTSForConditionalGeneration,
+    ParlerTTSMultiCodebookEmbedding,
+    ParlerTTSMultiCodebookHead,
     apply_delay_pattern_mask,
     build_delay_pattern_mask,
+    revert_delay_pattern_mask,
 )
 
-from .streamer import ParlerTTSStreamer
+from .streamer import AsyncParlerTTSStreamer, ParlerTTSAudioStream, ParlerTTSBatchStreamer, ParlerTTSStreamer
+from .cache_utils import (
+    BlockAllocator,
+    PagedCache,
+    PromptPrefixCache,
+    SharedCrossAttentionCache,
+    TextEncoderOutputCache,
+)
+from .voice_profile import ParlerTTSVoiceProfile
+from .continuous_batching import ParlerTTSContinuousBatchingEngine, ParlerTTSRequestOutput
+from .vocoder import ParlerTTSVocoder
+from .bucketing import ParlerTTSBucketedGenerator
 
 AutoConfig.register("dac", DACConfig)
 AutoModel.register(DACConfig, DACModel)
@@ -0,0 +1,154 @@
+from typing import Any, List, Optional, Sequence, Tuple
+
+import torch
+from transformers import PreTrainedTokenizerBase
+
+from .modeling_parler_tts import ParlerTTSForConditionalGeneration
+
+
+# average duration of the speech of a transcript token at a normal speaking rate, with the T5 tokenizer of the
+# Parler-TTS checkpoints
+SECONDS_PER_TOKEN = 0.3
+
+
+class ParlerTTSBucketedGenerator:
+    r"""
+    Batching front-end of [`~ParlerTTSForConditionalGeneration.generate`] for offline synthesis of many requests.
+
+    A batch is padded to its longest description and prompt, and decoded until its longest sample is done. The
+    generator predicts the length of the audio of each request from the number of tokens of its transcript, sorts the
+    requests by predicted length, and calls `generate` on buckets of requests of similar lengths. The audios are
+    returned in the order of the requests.
+
+    Parameters:
+        model (`ParlerTTSForConditionalGeneration`):
+            The Parler-TTS model used to generate.
+        tokenizer (`PreTrainedTokenizerBase`):
+            Tokenizer of the transcripts, i.e. the prompts.
+        description_tokenizer (`PreTrainedTokenizerBase`, *optional*):
+            Tokenizer of the descriptions. Defaults to `tokenizer`.
+        max_batch_size (`int`, *optional*, defaults to 16):
+            Maximum number of requests generated together.
+        max_batch_frames (`int`, *optional*):
+            If set, a bucket is closed before the number of requests times the predicted length of its longest request
+            exceeds `max_batch_frames`, which bounds the size of the cache of each `generate` call.
+        frames_per_token (`float`, *optional*):
+            Predicted number of audio frames per transcript token, used with `max_batch_frames`. Defaults to the frame
+            rate of the audio encoder times `SECONDS_PER_TOKEN`.
+        kwargs (`Dict[str, Any]`, *optional*):
+            Arguments passed to every `generate` call, e.g. `do_sample=True` or `compaction_interval=16`.
+
+    Example:
+
+    ```python
+    >>> generator = ParlerTTSBucketedGenerator(model, tokenizer, max_batch_size=32, do_sample=True)
+    >>> audios = generator.generate([(description, transcript) for description, transcript in requests])
+    ```
+    """
+
+    def __init__(
+        self,
+        model: ParlerTTSForConditionalGeneration,
+        tokenizer: PreTrainedTokenizerBase,
+        description_tokenizer: Optional[PreTrainedTokenizerBase] = None,
+        max_batch_size: int = 16,
+        max_batch_frames: Optional[int] = None,
+        frames_per_token: Optional[float] = None,
+        **kwargs,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.description_tokenizer = description_tokenizer if description_tokenizer is not None else tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_batch_frames = max_batch_frames
+        if frames_per_token is None:
+            frames_per_token = model.audio_encoder.config.frame_rate * SECONDS_PER_TOKEN
+        self.frames_per_token = frames_per_token
+        self.generate_kwargs = kwargs
+
+    def predict_num_frames(self, transcripts: Sequence[str]) -> List[int]:
+        """Predicts the number of audio frames generated for each of `transcripts`, from its number of tokens."""
+        return self._predict_num_frames(self.tokenizer(list(transcripts)).input_ids)
+
+    def _predict_num_frames(self, input_ids: List[List[int]]) -> List[int]:
+        return [max(int(len(ids) * self.frames_per_token), 1) for ids in input_ids]
+
+    def buckets(self, requests: Sequence[Tuple[str, str]]) -> List[List[int]]:
+        """
+        Groups the `(description, transcript)` requests into buckets of requests of similar predicted lengths.
+
+        Returns:
+            `List[List[int]]`: the indices of the requests of each bucket, from the shortest to the longest.
+        """
+        return self._buckets(self.predict_num_frames([transcript for _, transcript in requests]))
+
+    def _buckets(self, num_frames: List[int]) -> List[List[int]]:
+        # a stable sort keeps the order of requests of the same length
+        order = sorted(range(len(num_frames)), key=lambda index: num_frames[index])
+
+        buckets = []
+        bucket = []
+        for index in order:
+            # the requests are sorted, so the new request is the longest of the bucket
+            bucket_frames = (len(bucket) + 1) * num_frames[index]
+            if bucket and (
+                len(bucket) == self.max_batch_size
+                or (self.max_batch_frames is not None and bucket_frames > self.max_batch_frames)
+            ):
+                buckets.append(bucket)
+                bucket = []
+            bucket.append(index)
+        if bucket:
+            buckets.append(bucket)
+        return buckets
+
+    @torch.no_grad()
+    def generate(self, requests: Sequence[Tuple[str, str]], **kwargs) -> List[Any]:
+        """
+        Generates the audio of each `(description, transcript)` request, one `generate` call per bucket.
+
+        Args:
+            requests (`Sequence[Tuple[str, str]]`):
+                The description of the voice and the transcript of each request.
+            kwargs (`Dict[str, Any]`, *optional*):
+                Arguments passed to the `generate` calls, that override the ones passed at initialization.
+
+        Returns:
+            `List[torch.FloatTensor]`: the audio of each request, trimmed to its length, in the order of `requests`.
+            With `return_codes=True`, the audio codes of shape `(num_codebooks, frames)` of each request instead,
+            trimmed to its number of frames.
+        """
+        generate_kwargs = {**self.generate_kwargs, **kwargs}
+        # the outputs are trimmed to the lengths returned along with them
+        generate_kwargs.pop("return_dict_in_generate", None)
+        return_codes = generate_kwargs.get("return_codes", False)
+        device = self.model.device
+
+        if not requests:
+            return []
+
+        # the transcripts are tokenized once, to predict their lengths and then to be padded per bucket
+        prompt_input_ids = self.tokenizer([transcript for _, transcript in requests]).input_ids
+
+        audios = [None] * len(requests)
+        for bucket in self._buckets(self._predict_num_frames(prompt_input_ids)):
+            descriptions = [requests[index][0] for index in bucket]
+            inputs = self.description_tokenizer(descriptions, return_tensors="pt", padding=True).to(device)
+            prompt = self.tokenizer.pad(
+                {"input_ids": [prompt_input_ids[index] for index in bucket]}, return_tensors="pt"
+            ).to(device)
+
+            generation = self.model.generate(
+                input_ids=inputs.input_ids,
+                attention_mask=inputs.attention_mask,
+                prompt_input_ids=prompt.input_ids,
+                prompt_attention_mask=prompt.attention_mask,
+                return_dict_in_generate=True,
+                **generate_kwargs,
+            )
+            for row, index in enumerate(bucket):
+                if return_codes:
+                    audios[index] = generation.sequences[row, :, : generation.codes_length[row]]
+                else:
+                    audios[index] = generation.sequences[row, : generation.audios_length[row]]
+        return audios
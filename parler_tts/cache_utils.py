@@ -0,0 +1,624 @@
+import math
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import torch
+from transformers.cache_utils import Cache, DynamicCache
+from transformers.generation.stopping_criteria import StoppingCriteria
+
+from .configuration_parler_tts import ParlerTTSDecoderConfig
+
+
+def pad_to_length(tensor: torch.Tensor, dim: int, size: int, fill_value=0) -> torch.Tensor:
+    """Pads `tensor` with `fill_value` along `dim` so that it has at least `size` entries."""
+    missing = size - tensor.shape[dim]
+    if missing <= 0:
+        return tensor
+    pad_shape = list(tensor.shape)
+    pad_shape[dim] = missing
+    padding = torch.full(pad_shape, fill_value, dtype=tensor.dtype, device=tensor.device)
+    return torch.cat([tensor, padding], dim=dim)
+
+
+class BlockAllocator:
+    """
+    Hands out fixed-size cache blocks from a pool of `num_blocks` blocks. Block `0` is reserved as a null block that
+    backs unallocated or freed entries of the block tables, so it is never handed out.
+
+    Args:
+        num_blocks (`int`):
+            Initial size of the pool, including the null block.
+        growable (`bool`, *optional*, defaults to `True`):
+            Whether the pool can be doubled when it runs out of free blocks. If `False`, `allocate` raises a
+            `RuntimeError` instead.
+    """
+
+    def __init__(self, num_blocks: int, growable: bool = True):
+        if num_blocks < 2:
+            raise ValueError(f"`num_blocks` should be at least 2 (a null block and a usable block), got {num_blocks}.")
+        self.num_blocks = num_blocks
+        self.growable = growable
+        self._free_blocks = list(range(num_blocks - 1, 0, -1))
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - 1 - self.num_free_blocks
+
+    def allocate(self) -> int:
+        """Returns the index of a free block, growing the pool if needed and allowed."""
+        if not self._free_blocks:
+            if not self.growable:
+                raise RuntimeError(f"The paged cache ran out of blocks (pool of {self.num_blocks} blocks).")
+            self._free_blocks = list(range(2 * self.num_blocks - 1, self.num_blocks - 1, -1))
+            self.num_blocks *= 2
+        return self._free_blocks.pop()
+
+    def free(self, blocks: List[int]):
+        self._free_blocks.extend(reversed(blocks))
+
+
+class PagedCache(Cache):
+    """
+    Self-attention cache storing key/value states in fixed-size blocks taken from a shared pool. Each sequence of
+    the batch owns a block table mapping its positions to blocks, and blocks are only allocated when a sequence
+    actually reaches them. Memory therefore scales with the number of tokens generated rather than with
+    `max_batch_size * max_cache_len`, and the blocks of a sequence can be returned to the pool as soon as it is
+    finished with [`~PagedCache.free`].
+
+    The attention layers read and write it through [`~PagedCache.update`], like any other cache: new states are
+    scattered into the blocks of each sequence, and the cached states of the batch are gathered back as a
+    `(batch_size, num_heads, seq_len, head_dim)` tensor. This is a block allocation layer rather than a paged attention
+    kernel: every update copies the cached sequence of the layer out of its blocks, which is freed once the layer is
+    done. Between decoding steps only the allocated blocks are held, but each step still costs an `O(seq_len)` copy
+    per layer, like the concatenation of a `DynamicCache`.
+
+    Parameters:
+        config (`ParlerTTSDecoderConfig`):
+            The configuration of the decoder, used to infer the number of layers, key/value heads and head dimension.
+        max_batch_size (`int`, *optional*):
+            Expected batch size, used to size the initial pool when `num_blocks` is not specified. The actual batch
+            size is inferred from the first update.
+        max_cache_len (`int`, *optional*):
+            Not used, kept to have the same signature as the other caches.
+        device (`torch.device`, *optional*):
+            The device on which to allocate the pool.
+        dtype (`torch.dtype`, *optional*, defaults to `torch.float32`):
+            The dtype of the pool.
+        block_size (`int`, *optional*, defaults to 16):
+            Number of positions per block.
+        num_blocks (`int`, *optional*):
+            Number of blocks of the pool. If specified, the pool has a fixed size and running out of blocks raises an
+            error. Otherwise, the pool starts small and is doubled whenever it runs out of blocks.
+    """
+
+    def __init__(
+        self,
+        config: ParlerTTSDecoderConfig,
+        max_batch_size: Optional[int] = None,
+        max_cache_len: Optional[int] = None,
+        device: Union[torch.device, str, None] = None,
+        dtype: torch.dtype = torch.float32,
+        block_size: int = 16,
+        num_blocks: Optional[int] = None,
+    ):
+        self.num_layers = config.num_hidden_layers
+        self.num_key_value_heads = config.num_key_value_heads
+        self.head_dim = config.hidden_size // config.num_attention_heads
+        self.block_size = block_size
+        self.device = device
+        self.dtype = dtype
+
+        growable = num_blocks is None
+        if num_blocks is None:
+            # start with one block per sequence and let the pool grow with the generated length
+            num_blocks = 1 + (max_batch_size or 1)
+        self.allocator = BlockAllocator(num_blocks, growable=growable)
+
+        # pools of shape (num_blocks, num_key_value_heads, block_size, head_dim), one per layer
+        self.key_pool: List[torch.Tensor] = []
+        self.value_pool: List[torch.Tensor] = []
+
+        # per-sequence block tables, mirrored on the host to allocate blocks without device syncs
+        self.block_tables: Optional[torch.LongTensor] = None
+        self._block_lists: List[List[int]] = []
+        self._freed: List[bool] = []
+        self._seq_length = 0
+        self._write_block_ids = None
+        self._write_offsets = None
+
+    def __len__(self):
+        return len(self.key_pool)
+
+    @property
+    def num_used_blocks(self) -> int:
+        """Number of blocks currently holding the states of a sequence."""
+        return self.allocator.num_used_blocks
+
+    @property
+    def key_cache(self) -> List[torch.Tensor]:
+        """Contiguous copies of the cached keys of each layer, for code that indexes the cache directly."""
+        return [self._gather(self.key_pool[layer_idx]) for layer_idx in range(len(self))]
+
+    @property
+    def value_cache(self) -> List[torch.Tensor]:
+        """Contiguous copies of the cached values of each layer, for code that indexes the cache directly."""
+        return [self._gather(self.value_pool[layer_idx]) for layer_idx in range(len(self))]
+
+    def _allocate_pools(self, layer_idx: int, key_states: torch.Tensor):
+        device = self.device if self.device is not None else key_states.device
+        shape = (self.allocator.num_blocks, self.num_key_value_heads, self.block_size, self.head_dim)
+        self.key_pool.append(torch.zeros(shape, dtype=self.dtype, device=device))
+        self.value_pool.append(torch.zeros(shape, dtype=self.dtype, device=device))
+
+    def _grow_pools(self):
+        for pools in (self.key_pool, self.value_pool):
+            for layer_idx, pool in enumerate(pools):
+                missing = self.allocator.num_blocks - pool.shape[0]
+                if missing > 0:
+                    pools[layer_idx] = torch.cat([pool, pool.new_zeros((missing, *pool.shape[1:]))])
+
+    def _reserve(self, batch_size: int, seq_length: int, device: torch.device):
+        """Makes sure every live sequence owns enough blocks to hold `seq_length` positions."""
+        if self.block_tables is None:
+            self._block_lists = [[] for _ in range(batch_size)]
+            self._freed = [False] * batch_size
+            self.block_tables = torch.zeros((batch_size, 0), dtype=torch.long, device=device)
+        elif batch_size != len(self._block_lists):
+            raise ValueError(
+                f"The paged cache was initialized with a batch size of {len(self._block_lists)}, got {batch_size}."
+            )
+
+        num_blocks = math.ceil(seq_length / self.block_size)
+        if num_blocks > self.block_tables.shape[1]:
+            padding = self.block_tables.new_zeros((batch_size, num_blocks - self.block_tables.shape[1]))
+            self.block_tables = torch.cat([self.block_tables, padding], dim=1)
+
+        rows, columns, blocks = [], [], []
+        for batch_idx, block_list in enumerate(self._block_lists):
+            if self._freed[batch_idx]:
+                continue
+            while len(block_list) < num_blocks:
+                rows.append(batch_idx)
+                columns.append(len(block_list))
+                block_list.append(self.allocator.allocate())
+                blocks.append(block_list[-1])
+        if blocks:
+            self._grow_pools()
+            self.block_tables[rows, columns] = torch.tensor(blocks, dtype=torch.long, device=device)
+
+    def _gather(self, pool: torch.Tensor) -> torch.Tensor:
+        batch_size, num_blocks = self.block_tables.shape
+        # (batch_size, num_blocks, num_heads, block_size, head_dim) -> (batch_size, num_heads, seq_len, head_dim)
+        states = pool[self.block_tables].transpose(1, 2)
+        states = states.reshape(batch_size, self.num_key_value_heads, num_blocks * self.block_size, self.head_dim)
+        return states[:, :, : self._seq_length]
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Writes the new `key_states` and `value_states` of layer `layer_idx` into the blocks of each sequence, and
+        returns the cached states of the whole batch.
+
+        Parameters:
+            key_states (`torch.Tensor` of shape `(batch_size, num_heads, seq_len, head_dim)`):
+                The new key states to cache.
+            value_states (`torch.Tensor` of shape `(batch_size, num_heads, seq_len, head_dim)`):
+                The new value states to cache.
+            layer_idx (`int`):
+                The index of the layer to cache the states for.
+            cache_kwargs (`Dict[str, Any]`, *optional*):
+                Can hold the `cache_position` of the new states. Defaults to the positions following the cached ones.
+
+        Return:
+            A tuple containing the updated key and value states.
+        """
+        batch_size, _, seq_len, _ = key_states.shape
+        if len(self.key_pool) <= layer_idx:
+            self._allocate_pools(layer_idx, key_states)
+
+        if layer_idx == 0:
+            # every layer writes at the same positions: compute the block indices once per forward pass
+            cache_position = cache_kwargs.get("cache_position") if cache_kwargs is not None else None
+            if cache_position is None:
+                cache_position = torch.arange(self._seq_length, self._seq_length + seq_len, device=key_states.device)
+            else:
+                cache_position = cache_position.to(key_states.device)
+            # the new states are appended right after the cached ones
+            new_seq_length = self._seq_length + seq_len
+            self._reserve(batch_size, new_seq_length, key_states.device)
+            self._seq_length = new_seq_length
+
+            self._write_block_ids = self.block_tables[:, cache_position // self.block_size].reshape(-1)
+            self._write_offsets = (cache_position % self.block_size).repeat(batch_size)
+
+        # (batch_size, num_heads, seq_len, head_dim) -> (batch_size * seq_len, num_heads, head_dim)
+        new_keys = key_states.transpose(1, 2).reshape(-1, self.num_key_value_heads, self.head_dim)
+        new_values = value_states.transpose(1, 2).reshape(-1, self.num_key_value_heads, self.head_dim)
+        self.key_pool[layer_idx][self._write_block_ids, :, self._write_offsets] = new_keys.to(self.dtype)
+        self.value_pool[layer_idx][self._write_block_ids, :, self._write_offsets] = new_values.to(self.dtype)
+
+        return self._gather(self.key_pool[layer_idx]), self._gather(self.value_pool[layer_idx])
+
+    def free(self, batch_indices: List[int]):
+        """
+        Returns the blocks of the sequences at `batch_indices` to the pool. Their block tables then point to the null
+        block: they can still go through the model, but their outputs are meaningless.
+        """
+        rows = []
+        for batch_idx in batch_indices:
+            if self._freed[batch_idx]:
+                continue
+            self.allocator.free(self._block_lists[batch_idx])
+            self._block_lists[batch_idx] = []
+            self._freed[batch_idx] = True
+            rows.append(batch_idx)
+        if rows:
+            self.block_tables[rows] = 0
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Returns the sequence length of the cached states."""
+        return self._seq_length
+
+    def get_max_length(self) -> Optional[int]:
+        """The paged cache grows on demand and has no maximum length."""
+        return None
+
+    def reset(self):
+        """Frees every block, so that the pool can be reused by a new batch."""
+        if self.block_tables is not None:
+            self.free(list(range(len(self._block_lists))))
+        self.block_tables = None
+        self._block_lists = []
+        self._freed = []
+        self._seq_length = 0
+
+
+class SharedCrossAttentionCache(DynamicCache):
+    """
+    Cross-attention cache keeping a single copy of the key/value states for each unique encoder output of the batch.
+    Samples sharing the same description (and, with `prompt_cross_attention=True`, the same prompt) attend to the same
+    states, so the cross-attention layers only project and store the unique rows.
+
+    The states are never copied back to the full batch: the eager and SDPA attention layers group the queries of the
+    samples sharing a row with [`~SharedCrossAttentionCache.group_queries`], attend to the unique rows, and map the
+    outputs back to the batch with [`~SharedCrossAttentionCache.ungroup`]. Flash attention, and the legacy cache
+    format, read the states broadcast to the batch.
+
+    Parameters:
+        row_index (`torch.LongTensor` of shape `(batch_size,)`):
+            For each sample of the batch, the index of its unique encoder output.
+        unique_rows (`torch.LongTensor` of shape `(num_unique,)`):
+            For each unique encoder output, the index of a sample of the batch holding it.
+    """
+
+    def __init__(self, row_index: torch.LongTensor, unique_rows: torch.LongTensor):
+        super().__init__()
+        self.unique_rows = unique_rows
+        self._set_row_index(row_index)
+
+    def _set_row_index(self, row_index: torch.LongTensor):
+        self.row_index = row_index
+        # rank of each sample among the samples sharing its row, and the samples of each row, padded with the first
+        # sample of the batch
+        num_unique = self.unique_rows.shape[0]
+        batch_indices = torch.arange(row_index.shape[0], device=row_index.device)
+        counts = torch.bincount(row_index, minlength=num_unique)
+        order = torch.argsort(row_index, stable=True)
+        starts = counts.cumsum(0) - counts
+        self.group_slots = torch.empty_like(row_index)
+        self.group_slots[order] = batch_indices - starts[row_index[order]]
+        self.group_rows = row_index.new_zeros((num_unique, int(counts.max())))
+        self.group_rows[row_index, self.group_slots] = batch_indices
+
+    @classmethod
+    def from_encoder_outputs(
+        cls, encoder_hidden_states: torch.Tensor, encoder_attention_mask: Optional[torch.Tensor] = None
+    ) -> Optional["SharedCrossAttentionCache"]:
+        """
+        Finds the identical rows of `encoder_hidden_states` and `encoder_attention_mask`. Returns `None` if every row
+        of the batch is unique, in which case there is nothing to share.
+        """
+        rows = encoder_hidden_states.flatten(1)
+        if encoder_attention_mask is not None:
+            rows = torch.cat([rows, encoder_attention_mask.to(rows.dtype)], dim=1)
+        _, row_index = torch.unique(rows, dim=0, return_inverse=True)
+        num_unique = int(row_index.max()) + 1
+        if num_unique == rows.shape[0]:
+            return None
+        batch_indices = torch.arange(rows.shape[0], device=row_index.device)
+        unique_rows = batch_indices.new_zeros(num_unique).scatter_reduce(
+            0, row_index, batch_indices, reduce="amin", include_self=False
+        )
+        return cls(row_index, unique_rows)
+
+    def select_unique(self, states: torch.Tensor) -> torch.Tensor:
+        """Keeps one row of `states` per unique encoder output."""
+        return states.index_select(0, self.unique_rows)
+
+    def broadcast(self, states: torch.Tensor) -> torch.Tensor:
+        """Maps `states` of the unique encoder outputs back to the rows of the batch."""
+        if states.shape[0] == 1:
+            return states.expand(self.row_index.shape[0], *states.shape[1:])
+        return states.index_select(0, self.row_index)
+
+    def group_queries(self, query_states: torch.Tensor) -> torch.Tensor:
+        """
+        Concatenates the `(batch_size, num_heads, tgt_len, head_dim)` queries of the samples sharing each unique
+        encoder output along the sequence dimension, into `(num_unique, num_heads, group_size * tgt_len, head_dim)`
+        queries that attend to the cached states as is.
+        """
+        query_states = query_states[self.group_rows]
+        num_unique, group_size, num_heads, tgt_len, head_dim = query_states.shape
+        return query_states.transpose(1, 2).reshape(num_unique, num_heads, group_size * tgt_len, head_dim)
+
+    def group_attention_mask(self, attention_mask: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        """Keeps the `(batch_size, 1, tgt_len, src_len)` encoder attention mask of each unique encoder output."""
+        if attention_mask is None:
+            return None
+        # the samples sharing a row have the same encoder attention mask, whatever the query position
+        return attention_mask[self.group_rows[:, 0], :, :1]
+
+    def ungroup(self, states: torch.Tensor, tgt_len: int) -> torch.Tensor:
+        """Maps the outputs of the queries grouped by [`~SharedCrossAttentionCache.group_queries`] back to the batch."""
+        num_unique, num_heads, _, dim = states.shape
+        states = states.reshape(num_unique, num_heads, -1, tgt_len, dim).transpose(1, 2)
+        return states[self.row_index, self.group_slots]
+
+    def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        key_states, value_states = super().__getitem__(layer_idx)
+        return self.broadcast(key_states), self.broadcast(value_states)
+
+    def batch_select_indices(self, indices: torch.Tensor):
+        """Only keeps the samples `indices` of the batch. The states of the unique encoder outputs are kept as is."""
+        self._set_row_index(self.row_index[indices])
+
+
+class PagedCacheReleaseCriteria(StoppingCriteria):
+    """
+    Never stops generation, but returns the blocks of a [`PagedCache`] to its pool as soon as every codebook of a
+    sample has emitted EOS. The subsequent tokens of such a sample are replaced by padding, so its cached states are
+    not needed anymore.
+
+    Args:
+        cache (`PagedCache`):
+            The self-attention cache used by the generation loop.
+        num_codebooks (`int`):
+            Number of codebooks of the decoder. Generated ids are of shape `(batch_size * num_codebooks, seq_len)`.
+        eos_token_id (`int` or `List[int]`):
+            The end-of-sequence token id(s).
+        pad_token_id (`int`, *optional*):
+            The padding token id, emitted by codebooks once they are finished.
+    """
+
+    def __init__(
+        self,
+        cache: PagedCache,
+        num_codebooks: int,
+        eos_token_id: Union[int, List[int], torch.Tensor],
+        pad_token_id: Optional[int] = None,
+    ):
+        self.cache = cache
+        self.num_codebooks = num_codebooks
+        finished_token_ids = torch.as_tensor(eos_token_id).reshape(-1).tolist()
+        if pad_token_id is not None:
+            finished_token_ids.append(int(pad_token_id))
+        self.finished_token_ids = torch.tensor(finished_token_ids)
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        finished_token_ids = self.finished_token_ids.to(input_ids.device)
+        codebook_finished = torch.isin(input_ids[:, -1], finished_token_ids)
+        finished = codebook_finished.reshape(-1, self.num_codebooks).all(dim=-1)
+        if finished.any():
+            self.cache.free(finished.nonzero().flatten().tolist())
+        return torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+
+
+class TextEncoderOutputCache:
+    """
+    Least-recently-used cache of the projected text encoder outputs, keyed by the tokens of a description. Entries are
+    stored without padding, so a description gets a hit whatever the padding of the batch it comes in.
+
+    The cache is bounded both in number of entries and in bytes: the least recently used entries are evicted until
+    both bounds are satisfied. It does not track the model weights, so it should be cleared with
+    [`~TextEncoderOutputCache.clear`] if they change.
+
+    Args:
+        max_entries (`int`, *optional*, defaults to 256):
+            Maximum number of descriptions to keep.
+        max_bytes (`int`, *optional*):
+            Maximum total size of the cached hidden states, in bytes. No limit if not specified.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        if max_entries < 1:
+            raise ValueError(f"`max_entries` should be at least 1, got {max_entries}.")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries: "OrderedDict[Tuple[int, ...], torch.Tensor]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(input_ids: torch.LongTensor, attention_mask: Optional[torch.LongTensor] = None) -> Tuple[int, ...]:
+        """Returns the key of a single description, i.e. its non-padding token ids."""
+        if attention_mask is not None:
+            input_ids = input_ids[attention_mask.bool()]
+        return tuple(input_ids.tolist())
+
+    def get(self, key: Tuple[int, ...]) -> Optional[torch.Tensor]:
+        """Returns the hidden states of shape `(num_tokens, hidden_size)` cached for `key`, or `None`."""
+        hidden_states = self._entries.get(key)
+        if hidden_states is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return hidden_states
+
+    def put(self, key: Tuple[int, ...], hidden_states: torch.Tensor):
+        """Caches `hidden_states` of shape `(num_tokens, hidden_size)` for `key`, evicting old entries if needed."""
+        nbytes = self._nbytes(hidden_states)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self.nbytes -= self._nbytes(self._entries.pop(key))
+        self._entries[key] = hidden_states.detach()
+        self.nbytes += nbytes
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= self._nbytes(evicted)
+
+    def clear(self):
+        """Removes every entry and resets the hit and miss counters."""
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _nbytes(hidden_states: torch.Tensor) -> int:
+        return hidden_states.numel() * hidden_states.element_size()
+
+
+class PromptPrefixCache:
+    """
+    Least-recently-used cache of the decoder self-attention key/value states of the prompts, with
+    `prompt_cross_attention=False`, keyed by the tokens of a description and of a prompt.
+
+    The states of a prompt token only depend on the description and on the prompt tokens before it, so the states of
+    a cached prompt are valid for any prompt that starts with the same tokens, for the same description.
+    [`~PromptPrefixCache.match`] returns the cached prompt sharing the longest prefix with a new one, whose states
+    are loaded in the cache of `generate` so that only the rest of the prompt is run through the decoder.
+
+    Entries are bounded both in number and in bytes, the least recently used ones being evicted first. A cached prompt
+    that is a prefix of a new one is replaced by it. The cache does not track the model weights, so it should be
+    cleared with [`~PromptPrefixCache.clear`] if they change.
+
+    Args:
+        max_entries (`int`, *optional*, defaults to 256):
+            Maximum number of prompts to keep.
+        max_bytes (`int`, *optional*):
+            Maximum total size of the cached key/value states, in bytes. No limit if not specified.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        if max_entries < 1:
+            raise ValueError(f"`max_entries` should be at least 1, got {max_entries}.")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        # (description tokens, prompt tokens) -> (key states, value states) of each layer, of shape
+        # `(num_heads, num_prompt_tokens, head_dim)`
+        self._entries: "OrderedDict[Tuple[Any, Any], Tuple[List[torch.Tensor], List[torch.Tensor]]]" = OrderedDict()
+        # description tokens -> cached prompts of the description
+        self._prompts: Dict[Tuple[int, ...], set] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def get_key(
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.LongTensor],
+        prompt_input_ids: torch.LongTensor,
+        prompt_attention_mask: Optional[torch.LongTensor] = None,
+    ) -> Tuple[Tuple[int, ...], Tuple[int, ...]]:
+        """
+        Returns the key of a single sample: the non-padding tokens of its description, and the tokens of its prompt
+        up to the first padding token. Prompt tokens after left padding are at shifted positions, so a left-padded
+        prompt has an empty key and is not cached.
+        """
+        if attention_mask is not None:
+            input_ids = input_ids[attention_mask.bool()]
+        if prompt_attention_mask is not None:
+            num_prompt_tokens = int(prompt_attention_mask.long().cumprod(dim=0).sum())
+            prompt_input_ids = prompt_input_ids[:num_prompt_tokens]
+        return tuple(input_ids.tolist()), tuple(prompt_input_ids.tolist())
+
+    def match(
+        self, key: Tuple[Tuple[int, ...], Tuple[int, ...]]
+    ) -> Tuple[Optional[Tuple[List[torch.Tensor], List[torch.Tensor]]], int]:
+        """
+        Returns the key/value states of the cached prompt of the same description that shares the longest prefix
+        with the prompt of `key`, and the length of that prefix. Returns `(None, 0)` if there is no such prompt.
+        """
+        description, prompt = key
+        best_prompt, best_length = None, 0
+        for cached_prompt in self._prompts.get(description, ()):
+            length = 0
+            for cached_token, token in zip(cached_prompt, prompt):
+                if cached_token != token:
+                    break
+                length += 1
+            if length > best_length:
+                best_prompt, best_length = cached_prompt, length
+
+        if best_prompt is None:
+            self.misses += 1
+            return None, 0
+        self._entries.move_to_end((description, best_prompt))
+        self.hits += 1
+        return self._entries[(description, best_prompt)], best_length
+
+    def put(
+        self,
+        key: Tuple[Tuple[int, ...], Tuple[int, ...]],
+        key_states: List[torch.Tensor],
+        value_states: List[torch.Tensor],
+    ):
+        """
+        Caches the key/value states of each layer, of shape `(num_heads, num_prompt_tokens, head_dim)`, of the prompt
+        of `key`, evicting old entries if needed.
+        """
+        description, prompt = key
+        if len(prompt) == 0:
+            return
+        nbytes = self._nbytes(key_states) + self._nbytes(value_states)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+
+        # the new prompt covers the cached prompts that are a prefix of it
+        for cached_prompt in list(self._prompts.get(description, ())):
+            if prompt[: len(cached_prompt)] == cached_prompt:
+                self._pop((description, cached_prompt))
+
+        self._entries[key] = ([states.detach() for states in key_states], [states.detach() for states in value_states])
+        self._prompts.setdefault(description, set()).add(prompt)
+        self.nbytes += nbytes
+        while len(self._entries) > self.max_entries or (self.max_bytes is not None and self.nbytes > self.max_bytes):
+            self._pop(next(iter(self._entries)))
+
+    def clear(self):
+        """Removes every entry and resets the hit and miss counters."""
+        self._entries.clear()
+        self._prompts.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _pop(self, key):
+        description, prompt = key
+        key_states, value_states = self._entries.pop(key)
+        self.nbytes -= self._nbytes(key_states) + self._nbytes(value_states)
+        self._prompts[description].discard(prompt)
+        if not self._prompts[description]:
+            del self._prompts[description]
+
+    @staticmethod
+    def _nbytes(states: List[torch.Tensor]) -> int:
+        return sum(layer_states.numel() * layer_states.element_size() for layer_states in states)
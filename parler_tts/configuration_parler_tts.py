@@ -91,6 +91,10 @@ class ParlerTTSDecoderConfig(PretrainedConfig):
             The base period of the RoPE embeddings.
         cross_attention_implementation_strategy (`str`, *optional*):
             If not specified, the cross-attention implementation will be the same as `_attn_implementation`. If `always_eager`, it will always be the eager implementation. If `always_sdpa`, it will always be the sdpa implementation.
+        loss_chunk_size (`int`, *optional*):
+            If set, the training loss is computed over chunks of `loss_chunk_size` positions, whose logits are
+            recomputed during the backward pass, so that the logits of the whole sequence never exist at once. The
+            `logits` of the outputs are then `None` whenever `labels` are passed.
     """
 
     model_type = "parler_tts_decoder"
@@ -122,6 +126,7 @@ class ParlerTTSDecoderConfig(PretrainedConfig):
         rope_embeddings=False,
         rope_theta=10_000.0,
         cross_attention_implementation_strategy=None,
+        loss_chunk_size=None,
         **kwargs,
     ):
         self.vocab_size = vocab_size
@@ -148,6 +153,7 @@ class ParlerTTSDecoderConfig(PretrainedConfig):
         self.rope_embeddings = rope_embeddings
         self.rope_theta = rope_theta
         self.cross_attention_implementation_strategy = cross_attention_implementation_strategy
+        self.loss_chunk_size = loss_chunk_size
 
         super().__init__(
             pad_token_id=pad_token_id,
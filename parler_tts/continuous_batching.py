@@ -0,0 +1,661 @@
+import copy
+import itertools
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache, DynamicCache, EncoderDecoderCache
+from transformers.generation.configuration_utils import GenerationConfig
+from transformers.utils import logging
+
+from .cache_utils import pad_to_length
+from .modeling_parler_tts import (
+    ParlerTTSForConditionalGeneration,
+    build_delay_pattern_mask,
+    revert_delay_pattern_mask,
+)
+
+
+logger = logging.get_logger(__name__)
+
+
+@dataclass
+class ParlerTTSRequestOutput:
+    """
+    Output of a request processed by the [`ParlerTTSContinuousBatchingEngine`] or the [`ParlerTTSVocoder`].
+
+    Args:
+        request_id (`Any`):
+            Identifier of the request, as returned by [`~ParlerTTSContinuousBatchingEngine.add_request`].
+        audio_codes (`torch.LongTensor` of shape `(num_codebooks, num_frames)`):
+            Generated audio codes, with the delay pattern reverted.
+        audio_values (`torch.FloatTensor` of shape `(sequence_length,)`, *optional*):
+            Decoded audio waveform. `None` if the engine was created with `decode_audio=False`, in which case the codes
+            can be decoded separately, in larger batches, by a [`ParlerTTSVocoder`].
+    """
+
+    request_id: Any = None
+    audio_codes: torch.LongTensor = None
+    audio_values: Optional[torch.FloatTensor] = None
+
+
+@dataclass
+class _PendingRequest:
+    request_id: Any
+    input_ids: torch.LongTensor
+    attention_mask: torch.LongTensor
+    prompt_input_ids: Optional[torch.LongTensor]
+    prompt_attention_mask: Optional[torch.LongTensor]
+    max_length: int
+    min_new_tokens: int
+
+
+@dataclass
+class _PrefillingRequest:
+    request: _PendingRequest
+    encoder_hidden_states: torch.FloatTensor
+    encoder_attention_mask: torch.LongTensor
+    prompt_hidden_states: Optional[torch.FloatTensor]
+    prompt_attention_mask: Optional[torch.LongTensor]
+    cache: EncoderDecoderCache
+    num_prefilled: int = 0
+
+
+class _SlotCache(Cache):
+    """
+    Self-attention cache holding one row (slot) per running request. Each slot has its own length, so that requests
+    admitted at different decoding steps can share a batch: keys and values of the new token are written at the
+    per-row positions set with `set_write_positions`, and the attention mask is responsible for hiding the unused tail
+    of shorter rows.
+    """
+
+    def __init__(self, num_layers: int, max_batch_size: int, num_heads: int, head_dim: int, device, dtype):
+        self.num_layers = num_layers
+        self.max_batch_size = max_batch_size
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.device = device
+        self.dtype = dtype
+        self.capacity = 0
+        self.key_cache: List[torch.Tensor] = [self._empty() for _ in range(num_layers)]
+        self.value_cache: List[torch.Tensor] = [self._empty() for _ in range(num_layers)]
+        self._write_rows = None
+        self._write_positions = None
+        self._attend_length = 0
+
+    def _empty(self):
+        return torch.zeros(
+            (self.max_batch_size, self.num_heads, self.capacity, self.head_dim), device=self.device, dtype=self.dtype
+        )
+
+    def reserve(self, capacity: int):
+        """Makes sure every slot can hold at least `capacity` positions."""
+        if capacity <= self.capacity:
+            return
+        self.key_cache = [pad_to_length(k, 2, capacity) for k in self.key_cache]
+        self.value_cache = [pad_to_length(v, 2, capacity) for v in self.value_cache]
+        self.capacity = capacity
+
+    def set_write_positions(self, write_positions: torch.LongTensor, attend_length: int):
+        """Sets the position at which each of the first `len(write_positions)` slots stores its next token."""
+        self._write_rows = torch.arange(write_positions.shape[0], device=self.device)
+        self._write_positions = write_positions
+        self._attend_length = attend_length
+
+    def write(self, slot: int, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor):
+        """Copies the `(num_heads, seq_len, head_dim)` prefilled states of a request into `slot`."""
+        seq_len = key_states.shape[-2]
+        self.key_cache[layer_idx][slot, :, :seq_len] = key_states
+        self.value_cache[layer_idx][slot, :, :seq_len] = value_states
+
+    def move(self, src: int, dst: int):
+        for layer_idx in range(self.num_layers):
+            self.key_cache[layer_idx][dst] = self.key_cache[layer_idx][src]
+            self.value_cache[layer_idx][dst] = self.value_cache[layer_idx][src]
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if key_states.shape[-2] != 1:
+            raise ValueError("The slot cache only supports decoding one token per row at a time.")
+        num_rows = key_states.shape[0]
+        self.key_cache[layer_idx][self._write_rows, :, self._write_positions] = key_states[:, :, 0]
+        self.value_cache[layer_idx][self._write_rows, :, self._write_positions] = value_states[:, :, 0]
+        return (
+            self.key_cache[layer_idx][:num_rows, :, : self._attend_length],
+            self.value_cache[layer_idx][:num_rows, :, : self._attend_length],
+        )
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self._attend_length
+
+    def get_max_length(self) -> Optional[int]:
+        return self.capacity
+
+
+class ParlerTTSContinuousBatchingEngine:
+    r"""
+    Scheduler-driven generation engine for [`ParlerTTSForConditionalGeneration`].
+
+    Contrary to [`~ParlerTTSForConditionalGeneration.generate`], which runs a static batch until its longest row is
+    done, the engine keeps a pool of `max_batch_size` slots. At every call to [`~ParlerTTSContinuousBatchingEngine.step`],
+    waiting requests are admitted into free slots (their description is encoded and their prompt prefilled), all
+    running requests are advanced by one decoding step, and requests that emitted EOS in every codebook (or reached
+    their maximum length) are retired immediately, freeing their slot for the next request.
+
+    Each slot keeps its own delay pattern mask, self-attention and cross-attention key/values and prompt state, so
+    requests with different description and prompt lengths can be decoded together.
+
+    Only the `eager` and `sdpa` attention implementations are supported. Sampling supports the logits warpers built
+    from the generation config (`temperature`, `top_k`, `top_p`, ...) and `min_new_tokens`; other logits processors
+    are ignored.
+
+    Parameters:
+        model (`ParlerTTSForConditionalGeneration`):
+            The Parler-TTS model used to generate.
+        max_batch_size (`int`, *optional*, defaults to 8):
+            Maximum number of requests decoded concurrently.
+        generation_config (`~generation.GenerationConfig`, *optional*):
+            The generation configuration to use. Defaults to `model.generation_config`.
+        decode_audio (`bool`, *optional*, defaults to `True`):
+            Whether to decode the audio codes of finished requests with the audio encoder.
+        prefill_chunk_size (`int`, *optional*):
+            With `prompt_cross_attention=False`, the prompt of an admitted request is prefilled `prefill_chunk_size`
+            tokens per step, in between the decoding steps of the running requests, instead of all at once. This
+            bounds the time of a step when long prompts are admitted. The request takes its slot once its prompt is
+            prefilled.
+        kwargs (`Dict[str, Any]`, *optional*):
+            Ad hoc parametrization of `generation_config`, e.g. `do_sample=True, temperature=1.0`.
+
+    Example:
+
+    ```python
+    >>> engine = ParlerTTSContinuousBatchingEngine(model, max_batch_size=16, do_sample=True)
+    >>> for description, prompt in requests:
+    ...     engine.add_request(tokenizer(description).input_ids, prompt_input_ids=tokenizer(prompt).input_ids)
+    >>> while engine.has_unfinished_requests():
+    ...     for output in engine.step():
+    ...         print(output.request_id, output.audio_values.shape)
+    ```
+    """
+
+    def __init__(
+        self,
+        model: ParlerTTSForConditionalGeneration,
+        max_batch_size: int = 8,
+        generation_config: Optional[GenerationConfig] = None,
+        decode_audio: bool = True,
+        prefill_chunk_size: Optional[int] = None,
+        **kwargs,
+    ):
+        if model.config._attn_implementation == "flash_attention_2":
+            raise ValueError(
+                "`ParlerTTSContinuousBatchingEngine` relies on custom 4D attention masks and does not support "
+                "`attn_implementation='flash_attention_2'`. Use `attn_implementation='sdpa'` instead."
+            )
+        if prefill_chunk_size is not None and prefill_chunk_size < 1:
+            raise ValueError(f"`prefill_chunk_size` should be at least 1, got {prefill_chunk_size}.")
+
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.decode_audio = decode_audio
+        self.prefill_chunk_size = prefill_chunk_size
+
+        generation_config = copy.deepcopy(
+            generation_config if generation_config is not None else model.generation_config
+        )
+        unused_kwargs = generation_config.update(**kwargs)
+        if unused_kwargs:
+            raise ValueError(f"The following arguments are not used by the generation config: {list(unused_kwargs)}")
+        generation_config.validate()
+        self.generation_config = generation_config
+
+        decoder_config = model.config.decoder
+        self.num_codebooks = decoder_config.num_codebooks
+        self.bos_token_id = generation_config.bos_token_id
+        self.pad_token_id = generation_config.pad_token_id
+        self.eos_token_id = generation_config.eos_token_id
+        if isinstance(self.eos_token_id, list):
+            self.eos_token_id = self.eos_token_id[0]
+
+        self.device = model.device
+        self.dtype = model.dtype
+        self.logits_warper = (
+            model._get_logits_warper(generation_config, device=self.device) if generation_config.do_sample else None
+        )
+
+        head_dim = decoder_config.hidden_size // decoder_config.num_attention_heads
+        self.self_attention_cache = _SlotCache(
+            decoder_config.num_hidden_layers,
+            max_batch_size,
+            decoder_config.num_key_value_heads,
+            head_dim,
+            self.device,
+            self.dtype,
+        )
+        self.cross_attention_cache = _SlotCache(
+            decoder_config.num_hidden_layers,
+            max_batch_size,
+            decoder_config.num_cross_attention_key_value_heads,
+            head_dim,
+            self.device,
+            self.dtype,
+        )
+        # the cross-attention key/values are written at admission, so the decoder should never recompute them
+        self.cache = EncoderDecoderCache(self.self_attention_cache, DynamicCache())
+        self.cache.is_updated = dict.fromkeys(range(decoder_config.num_hidden_layers), True)
+
+        # per-slot state, kept contiguous: running requests always occupy slots `0 .. num_active - 1`
+        self._requests: List[_PendingRequest] = []
+        self._sequences = torch.zeros((max_batch_size, self.num_codebooks, 0), dtype=torch.long, device=self.device)
+        self._delay_pattern_masks = torch.zeros_like(self._sequences)
+        self._cur_lengths = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self._cache_lengths = torch.zeros(max_batch_size, dtype=torch.long, device=self.device)
+        self._unfinished = torch.zeros((max_batch_size, self.num_codebooks), dtype=torch.bool, device=self.device)
+        self._key_mask = torch.zeros((max_batch_size, 0), dtype=torch.long, device=self.device)
+        self._encoder_attention_mask = torch.zeros((max_batch_size, 0), dtype=torch.long, device=self.device)
+
+        self._waiting = deque()
+        # admitted requests whose prompt is being prefilled, see `prefill_chunk_size`
+        self._prefilling: List[_PrefillingRequest] = []
+        self._request_counter = itertools.count()
+
+    @property
+    def num_active(self) -> int:
+        """Number of requests currently being decoded."""
+        return len(self._requests)
+
+    @property
+    def num_waiting(self) -> int:
+        """Number of requests waiting for a free slot."""
+        return len(self._waiting)
+
+    @property
+    def num_prefilling(self) -> int:
+        """Number of admitted requests whose prompt is still being prefilled."""
+        return len(self._prefilling)
+
+    def has_unfinished_requests(self) -> bool:
+        return self.num_active > 0 or self.num_prefilling > 0 or self.num_waiting > 0
+
+    def add_request(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.LongTensor] = None,
+        prompt_input_ids: Optional[torch.LongTensor] = None,
+        prompt_attention_mask: Optional[torch.LongTensor] = None,
+        max_new_tokens: Optional[int] = None,
+        min_new_tokens: Optional[int] = None,
+        request_id: Optional[Any] = None,
+    ):
+        """
+        Queues a request. It will be admitted into the running batch as soon as a slot is free.
+
+        Args:
+            input_ids (`torch.LongTensor` of shape `(sequence_length,)` or `(1, sequence_length)`):
+                Token ids of the description, fed to the text encoder.
+            attention_mask (`torch.LongTensor`, *optional*):
+                Attention mask of the description.
+            prompt_input_ids (`torch.LongTensor` of shape `(prompt_length,)` or `(1, prompt_length)`, *optional*):
+                Token ids of the transcript.
+            prompt_attention_mask (`torch.LongTensor`, *optional*):
+                Attention mask of the transcript.
+            max_new_tokens (`int`, *optional*):
+                Maximum number of decoding steps for this request. Defaults to the generation config.
+            min_new_tokens (`int`, *optional*):
+                Minimum number of decoding steps before EOS is allowed. Defaults to the generation config.
+            request_id (`Any`, *optional*):
+                Identifier reported in the [`ParlerTTSRequestOutput`]. Defaults to an increasing integer.
+
+        Returns:
+            The request identifier.
+        """
+
+        def as_row(tensor):
+            if tensor is None:
+                return None
+            tensor = torch.as_tensor(tensor, device=self.device)
+            return tensor.reshape(1, -1)
+
+        input_ids = as_row(input_ids)
+        attention_mask = as_row(attention_mask) if attention_mask is not None else torch.ones_like(input_ids)
+        prompt_input_ids = as_row(prompt_input_ids)
+        if prompt_input_ids is not None and prompt_attention_mask is None:
+            prompt_attention_mask = torch.ones_like(prompt_input_ids)
+        prompt_attention_mask = as_row(prompt_attention_mask)
+
+        if max_new_tokens is None:
+            max_new_tokens = self.generation_config.max_new_tokens
+        # the bos column counts towards the maximum length, as in `generate`
+        max_length = max_new_tokens + 1 if max_new_tokens is not None else self.generation_config.max_length
+        if min_new_tokens is None:
+            min_new_tokens = self.generation_config.min_new_tokens or 0
+
+        request_id = request_id if request_id is not None else next(self._request_counter)
+        self._waiting.append(
+            _PendingRequest(
+                request_id=request_id,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                prompt_input_ids=prompt_input_ids,
+                prompt_attention_mask=prompt_attention_mask,
+                max_length=max_length,
+                min_new_tokens=min_new_tokens,
+            )
+        )
+        return request_id
+
+    @torch.no_grad()
+    def step(self) -> List[ParlerTTSRequestOutput]:
+        """
+        Admits waiting requests into free slots, runs one decoding step over the running batch and retires the
+        requests that are done. With `prefill_chunk_size`, the prompt of each admitted request is only advanced by one
+        chunk, and the request is decoded from the step its prompt is fully prefilled.
+
+        Returns:
+            `List[ParlerTTSRequestOutput]`: the requests that finished during this step.
+        """
+        finished = []
+        while self._waiting and self.num_active + self.num_prefilling < self.max_batch_size:
+            self._prefilling.append(self._start_prefill(self._waiting.popleft()))
+
+        prefilling = []
+        for prefill in self._prefilling:
+            if self._prefill_chunk(prefill):
+                prefilling.append(prefill)
+            else:
+                self._admit(prefill)
+        self._prefilling = prefilling
+        finished += self._retire_finished()
+
+        if self.num_active > 0:
+            self._decode_step()
+            finished += self._retire_finished()
+        return finished
+
+    def generate(self, requests: List[Dict[str, Any]]) -> List[ParlerTTSRequestOutput]:
+        """
+        Runs a list of requests to completion.
+
+        Args:
+            requests (`List[Dict[str, Any]]`):
+                Keyword arguments of [`~ParlerTTSContinuousBatchingEngine.add_request`], one dict per request.
+
+        Returns:
+            `List[ParlerTTSRequestOutput]`: the outputs, in the order of `requests`.
+        """
+        request_ids = [self.add_request(**request) for request in requests]
+        outputs = {}
+        while self.has_unfinished_requests():
+            for output in self.step():
+                outputs[output.request_id] = output
+        return [outputs[request_id] for request_id in request_ids]
+
+    def _start_prefill(self, request: _PendingRequest) -> _PrefillingRequest:
+        """Encodes the description and embeds the prompt of a request, and creates its request-local cache."""
+        model = self.model
+
+        # description (and prompt, if `prompt_cross_attention=True`) conditioning
+        model_kwargs = {"attention_mask": request.attention_mask}
+        model_kwargs = model._prepare_text_encoder_kwargs_for_generation(
+            request.input_ids, model_kwargs, "input_ids", self.generation_config
+        )
+        if request.prompt_input_ids is not None:
+            model_kwargs["prompt_attention_mask"] = request.prompt_attention_mask
+            model_kwargs = model._prepare_prompt_kwargs_for_generation(request.prompt_input_ids, model_kwargs)
+
+        return _PrefillingRequest(
+            request=request,
+            encoder_hidden_states=model_kwargs["encoder_outputs"].last_hidden_state,
+            encoder_attention_mask=model_kwargs["attention_mask"],
+            prompt_hidden_states=model_kwargs.get("prompt_hidden_states"),
+            prompt_attention_mask=model_kwargs.get("prompt_attention_mask"),
+            cache=EncoderDecoderCache(DynamicCache(), DynamicCache()),
+        )
+
+    def _prefill_chunk(self, prefill: _PrefillingRequest) -> bool:
+        """
+        Runs the next `prefill_chunk_size` tokens of the prompt through the decoder, into the request-local cache.
+
+        Returns whether part of the prompt is still to be prefilled. Without `prefill_chunk_size`, the prompt is
+        prefilled along with the first column in `_admit`.
+        """
+        if self.prefill_chunk_size is None or prefill.prompt_hidden_states is None:
+            return False
+
+        prompt_length = prefill.prompt_hidden_states.shape[1]
+        end = min(prefill.num_prefilled + self.prefill_chunk_size, prompt_length)
+        self.model._prefill_prompt_chunk(
+            prefill.prompt_hidden_states,
+            prefill.prompt_attention_mask,
+            prefill.encoder_hidden_states,
+            prefill.encoder_attention_mask,
+            prefill.cache,
+            prefill.num_prefilled,
+            end,
+        )
+        prefill.num_prefilled = end
+        return end < prompt_length
+
+    def _admit(self, prefill: _PrefillingRequest):
+        """Prefills the rest of the prompt and samples the first column of a request into a new slot."""
+        model = self.model
+        slot = self.num_active
+
+        # 1. conditioning, from `_start_prefill`
+        request = prefill.request
+        encoder_hidden_states = prefill.encoder_hidden_states
+        encoder_attention_mask = prefill.encoder_attention_mask
+        prompt_hidden_states = prefill.prompt_hidden_states
+        prompt_attention_mask = prefill.prompt_attention_mask
+
+        # 2. delay pattern mask and first decoder column
+        bos_ids = torch.full((self.num_codebooks, 1), self.bos_token_id, dtype=torch.long, device=self.device)
+        decoder_input_ids, delay_pattern_mask = build_delay_pattern_mask(
+            bos_ids, self.bos_token_id, self.pad_token_id, request.max_length, self.num_codebooks
+        )
+        decoder_input_ids = torch.where(delay_pattern_mask[:, :1] == -1, decoder_input_ids, delay_pattern_mask[:, :1])
+
+        # 3. prefill with the request-local cache, the prompt being prepended unless it was prefilled chunk by chunk
+        decoder_attention_mask = None
+        if prompt_attention_mask is not None:
+            decoder_attention_mask = torch.ones((1, 1), dtype=prompt_attention_mask.dtype, device=self.device)
+        prefill_cache = prefill.cache
+        outputs = model.decoder(
+            input_ids=decoder_input_ids,
+            attention_mask=decoder_attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            prompt_hidden_states=prompt_hidden_states if prefill.num_prefilled == 0 else None,
+            prompt_attention_mask=prompt_attention_mask,
+            past_key_values=prefill_cache,
+            use_cache=True,
+            return_dict=True,
+            num_logits_to_keep=1,
+        )
+        prefill_length = prefill_cache.self_attention_cache.get_seq_length()
+        encoder_length = encoder_hidden_states.shape[1]
+
+        # 4. move the request state into its slot
+        self.self_attention_cache.reserve(prefill_length + request.max_length)
+        self.cross_attention_cache.reserve(encoder_length)
+        for layer_idx in range(self.self_attention_cache.num_layers):
+            self.self_attention_cache.write(
+                slot,
+                layer_idx,
+                prefill_cache.self_attention_cache.key_cache[layer_idx][0],
+                prefill_cache.self_attention_cache.value_cache[layer_idx][0],
+            )
+            self.cross_attention_cache.write(
+                slot,
+                layer_idx,
+                prefill_cache.cross_attention_cache.key_cache[layer_idx][0],
+                prefill_cache.cross_attention_cache.value_cache[layer_idx][0],
+            )
+
+        self._sequences = pad_to_length(self._sequences, 2, request.max_length)
+        self._delay_pattern_masks = pad_to_length(self._delay_pattern_masks, 2, request.max_length, self.pad_token_id)
+        self._key_mask = pad_to_length(self._key_mask, 1, self.self_attention_cache.capacity)
+        self._encoder_attention_mask = pad_to_length(
+            self._encoder_attention_mask, 1, self.cross_attention_cache.capacity
+        )
+
+        self._sequences[slot] = 0
+        self._sequences[slot, :, :1] = bos_ids
+        self._delay_pattern_masks[slot] = self.pad_token_id
+        self._delay_pattern_masks[slot, :, : request.max_length] = delay_pattern_mask
+        self._cur_lengths[slot] = 1
+        self._cache_lengths[slot] = prefill_length
+        self._unfinished[slot] = True
+        self._key_mask[slot] = 0
+        if prompt_hidden_states is not None and prompt_attention_mask is not None:
+            self._key_mask[slot, : prompt_attention_mask.shape[1]] = prompt_attention_mask[0]
+            self._key_mask[slot, prompt_attention_mask.shape[1] : prefill_length] = 1
+        else:
+            self._key_mask[slot, :prefill_length] = 1
+        self._encoder_attention_mask[slot] = 0
+        self._encoder_attention_mask[slot, :encoder_length] = encoder_attention_mask[0]
+        self._requests.append(request)
+
+        # 5. sample the first generated column
+        self._select_next_tokens(outputs.logits[:, -1, :], slot, slot + 1)
+
+    def _decode_step(self):
+        """Feeds the last column of every running request through the decoder and samples the next one."""
+        num_active = self.num_active
+        rows = torch.arange(num_active, device=self.device)
+
+        cur_lengths = self._cur_lengths[:num_active]
+        columns = self._sequences[rows, :, cur_lengths - 1]
+        mask_columns = self._delay_pattern_masks[rows, :, cur_lengths - 1]
+        input_ids = torch.where(mask_columns == -1, columns, mask_columns).reshape(-1, 1)
+
+        # each row writes its new token right after its own cached positions
+        cache_lengths = self._cache_lengths[:num_active]
+        self._key_mask[rows, cache_lengths] = 1
+        attend_length = int(cache_lengths.max()) + 1
+        self.self_attention_cache.set_write_positions(cache_lengths, attend_length)
+
+        min_dtype = torch.finfo(self.dtype).min
+        key_mask = self._key_mask[:num_active, :attend_length]
+        attention_mask = (1 - key_mask[:, None, None, :].to(self.dtype)) * min_dtype
+
+        encoder_length = self.cross_attention_cache.capacity
+        self.cache.cross_attention_cache.key_cache = [k[:num_active] for k in self.cross_attention_cache.key_cache]
+        self.cache.cross_attention_cache.value_cache = [v[:num_active] for v in self.cross_attention_cache.value_cache]
+        # cross-attention key/values are already cached: the hidden states are only needed for their shape
+        encoder_hidden_states = torch.zeros((), dtype=self.dtype, device=self.device).expand(
+            num_active, encoder_length, self.model.config.decoder.hidden_size
+        )
+
+        outputs = self.model.decoder(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=cache_lengths[:, None],
+            sinusoidal_position_ids=cache_lengths[:, None],
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=self._encoder_attention_mask[:num_active, :encoder_length],
+            past_key_values=self.cache,
+            use_cache=True,
+            return_dict=True,
+            cache_position=cache_lengths[:1],
+        )
+        self._cache_lengths[:num_active] += 1
+
+        self._select_next_tokens(outputs.logits[:, -1, :], 0, num_active)
+
+    def _select_next_tokens(self, logits: torch.FloatTensor, start: int, end: int):
+        """Samples the next column of slots `start .. end - 1` from their `(rows * num_codebooks, vocab)` logits."""
+        num_rows = end - start
+        scores = logits.float().reshape(num_rows, self.num_codebooks, -1)
+
+        generated = self._cur_lengths[start:end] - 1
+        min_new_tokens = torch.tensor(
+            [request.min_new_tokens for request in self._requests[start:end]], device=self.device
+        )
+        block_eos = generated < min_new_tokens
+        scores[..., self.eos_token_id] = scores[..., self.eos_token_id].masked_fill(block_eos[:, None], -float("inf"))
+        scores = scores.reshape(num_rows * self.num_codebooks, -1)
+
+        if self.logits_warper is not None:
+            scores = self.logits_warper(None, scores)
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+            next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+        else:
+            next_tokens = torch.argmax(scores, dim=-1)
+        next_tokens = next_tokens.reshape(num_rows, self.num_codebooks)
+
+        # codebooks that already emitted EOS keep emitting padding
+        unfinished = self._unfinished[start:end]
+        next_tokens = torch.where(unfinished, next_tokens, self.pad_token_id)
+        self._unfinished[start:end] = unfinished & (next_tokens != self.eos_token_id)
+
+        rows = torch.arange(start, end, device=self.device)
+        self._sequences[rows, :, self._cur_lengths[start:end]] = next_tokens
+        self._cur_lengths[start:end] += 1
+
+    def _retire_finished(self) -> List[ParlerTTSRequestOutput]:
+        num_active = self.num_active
+        if num_active == 0:
+            return []
+        max_lengths = torch.tensor([request.max_length for request in self._requests], device=self.device)
+        done = ~self._unfinished[:num_active].any(dim=-1) | (self._cur_lengths[:num_active] >= max_lengths)
+        done_slots = done.nonzero().flatten().tolist()
+
+        outputs = []
+        # retire from the last slot so that compaction never moves a slot that is still to be retired
+        for slot in reversed(done_slots):
+            outputs.append(self._finalize(slot))
+            self._release(slot)
+        return outputs[::-1]
+
+    def _finalize(self, slot: int) -> ParlerTTSRequestOutput:
+        request = self._requests[slot]
+        cur_length = int(self._cur_lengths[slot])
+        output_ids = self._sequences[slot, :, :cur_length]
+
+        # apply the pattern mask to the final ids, then revert it by removing the bos and pad tokens of each codebook
+        delay_pattern_mask = self._delay_pattern_masks[slot, :, :cur_length]
+        output_ids = torch.where(delay_pattern_mask == -1, output_ids, delay_pattern_mask)
+        audio_codes = revert_delay_pattern_mask(output_ids, self.num_codebooks)[0]
+
+        audio_values = None
+        if self.decode_audio:
+            audio_values = self._decode_audio(audio_codes)
+        return ParlerTTSRequestOutput(
+            request_id=request.request_id, audio_codes=audio_codes, audio_values=audio_values
+        )
+
+    def _decode_audio(self, audio_codes: torch.LongTensor) -> torch.FloatTensor:
+        audio_encoder = self.model.audio_encoder
+        # drop the frames that contain special tokens, as done in `generate`
+        frame_mask = (audio_codes >= audio_encoder.config.codebook_size).sum(dim=0) == 0
+        if frame_mask.sum() == 0:
+            return torch.zeros(1, device=self.device)
+        audio_codes = audio_codes[:, frame_mask]
+        audio_values = audio_encoder.decode(audio_codes[None, None, ...], [None]).audio_values
+        return audio_values.reshape(-1)
+
+    def _release(self, slot: int):
+        """Frees `slot` by moving the last running request into it."""
+        last = self.num_active - 1
+        if slot != last:
+            self.self_attention_cache.move(last, slot)
+            self.cross_attention_cache.move(last, slot)
+            for state in (
+                self._sequences,
+                self._delay_pattern_masks,
+                self._cur_lengths,
+                self._cache_lengths,
+                self._unfinished,
+                self._key_mask,
+                self._encoder_attention_mask,
+            ):
+                state[slot] = state[last]
+            self._requests[slot] = self._requests[last]
+        self._requests.pop()
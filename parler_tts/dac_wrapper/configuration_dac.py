@@ -1,4 +1,6 @@
 
+from typing import Optional
+
 from transformers import PretrainedConfig
 
 
@@ -13,6 +15,8 @@ class DACConfig(PretrainedConfig):
         latent_dim: int = 1024,
         frame_rate: int = 86,
         sampling_rate: int = 44100,
+        chunk_length_s: float = None,
+        overlap: float = None,
         **kwargs,
     ):
         self.codebook_size = codebook_size
@@ -21,5 +25,24 @@ class DACConfig(PretrainedConfig):
         self.num_codebooks = num_codebooks
         self.frame_rate = frame_rate
         self.sampling_rate = sampling_rate
+        # if set, `encode` processes the audio by overlapping chunks of `chunk_length_s` seconds
+        self.chunk_length_s = chunk_length_s
+        self.overlap = overlap
 
         super().__init__(**kwargs)
+
+    # Copied from transformers.models.encodec.configuration_encodec.EncodecConfig.chunk_length
+    @property
+    def chunk_length(self) -> Optional[int]:
+        if self.chunk_length_s is None:
+            return None
+        else:
+            return int(self.chunk_length_s * self.sampling_rate)
+
+    # Copied from transformers.models.encodec.configuration_encodec.EncodecConfig.chunk_stride
+    @property
+    def chunk_stride(self) -> Optional[int]:
+        if self.chunk_length_s is None or self.overlap is None:
+            return None
+        else:
+            return max(1, int((1.0 - self.overlap) * self.chunk_length))
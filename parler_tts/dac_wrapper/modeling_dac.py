@@ -1,3 +1,5 @@
+import math
+
 import torch
 from dac.model import DAC
 from transformers import PreTrainedModel
@@ -6,9 +8,6 @@ from transformers.models.encodec.modeling_encodec import EncodecDecoderOutput, E
 from .configuration_dac import DACConfig
 
 
-# model doesn't support batching yet
-
-
 class DACModel(PreTrainedModel):
     config_class = DACConfig
 
@@ -21,17 +20,169 @@ class DACModel(PreTrainedModel):
             codebook_size=config.codebook_size,
         )
 
+    @property
+    def hop_length(self) -> int:
+        """Number of audio samples decoded from each frame of codes."""
+        return int(self.model.hop_length)
+
+    @property
+    def decoder_receptive_field(self) -> int:
+        """
+        Number of frames of codes on each side of a frame that its decoded audio samples depend on. Decoding a window
+        of frames gives the same samples as decoding the whole sequence, except for the `decoder_receptive_field`
+        frames at each of its ends that are not also ends of the whole sequence.
+        """
+        # receptive field radius, in frames, and number of samples per frame at the current layer
+        radius, rate = 0.0, 1
+        for module in self.model.decoder.modules():
+            if isinstance(module, torch.nn.ConvTranspose1d):
+                kernel_size, stride, padding = module.kernel_size[0], module.stride[0], module.padding[0]
+                radius += max(kernel_size - padding, padding) / stride / rate
+                rate *= stride
+            elif isinstance(module, torch.nn.Conv1d):
+                radius += module.dilation[0] * (module.kernel_size[0] - 1) / 2 / rate
+        return math.ceil(radius)
+
+    @property
+    def encoder_receptive_field(self) -> int:
+        """
+        Number of frames on each side of a frame whose audio samples its codes depend on. Encoding a window of audio
+        that starts and ends on frame boundaries gives the same codes as encoding the whole audio, except for the
+        `encoder_receptive_field` frames at each of its ends that are not also ends of the whole audio.
+        """
+        # samples on each side of a frame that it depends on, and number of samples per step at the current layer
+        left, right, rate = 0, 0, 1
+        for module in self.model.encoder.modules():
+            if isinstance(module, torch.nn.Conv1d):
+                kernel_size, stride, padding = module.kernel_size[0], module.stride[0], module.padding[0]
+                left += padding * rate
+                right += (module.dilation[0] * (kernel_size - 1) - padding) * rate
+                rate *= stride
+        return math.ceil(max(left, right) / self.hop_length)
+
+    @staticmethod
+    def _tail_windows(lengths, total_length, receptive_field, frame_length=1):
+        """
+        Returns the windows to process again for the rows shorter than `total_length`, whose last `receptive_field`
+        frames see the padding, grouped by window length as lists of `(batch_index, start_frame)`. Each window ends
+        with its row and has `receptive_field` frames of left context, if any. `lengths`, `total_length` and the
+        window lengths are in units of `1 / frame_length` frames.
+        """
+        windows = {}
+        for batch_index, length in enumerate(lengths):
+            if 0 < length < total_length:
+                start = max(length // frame_length - 2 * receptive_field, 0)
+                windows.setdefault(length - start * frame_length, []).append((batch_index, start))
+        return windows
+
+    def _encode_frames(self, audio_data, lengths=None, n_quantizers=None):
+        """
+        Encodes `audio_data`, of shape `(batch_size, channels, sequence_length)`, into codes of shape
+        `(batch_size, num_codebooks, frames)`. If `lengths` is set, the codes of each row are the codes of its first
+        `lengths` samples encoded alone, followed by padding frames.
+        """
+        _, audio_codes, _, _, _ = self.model.encode(audio_data, n_quantizers=n_quantizers)
+        if lengths is None:
+            return audio_codes
+
+        receptive_field, hop_length = self.encoder_receptive_field, self.hop_length
+        windows = self._tail_windows(lengths, audio_data.shape[-1], receptive_field, frame_length=hop_length)
+        for window_length, rows in windows.items():
+            window_data = torch.stack(
+                [audio_data[i, :, start * hop_length : start * hop_length + window_length] for i, start in rows]
+            )
+            _, window_codes, _, _, _ = self.model.encode(window_data, n_quantizers=n_quantizers)
+            for window_codes_, (i, start) in zip(window_codes, rows):
+                offset = receptive_field if start > 0 else 0
+                audio_codes[i, :, start + offset : start + window_codes_.shape[-1]] = window_codes_[:, offset:]
+        return audio_codes
+
+    def _encode_chunks(self, audio_data, chunk_length, stride=None, lengths=None, n_quantizers=None):
+        """
+        Encodes `audio_data` like [`~DACModel._encode_frames`], by windows of `chunk_length` samples every `stride`
+        samples. Only the codes of the frames in the middle of each window are kept, the frames that overlap with the
+        previous and next windows being the context that the kept frames depend on, so that the codes are the same as
+        encoding the whole audio at once. If `stride` is `None`, the windows overlap by the smallest context possible.
+        """
+        receptive_field, hop_length = self.encoder_receptive_field, self.hop_length
+        if stride is None:
+            stride = chunk_length - 2 * receptive_field * hop_length
+        stride_frames = stride // hop_length
+        context_frames = (chunk_length // hop_length - stride_frames) // 2
+        if stride_frames < 1 or context_frames < receptive_field:
+            raise ValueError(
+                f"Chunked encoding needs chunks that overlap by at least {2 * receptive_field * hop_length} samples, "
+                f"with a stride of at least {hop_length} samples, but got a chunk length of {chunk_length} and a "
+                f"stride of {stride}."
+            )
+
+        input_length = audio_data.shape[-1]
+        audio_codes = []
+        # first frame to keep from the current window
+        start = 0
+        while True:
+            window_start = max(start - context_frames, 0) * hop_length
+            window_end = min((start + stride_frames + context_frames) * hop_length, input_length)
+            offset = start - window_start // hop_length
+            window_lengths = None
+            if lengths is not None:
+                # the rows that end before the frames to keep are only padding in this window
+                window_lengths = [length - window_start for length in lengths]
+                window_lengths = [
+                    min(length, window_end - window_start) if length > offset * hop_length else 0
+                    for length in window_lengths
+                ]
+
+            window_codes = self._encode_frames(
+                audio_data[..., window_start:window_end], window_lengths, n_quantizers=n_quantizers
+            )
+            if window_end == input_length:
+                audio_codes.append(window_codes[..., offset:])
+                return torch.cat(audio_codes, dim=-1)
+            audio_codes.append(window_codes[..., offset : offset + stride_frames])
+            start += stride_frames
+
+    def _decode_frames(self, audio_codes, lengths=None):
+        """
+        Decodes `audio_codes`, of shape `(batch_size, num_codebooks, frames)`, into audio of shape
+        `(batch_size, 1, frames * hop_length)`. If `lengths` is set, the audio of each row is the audio of its first
+        `lengths` frames decoded alone, followed by zeros.
+        """
+        audio_values = self.model.decode(self.model.quantizer.from_codes(audio_codes)[0])
+        if lengths is None:
+            return audio_values
+
+        receptive_field, hop_length = self.decoder_receptive_field, self.hop_length
+        for window_length, rows in self._tail_windows(lengths, audio_codes.shape[-1], receptive_field).items():
+            windows = torch.stack([audio_codes[i, :, start : start + window_length] for i, start in rows])
+            window_values = self.model.decode(self.model.quantizer.from_codes(windows)[0])
+            for window_values_, (i, start) in zip(window_values, rows):
+                offset = receptive_field if start > 0 else 0
+                audio_values[i, :, (start + offset) * hop_length : (start + window_length) * hop_length] = (
+                    window_values_[:, offset * hop_length :]
+                )
+
+        samples = torch.arange(audio_values.shape[-1], device=audio_values.device)
+        lengths = torch.tensor(lengths, device=audio_values.device)
+        return audio_values.masked_fill((samples >= lengths[:, None] * hop_length)[:, None], 0)
+
     def encode(
         self, input_values, padding_mask=None, bandwidth=None, return_dict=None, n_quantizers=None, sample_rate=None
     ):
         """
         Encodes the input audio waveform into discrete codes.
 
+        If `config.chunk_length_s` is set, the audio is encoded by chunks of that length, overlapping by
+        `config.overlap` of their length, or by the smallest overlap possible if `None`. The memory used then does not
+        depend on the length of the audio, and the codes are the same as when encoding it at once.
+
         Args:
             input_values (`torch.Tensor` of shape `(batch_size, channels, sequence_length)`):
                 Float values of the input audio waveform.
-            padding_mask (`torch.Tensor` of shape `(batch_size, channels, sequence_length)`):
-                Padding mask used to pad the `input_values`.
+            padding_mask (`torch.Tensor` of shape `(batch_size, channels, sequence_length)`, *optional*):
+                Padding mask used to pad the `input_values`, with 1 for the samples of the audio and 0 for the right
+                padding. A mask of shape `(batch_size, sequence_length)` is also accepted. The codes of each row are
+                then the ones of its audio encoded alone, followed by padding frames.
             bandwidth (`float`, *optional*):
                 Not used, kept to have the same inferface as HF encodec.
             n_quantizers (`int`, *optional*) :
@@ -47,47 +198,35 @@ class DACModel(PreTrainedModel):
             Scale is not used here.
 
         """
-        _, channels, input_length = input_values.shape
+        batch_size, channels, input_length = input_values.shape
 
         if channels < 1 or channels > 2:
             raise ValueError(f"Number of audio channels must be 1 or 2, but got {channels}")
 
-        audio_data = self.model.preprocess(input_values, sample_rate)
+        lengths = None
+        if padding_mask is not None:
+            padding_mask = padding_mask.reshape(batch_size, -1, input_length).bool().any(dim=1)
+            if not padding_mask.all():
+                lengths = padding_mask.sum(dim=-1).tolist()
+                # the padding is encoded as silence
+                input_values = input_values.masked_fill(~padding_mask[:, None], 0)
 
-        return_dict = return_dict if return_dict is not None else self.config.return_dict
+        # the right padding added by `preprocess` is not encoded
+        audio_data = self.model.preprocess(input_values, sample_rate)[..., :input_length]
 
-        # TODO: for now, no chunk length
+        return_dict = return_dict if return_dict is not None else self.config.return_dict
 
-        chunk_length = None  # self.config.chunk_length
-        if chunk_length is None:
-            chunk_length = input_length
-            stride = input_length
+        chunk_length = self.config.chunk_length
+        if chunk_length is None or chunk_length >= input_length:
+            encoded_frames = self._encode_frames(audio_data, lengths, n_quantizers=n_quantizers)
         else:
-            stride = self.config.chunk_stride
-
-        if padding_mask is None:
-            padding_mask = torch.ones_like(input_values).bool()
-
-        encoded_frames = []
-        scales = []
-
-        step = chunk_length - stride
-        if (input_length % stride) - step != 0:
-            raise ValueError(
-                "The input length is not properly padded for batched chunked decoding. Make sure to pad the input correctly."
+            encoded_frames = self._encode_chunks(
+                audio_data, chunk_length, self.config.chunk_stride, lengths, n_quantizers=n_quantizers
             )
 
-        for offset in range(0, input_length - step, stride):
-            mask = padding_mask[..., offset : offset + chunk_length].bool()
-            frame = audio_data[:, :, offset : offset + chunk_length]
-
-            scale = None
-
-            _, encoded_frame, _, _, _ = self.model.encode(frame, n_quantizers=n_quantizers)
-            encoded_frames.append(encoded_frame)
-            scales.append(scale)
-
-        encoded_frames = torch.stack(encoded_frames)
+        # the chunks are merged back, so that the codes are the same as when encoding the audio at once
+        encoded_frames = encoded_frames[None]
+        scales = [None]
 
         if not return_dict:
             return (encoded_frames, scales)
@@ -112,9 +251,10 @@ class DACModel(PreTrainedModel):
                 Discret code embeddings computed using `model.encode`.
             audio_scales (`torch.Tensor` of shape `(batch_size, nb_chunks)`, *optional*):
                 Not used, kept to have the same inferface as HF encodec.
-            padding_mask (`torch.Tensor` of shape `(batch_size, channels, sequence_length)`):
-                Padding mask used to pad the `input_values`.
-                Not used yet, kept to have the same inferface as HF encodec.
+            padding_mask (`torch.Tensor` of shape `(batch_size, chunk_length)`, *optional*):
+                Mask of the frames to decode, with 1 for the frames of the audio and 0 for the frames to skip. If
+                `None`, the frames containing a special token, i.e. a code greater or equal to the codebook size, are
+                skipped. The audio of each row is then the audio of its frames decoded alone, followed by zeros.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
 
@@ -126,11 +266,66 @@ class DACModel(PreTrainedModel):
         if len(audio_codes) != 1:
             raise ValueError(f"Expected one frame, got {len(audio_codes)}")
 
-        audio_values = self.model.quantizer.from_codes(audio_codes.squeeze(0))[0]
-        audio_values = self.model.decode(audio_values)
+        audio_codes, lengths = self._pack_frames(audio_codes[0], padding_mask)
+        audio_values = self._decode_frames(audio_codes, lengths)
         if not return_dict:
             return (audio_values,)
         return EncodecDecoderOutput(audio_values)
 
+    @torch.no_grad()
+    def decode_chunks(self, audio_codes, padding_mask=None, chunk_length=None):
+        """
+        Decodes the given frames into an output audio waveform chunk by chunk, as a generator. Each chunk is decoded
+        with the frames that its samples depend on, so that the memory used does not depend on the number of frames,
+        and the chunks put together are the audio returned by [`~DACModel.decode`], up to the longest row.
+
+        Args:
+            audio_codes (`torch.LongTensor` of shape `(1, batch_size, num_codebooks, frames)`):
+                Discret code embeddings computed using `model.encode`.
+            padding_mask (`torch.Tensor` of shape `(batch_size, frames)`, *optional*):
+                Mask of the frames to decode, as in [`~DACModel.decode`].
+            chunk_length (`int`, *optional*):
+                Number of frames decoded in each chunk. If `None`, will default to one second of audio.
+
+        Yields:
+            `torch.FloatTensor` of shape `(batch_size, 1, chunk_length * hop_length)`, the audio of the next chunk
+            of each row. The last chunk can be shorter.
+        """
+        if len(audio_codes) != 1:
+            raise ValueError(f"Expected one frame, got {len(audio_codes)}")
+
+        audio_codes, lengths = self._pack_frames(audio_codes[0], padding_mask)
+        chunk_length = chunk_length if chunk_length is not None else self.config.frame_rate
+        receptive_field, hop_length = self.decoder_receptive_field, self.hop_length
+
+        num_frames = audio_codes.shape[-1] if lengths is None else max(lengths)
+        for start in range(0, num_frames, chunk_length):
+            end = min(start + chunk_length, num_frames)
+            window_start, window_end = max(start - receptive_field, 0), min(end + receptive_field, num_frames)
+            window_lengths = None
+            if lengths is not None:
+                window_lengths = [min(max(length - window_start, 0), window_end - window_start) for length in lengths]
+            audio_values = self._decode_frames(audio_codes[..., window_start:window_end], window_lengths)
+            yield audio_values[..., (start - window_start) * hop_length : (end - window_start) * hop_length]
+
+    def _pack_frames(self, audio_codes, padding_mask=None):
+        """
+        Moves the frames to decode of each row of `audio_codes`, of shape `(batch_size, num_codebooks, frames)`, to its
+        start, in order, and replaces the others by valid codes. Returns the codes and the number of frames to decode
+        of each row, or `None` if all the frames are decoded.
+        """
+        if padding_mask is None:
+            padding_mask = (audio_codes < self.config.codebook_size).all(dim=1)
+        if padding_mask.all():
+            return audio_codes, None
+
+        padding_mask = padding_mask.bool()
+        order = torch.sort(padding_mask.int(), dim=-1, descending=True, stable=True).indices
+        audio_codes = audio_codes.gather(-1, order[:, None].expand_as(audio_codes))
+        lengths = padding_mask.sum(dim=-1)
+        frames = torch.arange(audio_codes.shape[-1], device=audio_codes.device)
+        audio_codes = audio_codes.masked_fill((frames >= lengths[:, None])[:, None], 0)
+        return audio_codes, lengths.tolist()
+
     def forward(self, tensor):
         raise ValueError("`DACModel.forward` not implemented yet")
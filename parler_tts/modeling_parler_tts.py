@@ -14,6 +14,7 @@
 # limitations under the License.
 """ PyTorch ParlerTTS model."""
 import copy
+import functools
 import inspect
 import math
 import random
@@ -23,7 +24,7 @@ from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.nn import CrossEntropyLoss
+from torch.utils.checkpoint import checkpoint
 from transformers import AutoConfig, AutoModel, AutoModelForTextEncoding
 from transformers.activations import ACT2FN
 from transformers.cache_utils import (
@@ -36,6 +37,7 @@ from transformers.cache_utils import (
 from transformers.generation.configuration_utils import GenerationConfig
 from transformers.generation.logits_process import LogitsProcessorList
 from transformers.generation.stopping_criteria import StoppingCriteriaList
+from transformers.generation.utils import GenerateEncoderDecoderOutput, GenerateNonBeamOutput
 from transformers.modeling_attn_mask_utils import (
     AttentionMaskConverter,
     _prepare_4d_attention_mask,
@@ -52,13 +54,22 @@ from transformers.modeling_utils import PreTrainedModel
 from transformers.utils import (
     add_start_docstrings,
     add_start_docstrings_to_model_forward,
+    is_torchdynamo_compiling,
     logging,
     replace_return_docstrings,
 )
 from transformers.utils.import_utils import is_flash_attn_2_available, is_flash_attn_greater_or_equal_2_10
 
+from .cache_utils import (
+    PagedCache,
+    PagedCacheReleaseCriteria,
+    PromptPrefixCache,
+    SharedCrossAttentionCache,
+    TextEncoderOutputCache,
+)
 from .configuration_parler_tts import ParlerTTSConfig, ParlerTTSDecoderConfig
 from .dac_wrapper import DACConfig, DACModel
+from .voice_profile import ParlerTTSVoiceProfile
 
 
 AutoConfig.register("dac", DACConfig)
@@ -97,6 +108,23 @@ def apply_delay_pattern_mask(input_ids, decoder_pad_token_mask):
     return input_ids
 
 
+@functools.lru_cache(maxsize=64)
+def _get_delay_pattern(num_codebooks: int, max_length: int, device: torch.device):
+    """
+    Returns, for a delay pattern of shape `(num_codebooks, max_length)`, the position of the input id shifted to each
+    entry, and the boolean masks of the BOS and EOS (padding) entries. Cached per `(num_codebooks, max_length, device)`
+    so that they are only built once per generation shape, and directly on `device`.
+    """
+    positions = torch.arange(max_length, device=device)
+    codebooks = torch.arange(num_codebooks, device=device)[:, None]
+    # codebook `k` is delayed by `k` steps
+    offsets = positions - codebooks
+    # the lower triangular part is the BOS padding, the upper triangular part is the EOS padding
+    bos_mask = offsets <= 0
+    eos_mask = offsets >= max_length - num_codebooks + 1
+    return offsets, bos_mask, eos_mask
+
+
 def build_delay_pattern_mask(
     input_ids: torch.LongTensor, bos_token_id: int, pad_token_id: int, max_length: int, num_codebooks: int
 ):
@@ -122,39 +150,28 @@ def build_delay_pattern_mask(
     input_ids = input_ids.reshape(-1, num_codebooks, input_ids.shape[-1])
     bsz, num_codebooks, seq_len = input_ids.shape
 
-    input_ids_shifted = torch.ones((bsz, num_codebooks, max_length), dtype=torch.long, device=input_ids.device) * -1
-
     # we only apply the mask if we have a large enough seq len - otherwise we return as is
     if max_length < 2 * num_codebooks - 1:
-        return input_ids.reshape(bsz * num_codebooks, -1), input_ids_shifted.reshape(bsz * num_codebooks, -1)
+        input_ids_shifted = torch.full(
+            (bsz * num_codebooks, max_length), -1, dtype=torch.long, device=input_ids.device
+        )
+        return input_ids.reshape(bsz * num_codebooks, -1), input_ids_shifted
+
+    offsets, bos_mask, eos_mask = _get_delay_pattern(num_codebooks, max_length, input_ids.device)
 
     # fill the shifted ids with the prompt entries, offset by the codebook idx
-    for codebook in range(num_codebooks):
-        # mono channel - loop over the codebooks one-by-one
-        input_ids_shifted[:, codebook, codebook : seq_len + codebook] = input_ids[:, codebook]
-
-    # construct a pattern mask that indicates the positions of padding tokens for each codebook
-    # first fill the upper triangular part (the EOS padding)
-    eos_delay_pattern = torch.triu(
-        torch.ones((num_codebooks, max_length), dtype=torch.bool), diagonal=max_length - num_codebooks + 1
+    is_prompt = (offsets >= 0) & (offsets < seq_len)
+    input_ids_shifted = torch.gather(
+        input_ids.long(), 2, offsets.clamp(0, seq_len - 1).expand(bsz, num_codebooks, max_length)
     )
-    # then fill the lower triangular part (the BOS padding)
-    bos_delay_pattern = torch.tril(torch.ones((num_codebooks, max_length), dtype=torch.bool))
-
-    bos_mask = ~(bos_delay_pattern).to(input_ids.device)
-    eos_mask = ~(eos_delay_pattern).to(input_ids.device)
-    mask = ~(bos_delay_pattern + eos_delay_pattern).to(input_ids.device)
-    input_ids = mask * input_ids_shifted + ~bos_mask * bos_token_id + ~eos_mask * pad_token_id
-
-    # find the first position to start generating - this is the first place we have the -1 token
-    # and will always be in the first codebook (since it has no codebook offset)
-    first_codebook_ids = input_ids[:, 0, :]
-    start_ids = (first_codebook_ids == -1).nonzero()[:, 1]
-    if len(start_ids) > 0:
-        first_start_id = min(start_ids)
-    else:
-        # we have no tokens that need to be filled - return entire matrix of input ids
-        first_start_id = seq_len
+    input_ids_shifted = input_ids_shifted.masked_fill(~is_prompt, -1)
+
+    # then set the BOS and EOS padding of the delay pattern
+    input_ids = input_ids_shifted.masked_fill(bos_mask, bos_token_id).masked_fill(eos_mask, pad_token_id)
+
+    # the first position to start generating is the first place we have the -1 token in the first codebook (since it
+    # has no codebook offset), i.e. right after the prompt since input ids are positive
+    first_start_id = seq_len
 
     # (bsz * num_codebooks, seq_len) -> (bsz, num_codebooks, seq_len)
     pattern_mask = input_ids.reshape(bsz * num_codebooks, -1)
@@ -162,6 +179,22 @@ def build_delay_pattern_mask(
     return input_ids, pattern_mask
 
 
+def revert_delay_pattern_mask(input_ids: torch.LongTensor, num_codebooks: int):
+    """Revert the delay pattern of the input_ids, i.e. remove the BOS and EOS padding of each codebook and align the
+    codebooks. Input ids of shape `(bsz * num_codebooks, seq_len)` give ids of shape `(bsz, num_codebooks, seq_len -
+    num_codebooks)`, or `(bsz, num_codebooks, seq_len)` if they are too short to have had a delay pattern applied."""
+    # (bsz * num_codebooks, seq_len) -> (bsz, num_codebooks, seq_len)
+    input_ids = input_ids.reshape(-1, num_codebooks, input_ids.shape[-1])
+    bsz, num_codebooks, seq_len = input_ids.shape
+    if seq_len < 2 * num_codebooks - 1:
+        return input_ids
+
+    # codebook `k` starts after its `k + 1` BOS tokens
+    positions = torch.arange(seq_len - num_codebooks, device=input_ids.device)
+    positions = positions + torch.arange(1, num_codebooks + 1, device=input_ids.device)[:, None]
+    return torch.gather(input_ids, 2, positions.expand(bsz, num_codebooks, -1))
+
+
 # Copied from transformers.models.llama.modeling_llama.repeat_kv
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     """
@@ -245,14 +278,19 @@ class ParlerTTSSinusoidalPositionalEmbedding(nn.Module):
         return emb.to(torch.get_default_dtype())
 
     @torch.no_grad()
-    def forward(self, input_ids: torch.Tensor, past_key_values_length: int = 0):
+    def forward(
+        self, input_ids: torch.Tensor, past_key_values_length: int = 0, position_ids: Optional[torch.LongTensor] = None
+    ):
         bsz, seq_len, _ = input_ids.size()
-        # Create the position ids from the input token ids.
-        position_ids = torch.arange(seq_len, device=input_ids.device) + past_key_values_length
+        if position_ids is None:
+            # Create the position ids from the input token ids.
+            position_ids = torch.arange(seq_len, device=input_ids.device) + past_key_values_length
         # expand embeddings if needed
-        if seq_len > self.weights.size(0):
-            self.make_weights(seq_len + self.offset, self.embedding_dim)
-        return self.weights.index_select(0, position_ids.view(-1)).detach()
+        num_positions = int(position_ids.max()) + 1
+        if num_positions > self.weights.size(0):
+            self.make_weights(num_positions, self.embedding_dim)
+        # per-row position ids (e.g. rows at different decoding steps) give `(bsz, seq_len, embedding_dim)` positions
+        return self.weights.index_select(0, position_ids.reshape(-1)).view(*position_ids.shape, -1).detach()
 
 
 # Copied from transformers.models.llama.modeling_llama.LlamaRotaryEmbedding with Llama->ParlerTTS
@@ -418,8 +456,11 @@ class ParlerTTSAttention(nn.Module):
             key_states = past_key_value.key_cache[self.layer_idx]
             value_states = past_key_value.value_cache[self.layer_idx]
         else:
-            key_states = self._shape_key_value(self.k_proj(current_states), -1, bsz)
-            value_states = self._shape_key_value(self.v_proj(current_states), -1, bsz)
+            if is_cross_attention and isinstance(past_key_value, SharedCrossAttentionCache):
+                # only project and cache one copy of each unique encoder output
+                current_states = past_key_value.select_unique(current_states)
+            key_states = self._shape_key_value(self.k_proj(current_states), -1, current_states.shape[0])
+            value_states = self._shape_key_value(self.v_proj(current_states), -1, current_states.shape[0])
 
             if not is_cross_attention:
                 # cached key states already have rope applied - only apply to new state
@@ -432,6 +473,12 @@ class ParlerTTSAttention(nn.Module):
                     key_states, value_states, self.layer_idx, {"cache_position": cache_position}
                 )
 
+        shared_cross_attention = is_cross_attention and isinstance(past_key_value, SharedCrossAttentionCache)
+        if shared_cross_attention:
+            # the samples sharing an encoder output attend to its single copy, with their queries grouped together
+            query_states = past_key_value.group_queries(query_states)
+            attention_mask = past_key_value.group_attention_mask(attention_mask)
+
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
 
@@ -454,6 +501,10 @@ class ParlerTTSAttention(nn.Module):
         attn_probs = nn.functional.dropout(attn_weights, p=self.dropout, training=self.training)
         attn_output = torch.matmul(attn_probs, value_states)
 
+        if shared_cross_attention:
+            attn_weights = past_key_value.ungroup(attn_weights, tgt_len)
+            attn_output = past_key_value.ungroup(attn_output, tgt_len)
+
         if attn_output.size() != (bsz, self.num_heads, tgt_len, self.head_dim):
             raise ValueError(
                 f"`attn_output` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is"
@@ -545,8 +596,11 @@ class ParlerTTSFlashAttention2(ParlerTTSAttention):
             key_states = past_key_value.key_cache[self.layer_idx]
             value_states = past_key_value.value_cache[self.layer_idx]
         else:
-            key_states = self._shape_key_value(self.k_proj(current_states), -1, bsz)
-            value_states = self._shape_key_value(self.v_proj(current_states), -1, bsz)
+            if is_cross_attention and isinstance(past_key_value, SharedCrossAttentionCache):
+                # only project and cache one copy of each unique encoder output
+                current_states = past_key_value.select_unique(current_states)
+            key_states = self._shape_key_value(self.k_proj(current_states), -1, current_states.shape[0])
+            value_states = self._shape_key_value(self.v_proj(current_states), -1, current_states.shape[0])
 
             if not is_cross_attention and self.rope_embeddings:
                 # cached key states already have rope applied - only apply to new state
@@ -559,6 +613,10 @@ class ParlerTTSFlashAttention2(ParlerTTSAttention):
                     key_states, value_states, self.layer_idx, {"cache_position": cache_position}
                 )
 
+        if is_cross_attention and isinstance(past_key_value, SharedCrossAttentionCache):
+            # flash attention unpads the keys of each sample, the shared states are broadcast back to the batch
+            key_states, value_states = past_key_value.broadcast(key_states), past_key_value.broadcast(value_states)
+
         # # TODO: These transpose are quite inefficient but Flash Attention requires the layout [batch_size, sequence_length, num_heads, head_dim]
         # #  We would need to refactor the KV cache to be able to avoid many of these transpose/reshape/view.
         key_states = key_states.transpose(1, 2)
@@ -760,8 +818,11 @@ class ParlerTTSSdpaAttention(ParlerTTSAttention):
             key_states = past_key_value.key_cache[self.layer_idx]
             value_states = past_key_value.value_cache[self.layer_idx]
         else:
-            key_states = self._shape_key_value(self.k_proj(current_states), -1, bsz)
-            value_states = self._shape_key_value(self.v_proj(current_states), -1, bsz)
+            if is_cross_attention and isinstance(past_key_value, SharedCrossAttentionCache):
+                # only project and cache one copy of each unique encoder output
+                current_states = past_key_value.select_unique(current_states)
+            key_states = self._shape_key_value(self.k_proj(current_states), -1, current_states.shape[0])
+            value_states = self._shape_key_value(self.v_proj(current_states), -1, current_states.shape[0])
 
             if not is_cross_attention and self.rope_embeddings:
                 # cached key states already have rope applied - only apply to new state
@@ -774,6 +835,12 @@ class ParlerTTSSdpaAttention(ParlerTTSAttention):
                     key_states, value_states, self.layer_idx, {"cache_position": cache_position}
                 )
 
+        shared_cross_attention = is_cross_attention and isinstance(past_key_value, SharedCrossAttentionCache)
+        if shared_cross_attention:
+            # the samples sharing an encoder output attend to its single copy, with their queries grouped together
+            query_states = past_key_value.group_queries(query_states)
+            attention_mask = past_key_value.group_attention_mask(attention_mask)
+
         causal_mask = attention_mask
         if attention_mask is not None:  # no matter the length, we just slice it
             causal_mask = attention_mask[:, :, :, : key_states.shape[-2]]
@@ -799,6 +866,9 @@ class ParlerTTSSdpaAttention(ParlerTTSAttention):
             is_causal=is_causal,
         )
 
+        if shared_cross_attention:
+            attn_output = past_key_value.ungroup(attn_output, tgt_len)
+
         if attn_output.size() != (bsz, self.num_heads, tgt_len, self.head_dim):
             raise ValueError(
                 f"`attn_output` should be of size {(bsz, self.num_heads, tgt_len, self.head_dim)}, but is"
@@ -960,6 +1030,101 @@ class ParlerTTSDecoderLayer(nn.Module):
         return outputs
 
 
+class _ParlerTTSPackedCodebookWeight(nn.Module):
+    """
+    Base of the modules packing the weights of the codebooks into a single
+    `(num_codebooks * rows_per_codebook, hidden_size)` weight.
+
+    Its state dict uses the layout of a `nn.ModuleList` of per-codebook modules, i.e. `{k}.weight` keys, so that it can
+    load and save the same checkpoints.
+    """
+
+    def __init__(self, rows_per_codebook: int, hidden_size: int, num_codebooks: int):
+        super().__init__()
+        self.rows_per_codebook = rows_per_codebook
+        self.num_codebooks = num_codebooks
+        self.weight = nn.Parameter(torch.empty(num_codebooks * rows_per_codebook, hidden_size))
+        self._register_state_dict_hook(self._split_state_dict)
+
+    def _pack(self, modules: nn.ModuleList):
+        """Sets the packed weight from the weights of per-codebook `modules`."""
+        self.weight = nn.Parameter(
+            torch.cat([module.weight.detach() for module in modules]),
+            requires_grad=modules[0].weight.requires_grad,
+        )
+
+    @staticmethod
+    def _split_state_dict(module, state_dict, prefix, local_metadata):
+        weight = state_dict.pop(prefix + "weight")
+        # clone so that the per-codebook weights don't share memory when serialized
+        for codebook, codebook_weight in enumerate(weight.split(module.rows_per_codebook)):
+            state_dict[f"{prefix}{codebook}.weight"] = codebook_weight.clone()
+        return state_dict
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        codebook_keys = [f"{prefix}{codebook}.weight" for codebook in range(self.num_codebooks)]
+        if all(key in state_dict for key in codebook_keys):
+            state_dict[prefix + "weight"] = torch.cat([state_dict.pop(key) for key in codebook_keys])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+class ParlerTTSMultiCodebookHead(_ParlerTTSPackedCodebookWeight):
+    """
+    The language modelling heads of all the codebooks, fused into a single `(num_codebooks * vocab_size, hidden_size)`
+    projection so that the logits of every codebook are computed with one matmul.
+
+    Its state dict uses the layout of a `nn.ModuleList` of per-codebook `nn.Linear` heads, i.e. `{k}.weight` keys, so
+    that it can load and save the same checkpoints.
+    """
+
+    def __init__(self, hidden_size: int, vocab_size: int, num_codebooks: int):
+        super().__init__(vocab_size, hidden_size, num_codebooks)
+        self.vocab_size = vocab_size
+
+    @classmethod
+    def from_heads(cls, lm_heads: nn.ModuleList) -> "ParlerTTSMultiCodebookHead":
+        vocab_size, hidden_size = lm_heads[0].weight.shape
+        fused_head = cls(hidden_size, vocab_size, len(lm_heads))
+        fused_head._pack(lm_heads)
+        return fused_head
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        # (bsz, seq_len, hidden_size) -> (bsz, seq_len, num_codebooks * vocab_size)
+        logits = F.linear(hidden_states, self.weight)
+        # (bsz, seq_len, num_codebooks * vocab_size) -> (bsz, num_codebooks, seq_len, vocab_size), as a view
+        return logits.view(*logits.shape[:-1], self.num_codebooks, self.vocab_size).transpose(1, 2)
+
+
+class ParlerTTSMultiCodebookEmbedding(_ParlerTTSPackedCodebookWeight):
+    """
+    The input embeddings of all the codebooks, packed into a single `(num_codebooks * num_embeddings, hidden_size)`
+    table, so that the embeddings of the codes of every codebook are gathered and summed with one `embedding_bag`.
+
+    Its state dict uses the layout of a `nn.ModuleList` of per-codebook `nn.Embedding`, i.e. `{k}.weight` keys, so
+    that it can load and save the same checkpoints.
+    """
+
+    def __init__(self, num_embeddings: int, hidden_size: int, num_codebooks: int):
+        super().__init__(num_embeddings, hidden_size, num_codebooks)
+        self.num_embeddings = num_embeddings
+        # offset of the rows of each codebook in the packed table
+        self.register_buffer("offsets", torch.arange(num_codebooks) * num_embeddings, persistent=False)
+
+    @classmethod
+    def from_embeddings(cls, embed_tokens: nn.ModuleList) -> "ParlerTTSMultiCodebookEmbedding":
+        num_embeddings, hidden_size = embed_tokens[0].weight.shape
+        fused_embedding = cls(num_embeddings, hidden_size, len(embed_tokens)).to(embed_tokens[0].weight.device)
+        fused_embedding._pack(embed_tokens)
+        return fused_embedding
+
+    def forward(self, input_ids: torch.LongTensor) -> torch.Tensor:
+        # (bsz, num_codebooks, seq_len) -> (bsz * seq_len, num_codebooks) rows of the packed table
+        bsz, num_codebooks, seq_len = input_ids.shape
+        rows = (input_ids.transpose(1, 2) + self.offsets).reshape(-1, num_codebooks)
+        # (bsz * seq_len, hidden_size) -> (bsz, seq_len, hidden_size)
+        return F.embedding_bag(rows, self.weight, mode="sum").view(bsz, seq_len, -1)
+
+
 # Copied from transformers.models.musicgen.modeling_musicgen.MusicgenPreTrainedModel with Musicgen->ParlerTTS
 class ParlerTTSPreTrainedModel(PreTrainedModel):
     """
@@ -978,9 +1143,9 @@ class ParlerTTSPreTrainedModel(PreTrainedModel):
 
     def _init_weights(self, module):
         std = self.config.initializer_factor
-        if isinstance(module, (nn.Linear, nn.Conv1d)):
+        if isinstance(module, (nn.Linear, nn.Conv1d, _ParlerTTSPackedCodebookWeight)):
             module.weight.data.normal_(mean=0.0, std=std)
-            if module.bias is not None:
+            if getattr(module, "bias", None) is not None:
                 module.bias.data.zero_()
         elif isinstance(module, nn.Embedding):
             module.weight.data.normal_(mean=0.0, std=std)
@@ -1131,6 +1296,10 @@ MUSICGEN_INPUTS_DOCSTRING = r"""
         cache_position (`torch.LongTensor` of shape `(sequence_length)`, *optional*):
             Indices depicting the position of the input sequence tokens in the sequence. It is used to update the cache
             in the correct position and to infer the complete sequence length.
+        num_logits_to_keep (`int`, *optional*, defaults to 0):
+            If non-zero, only computes the logits of the last `num_logits_to_keep` positions, e.g. `1` during
+            generation where only the logits of the last position are needed. `0` computes the logits of every
+            position.
 """
 
 MUSICGEN_DECODER_INPUTS_DOCSTRING = r"""
@@ -1218,6 +1387,14 @@ MUSICGEN_DECODER_INPUTS_DOCSTRING = r"""
             more detail.
         return_dict (`bool`, *optional*):
             Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+        num_logits_to_keep (`int`, *optional*, defaults to 0):
+            If non-zero, only computes the logits of the last `num_logits_to_keep` positions, e.g. `1` during
+            generation where only the logits of the last position are needed. `0` computes the logits of every
+            position.
+        sinusoidal_position_ids (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Positions of each row in the sinusoidal position embeddings, e.g. for rows at different decoding steps.
+            Defaults to the positions following the past key values. Unused with rotary embeddings, which take
+            `position_ids` instead.
 """
 
 
@@ -1274,6 +1451,12 @@ class ParlerTTSDecoder(ParlerTTSPreTrainedModel):
     def set_input_embeddings(self, value):
         self.embed_tokens = value
 
+    def embed_codebooks(self, input: torch.LongTensor) -> torch.Tensor:
+        """Sums the embeddings of the codes of each codebook, from `(bsz, num_codebooks, seq_len)` ids."""
+        if isinstance(self.embed_tokens, ParlerTTSMultiCodebookEmbedding):
+            return self.embed_tokens(input)
+        return sum([self.embed_tokens[codebook](input[:, codebook]) for codebook in range(input.shape[1])])
+
     @add_start_docstrings_to_model_forward(MUSICGEN_DECODER_INPUTS_DOCSTRING)
     def forward(
         self,
@@ -1293,6 +1476,7 @@ class ParlerTTSDecoder(ParlerTTSPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         cache_position=None,
+        sinusoidal_position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPastAndCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1316,7 +1500,7 @@ class ParlerTTSDecoder(ParlerTTSPreTrainedModel):
             raise ValueError("You have to specify either decoder_input_ids or decoder_inputs_embeds")
 
         if inputs_embeds is None:
-            inputs_embeds = sum([self.embed_tokens[codebook](input[:, codebook]) for codebook in range(num_codebooks)])
+            inputs_embeds = self.embed_codebooks(input)
 
         prepended_sequence_length = 0
         # if prompt_hidden_states, fuse to inputs_embeds and update input shape
@@ -1393,7 +1577,9 @@ class ParlerTTSDecoder(ParlerTTSPreTrainedModel):
             # embed positions
             # TODO: As it is, the masked ids from the prompt will still count in the positions embeddings
             # maybe should modify position embeddings
-            positions = self.embed_positions(inputs_embeds, past_key_values_length)
+            positions = self.embed_positions(
+                inputs_embeds, past_key_values_length, position_ids=sinusoidal_position_ids
+            )
             hidden_states = inputs_embeds + positions.to(inputs_embeds.device)
         else:
             hidden_states = inputs_embeds
@@ -1429,7 +1615,12 @@ class ParlerTTSDecoder(ParlerTTSPreTrainedModel):
             output_attentions,
         )
 
-        if encoder_hidden_states is not None and encoder_attention_mask is not None:
+        # a 4D `encoder_attention_mask` is expected to be already expanded and inverted, e.g. by the static decoding step
+        if (
+            encoder_hidden_states is not None
+            and encoder_attention_mask is not None
+            and encoder_attention_mask.dim() == 2
+        ):
             if self.encoder_attn_implementation == "flash_attention_2":
                 encoder_attention_mask = encoder_attention_mask if 0 in encoder_attention_mask else None
             elif self.encoder_attn_implementation == "sdpa" and cross_attn_head_mask is None and not output_attentions:
@@ -1589,7 +1780,7 @@ class ParlerTTSDecoder(ParlerTTSPreTrainedModel):
 
         if attention_mask is not None and attention_mask.dim() == 4:
             # in this case we assume that the mask comes already in inverted form and requires no inversion or slicing
-            if attention_mask.max() != 0:
+            if not is_torchdynamo_compiling() and attention_mask.max() != 0:
                 raise ValueError("Custom 4D attention mask should be passed in inverted form with max==0`")
             causal_mask = attention_mask
         else:
@@ -1662,6 +1853,7 @@ class ParlerTTSModel(ParlerTTSPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
+        sinusoidal_position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, BaseModelOutputWithPastAndCrossAttentions]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1688,6 +1880,7 @@ class ParlerTTSModel(ParlerTTSPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             cache_position=cache_position,
+            sinusoidal_position_ids=sinusoidal_position_ids,
         )
 
         if not return_dict:
@@ -1732,6 +1925,30 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
     def set_output_embeddings(self, new_embeddings):
         self.lm_heads = new_embeddings
 
+    def fuse_lm_heads(self):
+        """
+        Replaces the per-codebook language modelling heads by a [`ParlerTTSMultiCodebookHead`] holding their weights in
+        a single matrix, so that the logits of all the codebooks are computed with a single matmul. The model keeps
+        saving and loading checkpoints with per-codebook `lm_heads.{k}.weight` weights.
+
+        Call it once the weights are loaded: loading with `device_map` or `low_cpu_mem_usage=True` sets the weights by
+        name, and expects the per-codebook heads.
+        """
+        if not isinstance(self.lm_heads, ParlerTTSMultiCodebookHead):
+            self.lm_heads = ParlerTTSMultiCodebookHead.from_heads(self.lm_heads)
+
+    def fuse_embed_tokens(self):
+        """
+        Replaces the per-codebook input embeddings by a [`ParlerTTSMultiCodebookEmbedding`] holding their weights in a
+        single table, so that the embeddings of all the codebooks are gathered and summed with a single op. The model
+        keeps saving and loading checkpoints with per-codebook `embed_tokens.{k}.weight` weights.
+
+        As for [`~ParlerTTSForCausalLM.fuse_lm_heads`], call it once the weights are loaded.
+        """
+        decoder = self.model.decoder
+        if not isinstance(decoder.embed_tokens, ParlerTTSMultiCodebookEmbedding):
+            decoder.embed_tokens = ParlerTTSMultiCodebookEmbedding.from_embeddings(decoder.embed_tokens)
+
     def set_decoder(self, decoder):
         self.model.decoder = decoder
 
@@ -1759,6 +1976,8 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
+        num_logits_to_keep: int = 0,
+        sinusoidal_position_ids: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, CausalLMOutputWithCrossAttentions]:
         r"""
         labels (`torch.LongTensor` of shape `(batch_size, sequence_length, num_codebooks)`, *optional*):
@@ -1787,39 +2006,55 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
             cache_position=cache_position,
+            sinusoidal_position_ids=sinusoidal_position_ids,
         )
 
         hidden_states = outputs[0]
-
-        lm_logits = torch.stack([head(hidden_states) for head in self.lm_heads], dim=1)
+        if num_logits_to_keep > 0:
+            # e.g. when generating, only the last position is sampled from
+            hidden_states = hidden_states[:, -num_logits_to_keep:]
+
+        loss_chunk_size = getattr(self.config, "loss_chunk_size", None)
+        if labels is not None and loss_chunk_size is not None:
+            # the logits are only computed chunk by chunk, within the loss
+            lm_logits = None
+        else:
+            lm_logits = self._compute_lm_logits(hidden_states)
 
         loss = None
         if labels is not None:
-            # since encoder hidden states have concatenated to hidden states, take the last hidden states corresponding to labels
-            logits = lm_logits[:, :, -labels.shape[1] :]
-
-            loss_fct = CrossEntropyLoss()
-            loss = torch.zeros([], device=self.device)
-
-            # (bsz, vocab_size, seq_len, num_codebooks), (bsz, seq_len, num_codebooks)
+            # (bsz, seq_len, num_codebooks)
             labels = labels.masked_fill(labels == self.config.bos_token_id, -100)
 
             # we use every codebooks token AND one single EOS at the end of each codebooks
             mask = (input_ids.transpose(1, 2) != self.config.eos_token_id) & ((labels != -100))
+            labels = labels.masked_fill(~mask, -100)
 
-            # per codebook cross-entropy
-            for codebook in range(self.config.num_codebooks):
-                codebook_logits = logits[:, codebook].contiguous().view(-1, logits.shape[-1])
-                codebook_mask = mask[..., codebook].contiguous().view(-1)
-                codebook_labels = labels[..., codebook].contiguous().view(-1)
-
-                codebook_loss = loss_fct(codebook_logits[codebook_mask], codebook_labels[codebook_mask])
-                loss += codebook_loss
+            # since encoder hidden states have concatenated to hidden states, take the last hidden states corresponding to labels
+            if lm_logits is None:
+                hidden_states = hidden_states[:, -labels.shape[1] :]
+                codebook_losses = hidden_states.new_zeros(self.config.num_codebooks, dtype=torch.float32)
+                for start in range(0, labels.shape[1], loss_chunk_size):
+                    chunk_hidden_states = hidden_states[:, start : start + loss_chunk_size]
+                    chunk_labels = labels[:, start : start + loss_chunk_size]
+                    if torch.is_grad_enabled():
+                        # don't keep the logits of the chunk for the backward pass, recompute them instead
+                        codebook_losses += checkpoint(
+                            self._codebook_cross_entropy, chunk_hidden_states, chunk_labels, use_reentrant=False
+                        )
+                    else:
+                        codebook_losses += self._codebook_cross_entropy(chunk_hidden_states, chunk_labels)
+            else:
+                codebook_losses = self._codebook_cross_entropy(
+                    None, labels, logits=lm_logits[:, :, -labels.shape[1] :]
+                )
 
-            loss = loss / self.config.num_codebooks
+            # mean over the tokens of each codebook, then over the codebooks
+            loss = (codebook_losses / mask.sum(dim=(0, 1))).mean()
 
-        # (bsz, num_codebooks, seq_len, vocab_size) -> (bsz * num_codebooks, seq_len, vocab_size)
-        lm_logits = lm_logits.reshape(-1, *lm_logits.shape[2:])
+        if lm_logits is not None:
+            # (bsz, num_codebooks, seq_len, vocab_size) -> (bsz * num_codebooks, seq_len, vocab_size)
+            lm_logits = lm_logits.reshape(-1, *lm_logits.shape[2:])
 
         if not return_dict:
             output = (lm_logits,) + outputs[1:]
@@ -1834,6 +2069,27 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
             cross_attentions=outputs.cross_attentions,
         )
 
+    def _compute_lm_logits(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        # (bsz, seq_len, hidden_size) -> (bsz, num_codebooks, seq_len, vocab_size)
+        if isinstance(self.lm_heads, ParlerTTSMultiCodebookHead):
+            return self.lm_heads(hidden_states)
+        return torch.stack([head(hidden_states) for head in self.lm_heads], dim=1)
+
+    def _codebook_cross_entropy(
+        self, hidden_states: torch.Tensor, labels: torch.LongTensor, logits: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
+        """
+        Returns the sum of the cross-entropy of the `labels` of shape `(bsz, seq_len, num_codebooks)` for each
+        codebook, ignoring labels set to -100. The logits are computed from `hidden_states` unless they are passed.
+        """
+        if logits is None:
+            logits = self._compute_lm_logits(hidden_states)
+        # (bsz, num_codebooks, seq_len, vocab_size) -> (bsz * num_codebooks * seq_len, vocab_size)
+        losses = F.cross_entropy(
+            logits.reshape(-1, logits.shape[-1]), labels.transpose(1, 2).reshape(-1), reduction="none"
+        )
+        return losses.view(*logits.shape[:2], -1).sum(dim=(0, 2))
+
     def prepare_inputs_for_generation(
         self,
         input_ids,
@@ -1849,6 +2105,7 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
         delay_pattern_mask=None,
         cache_position=None,
         inputs_embeds=None,
+        num_logits_to_keep=0,
         **kwargs,
     ):
         if delay_pattern_mask is None:
@@ -1896,6 +2153,7 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
             "use_cache": use_cache,
             "cache_position": cache_position,
             "inputs_embeds": inputs_embeds,
+            "num_logits_to_keep": num_logits_to_keep,
         }
 
     # Ignore copy
@@ -2040,6 +2298,9 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
 
         # 4. Define other model kwargs
         model_kwargs["use_cache"] = generation_config.use_cache
+        if "num_logits_to_keep" not in model_kwargs:
+            # only the logits of the last position are sampled from
+            model_kwargs["num_logits_to_keep"] = 1
 
         requires_attention_mask = "encoder_outputs" not in model_kwargs
         if model_kwargs.get("attention_mask", None) is None and requires_attention_mask:
@@ -2174,17 +2435,11 @@ class ParlerTTSForCausalLM(ParlerTTSPreTrainedModel):
         # apply the pattern mask to the final ids
         output_ids = self.apply_delay_pattern_mask(output_ids, model_kwargs["delay_pattern_mask"])
 
-        # revert the pattern delay mask by filtering the eos and bos token ids from the delay pattern mask
-        _, mask = self.build_delay_pattern_mask(
-            input_ids,
-            bos_token_id=generation_config.bos_token_id,
-            pad_token_id=generation_config.pad_token_id,
-            max_length=output_ids.shape[1],
+        # revert the pattern delay mask by removing the bos and eos padding of each codebook
+        output_ids = revert_delay_pattern_mask(output_ids, self.num_codebooks).reshape(
+            batch_size, self.num_codebooks, -1
         )
 
-        mask = (mask != generation_config.bos_token_id) & (mask != generation_config.pad_token_id)
-        output_ids = output_ids[mask].reshape(batch_size, self.num_codebooks, -1)
-
         if generation_config.return_dict_in_generate:
             outputs.sequences = output_ids
             return outputs
@@ -2304,6 +2559,16 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 "following discussion on GitHub: https://github.com/huggingface/transformers/issues/23350"
             )
 
+        # opt-in cache of the text encoder outputs, see `enable_text_encoder_cache`
+        self.text_encoder_cache = None
+        # opt-in cache of the self-attention states of the prompts, see `enable_prompt_prefix_cache`
+        self.prompt_prefix_cache = None
+
+        # compiled decoding step and the batch sizes it is compiled for, see `compile_for_generation`
+        self._compiled_decode_step = None
+        self._generation_batch_buckets = None
+        self._bucket_caches = {}
+
         # Initialize projection and embedding layers and tie text encoder and decoder weights if set accordingly
         self.post_init()
 
@@ -2597,6 +2862,7 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         cache_position: Optional[torch.LongTensor] = None,
+        num_logits_to_keep: int = 0,
         **kwargs,
     ) -> Union[Tuple, Seq2SeqLMOutput]:
         r"""
@@ -2741,6 +3007,7 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             return_dict=return_dict,
             labels=labels,
             cache_position=cache_position,
+            num_logits_to_keep=num_logits_to_keep,
             **kwargs_decoder,
         )
 
@@ -2775,6 +3042,7 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         decoder_delay_pattern_mask=None,
         cache_position=None,
         inputs_embeds=None,
+        num_logits_to_keep=0,
         **kwargs,
     ):
         if decoder_delay_pattern_mask is None:
@@ -2785,14 +3053,15 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 max_length=self.generation_config.max_length,
             )
 
-        # apply the delay pattern mask
-        decoder_input_ids = self.decoder.apply_delay_pattern_mask(decoder_input_ids, decoder_delay_pattern_mask)
-
         past_length = 0
         if past_key_values is not None:
             if isinstance(past_key_values, EncoderDecoderCache):
-                past_length = cache_position[0] if cache_position is not None else past_key_values.get_seq_length()
-                if past_key_values.get_seq_length() > 0:
+                past_length = (
+                    cache_position[0]
+                    if cache_position is not None
+                    else past_key_values.self_attention_cache.get_seq_length()
+                )
+                if past_key_values.self_attention_cache.get_seq_length() > 0:
                     # we only want to use prompt signal in the 1st generation step
                     prompt_hidden_states = None
             else:
@@ -2808,6 +3077,10 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 remove_prefix_length = decoder_input_ids.shape[1] - 1
 
             decoder_input_ids = decoder_input_ids[:, remove_prefix_length:]
+            decoder_delay_pattern_mask = decoder_delay_pattern_mask[:, remove_prefix_length:]
+
+        # apply the delay pattern mask, only to the ids that are fed to the model
+        decoder_input_ids = self.decoder.apply_delay_pattern_mask(decoder_input_ids, decoder_delay_pattern_mask)
 
         if cache_position is None:
             cache_position = torch.arange(
@@ -2836,7 +3109,8 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 "`prompt_attention_mask` is specified but `attention_mask` is not. A full `attention_mask` will be created. Make sure this is the intended behaviour."
             )
             if past_key_values is None or (
-                isinstance(past_key_values, EncoderDecoderCache) and past_key_values.get_seq_length() == 0
+                isinstance(past_key_values, EncoderDecoderCache)
+                and past_key_values.self_attention_cache.get_seq_length() == 0
             ):
                 decoder_attention_mask = torch.ones(input_shape, device=self.device, dtype=decoder_input_ids.dtype)
             elif prompt_attention_mask is not None:
@@ -2863,8 +3137,264 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             "use_cache": use_cache,
             "cache_position": cache_position,
             "inputs_embeds": inputs_embeds,
+            "num_logits_to_keep": num_logits_to_keep,
         }
 
+    def _sample(
+        self,
+        input_ids: torch.LongTensor,
+        logits_processor: LogitsProcessorList,
+        stopping_criteria: StoppingCriteriaList,
+        generation_config: GenerationConfig,
+        synced_gpus: bool,
+        streamer: Optional["BaseStreamer"],
+        logits_warper: Optional[LogitsProcessorList] = None,
+        num_padding_sequences: int = 0,
+        compaction_interval: Optional[int] = None,
+        **model_kwargs,
+    ) -> Union[GenerateNonBeamOutput, torch.LongTensor]:
+        """
+        Same as [`~generation.GenerationMixin._sample`], except that the generated ids are written in a buffer
+        preallocated to `generation_config.max_length` instead of being concatenated to the previous ids at every step,
+        and that `logits_warper` is optional for greedy decoding.
+
+        The last `num_padding_sequences` rows only pad the batch to a size the decoding step is compiled for: they are
+        finished from the start, and are neither streamed nor returned. Once the prompt is prefilled, the steps run
+        through the compiled decoding step if [`~ParlerTTSForConditionalGeneration.compile_for_generation`] was
+        called and the cache is static.
+
+        If `compaction_interval` is set, every `compaction_interval` steps, the samples whose codebooks are all
+        finished are dropped from the batch, along with their cache and model kwargs. Their ids are padded and put
+        back in place at the end.
+        """
+        # init values
+        pad_token_id = generation_config._pad_token_tensor
+        output_attentions = generation_config.output_attentions
+        output_hidden_states = generation_config.output_hidden_states
+        output_scores = generation_config.output_scores
+        output_logits = generation_config.output_logits
+        return_dict_in_generate = generation_config.return_dict_in_generate
+        has_eos_stopping_criteria = any(hasattr(criteria, "eos_token_id") for criteria in stopping_criteria)
+        do_sample = generation_config.do_sample
+        if do_sample is True and not isinstance(logits_warper, LogitsProcessorList):
+            raise ValueError(
+                "`do_sample` is set to `True`, `logits_warper` must be a `LogitsProcessorList` instance (it is "
+                f"{logits_warper})."
+            )
+
+        # init attention / hidden states / scores tuples
+        scores = () if (return_dict_in_generate and output_scores) else None
+        raw_logits = () if (return_dict_in_generate and output_logits) else None
+        decoder_attentions = () if (return_dict_in_generate and output_attentions) else None
+        cross_attentions = () if (return_dict_in_generate and output_attentions) else None
+        decoder_hidden_states = () if (return_dict_in_generate and output_hidden_states) else None
+
+        # retrieve encoder attention weights and hidden states
+        if return_dict_in_generate:
+            encoder_attentions = model_kwargs["encoder_outputs"].get("attentions") if output_attentions else None
+            encoder_hidden_states = (
+                model_kwargs["encoder_outputs"].get("hidden_states") if output_hidden_states else None
+            )
+
+        # keep track of which sequences are already finished
+        batch_size, cur_len = input_ids.shape
+        this_peer_finished = False
+        unfinished_sequences = torch.ones(batch_size, dtype=torch.long, device=input_ids.device)
+        num_sequences = batch_size - num_padding_sequences
+        unfinished_sequences[num_sequences:] = 0
+        model_kwargs = self._get_initial_cache_position(input_ids, model_kwargs)
+
+        past_key_values = model_kwargs.get("past_key_values")
+        uses_static_decode_step = (
+            self._compiled_decode_step is not None
+            and isinstance(past_key_values, EncoderDecoderCache)
+            and isinstance(past_key_values.self_attention_cache, StaticCache)
+            and model_kwargs.get("encoder_outputs") is not None
+            and model_kwargs.get("decoder_attention_mask") is None
+            and not output_attentions
+            and not output_hidden_states
+        )
+        static_decode_inputs = None
+
+        # dropping the finished samples needs a cache whose batch can shrink, and no per-step outputs of the full batch
+        num_codebooks = self.decoder.num_codebooks
+        compacts_batch = (
+            compaction_interval is not None
+            and isinstance(past_key_values, EncoderDecoderCache)
+            and type(past_key_values.self_attention_cache) is DynamicCache
+            and not synced_gpus
+            and not (return_dict_in_generate and (output_scores or output_logits))
+            and not output_attentions
+            and not output_hidden_states
+        )
+        # rows of the full batch that are still decoded, and the ids of the rows that were dropped
+        active_rows = torch.arange(batch_size, device=input_ids.device)
+        dropped_rows, dropped_ids = [], []
+        num_steps = 0
+
+        # generated ids are written in place, `input_ids` is a view of the ids generated so far
+        sequences = input_ids.new_empty((batch_size, max(generation_config.max_length, cur_len)))
+        sequences[:, :cur_len] = input_ids
+        input_ids = sequences[:, :cur_len]
+
+        while self._has_unfinished_sequences(this_peer_finished, synced_gpus, device=input_ids.device):
+            if static_decode_inputs is not None:
+                # fixed-shape step: the last ids, with the delay pattern applied, and the position of their keys
+                decoder_input_ids = self.decoder.apply_delay_pattern_mask(
+                    input_ids[:, -1:], model_kwargs["decoder_delay_pattern_mask"][:, cur_len - 1 : cur_len]
+                )
+                logits = self._compiled_decode_step(
+                    decoder_input_ids, model_kwargs["cache_position"], **static_decode_inputs
+                )
+                next_token_logits = logits[:, -1, :].clone()
+                outputs = None
+            else:
+                # prepare model inputs
+                model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+
+                # prepare variable output controls (note: some models won't accept all output controls)
+                model_inputs.update({"output_attentions": output_attentions} if output_attentions else {})
+                model_inputs.update({"output_hidden_states": output_hidden_states} if output_hidden_states else {})
+
+                # forward pass to get next token
+                outputs = self(**model_inputs, return_dict=True)
+
+                if synced_gpus and this_peer_finished:
+                    continue  # don't waste resources running the code we don't need
+
+                # Clone is needed to avoid keeping a hanging ref to outputs.logits which may be very large for first
+                # iteration (the clone itself is always small)
+                next_token_logits = outputs.logits[:, -1, :].clone()
+
+            # pre-process distribution
+            next_token_scores = logits_processor(input_ids, next_token_logits)
+            if do_sample:
+                next_token_scores = logits_warper(input_ids, next_token_scores)
+
+            # Store scores, attentions and hidden_states when required
+            if return_dict_in_generate:
+                if output_scores:
+                    scores += (next_token_scores[:num_sequences],)
+                if output_logits:
+                    raw_logits += (next_token_logits[:num_sequences],)
+                if output_attentions:
+                    decoder_attentions += (outputs.decoder_attentions,)
+                    cross_attentions += (outputs.cross_attentions,)
+                if output_hidden_states:
+                    decoder_hidden_states += (outputs.decoder_hidden_states,)
+
+            # token selection
+            if do_sample:
+                probs = nn.functional.softmax(next_token_scores, dim=-1)
+                next_tokens = torch.multinomial(probs, num_samples=1).squeeze(1)
+            else:
+                next_tokens = torch.argmax(next_token_scores, dim=-1)
+
+            # finished sentences should have their next token be a padding token
+            if has_eos_stopping_criteria:
+                next_tokens = next_tokens * unfinished_sequences + pad_token_id * (1 - unfinished_sequences)
+
+            # update generated ids, model inputs, and length for next step
+            if cur_len == sequences.shape[1]:
+                # can only happen when stopping criteria other than the max length keep the loop running
+                sequences = torch.cat([sequences, sequences.new_empty(sequences.shape)], dim=-1)
+            sequences[:, cur_len] = next_tokens
+            cur_len += 1
+            input_ids = sequences[:, :cur_len]
+            if streamer is not None:
+                streamed_tokens = next_tokens
+                if next_tokens.shape[0] < batch_size:
+                    # the streamer sees the full batch, the dropped rows are padding
+                    streamed_tokens = next_tokens.new_empty(batch_size).fill_(pad_token_id)
+                    streamed_tokens[active_rows] = next_tokens
+                streamer.put(streamed_tokens[:num_sequences].cpu())
+            if outputs is None:
+                model_kwargs["cache_position"] = model_kwargs["cache_position"][-1:] + 1
+            else:
+                model_kwargs = self._update_model_kwargs_for_generation(
+                    outputs,
+                    model_kwargs,
+                    is_encoder_decoder=self.config.is_encoder_decoder,
+                )
+                if uses_static_decode_step:
+                    # the prompt is prefilled, the next steps have fixed shapes
+                    static_decode_inputs = self._prepare_static_decode_inputs(model_kwargs)
+
+            unfinished_sequences = unfinished_sequences & ~stopping_criteria(input_ids, scores)
+            this_peer_finished = unfinished_sequences.max() == 0
+
+            # This is needed to properly delete outputs.logits which may be very large for first iteration
+            # Otherwise a reference to outputs is kept which keeps the logits alive in the next iteration
+            del outputs
+
+            num_steps += 1
+            if compacts_batch and not this_peer_finished and num_steps % compaction_interval == 0:
+                finished_samples = ~unfinished_sequences.view(-1, num_codebooks).bool().any(dim=-1)
+                if finished_samples.any():
+                    kept_samples = (~finished_samples).nonzero().flatten()
+                    codebooks = torch.arange(num_codebooks, device=input_ids.device)
+                    kept_rows = (kept_samples[:, None] * num_codebooks + codebooks).flatten()
+                    finished_rows = finished_samples.repeat_interleave(num_codebooks)
+                    dropped_rows.append(active_rows[finished_rows])
+                    dropped_ids.append(input_ids[finished_rows])
+
+                    active_rows = active_rows[kept_rows]
+                    unfinished_sequences = unfinished_sequences[kept_rows]
+                    sequences = sequences[kept_rows]
+                    input_ids = sequences[:, :cur_len]
+                    model_kwargs = self._select_samples_for_generation(model_kwargs, kept_samples)
+
+        if streamer is not None:
+            streamer.end()
+
+        if dropped_rows:
+            # put the rows that were dropped back in place, padded up to the final length
+            all_ids = input_ids.new_empty((batch_size, cur_len)).fill_(pad_token_id)
+            all_ids[active_rows] = input_ids
+            for rows, ids in zip(dropped_rows, dropped_ids):
+                all_ids[rows, : ids.shape[1]] = ids
+            input_ids = all_ids
+        input_ids = input_ids[:num_sequences]
+        if return_dict_in_generate:
+            return GenerateEncoderDecoderOutput(
+                sequences=input_ids,
+                scores=scores,
+                logits=raw_logits,
+                encoder_attentions=encoder_attentions,
+                encoder_hidden_states=encoder_hidden_states,
+                decoder_attentions=decoder_attentions,
+                cross_attentions=cross_attentions,
+                decoder_hidden_states=decoder_hidden_states,
+                past_key_values=model_kwargs.get("past_key_values"),
+            )
+        else:
+            return input_ids
+
+    def _select_samples_for_generation(self, model_kwargs, samples: torch.LongTensor):
+        """Only keeps the `samples` of the batch in the cache and the per-sample model kwargs used by `_sample`."""
+        for key in [
+            "attention_mask",
+            "decoder_attention_mask",
+            "prompt_hidden_states",
+            "prompt_attention_mask",
+            "inputs_embeds",
+        ]:
+            if isinstance(model_kwargs.get(key), torch.Tensor):
+                model_kwargs[key] = model_kwargs[key][samples]
+
+        if model_kwargs.get("encoder_outputs") is not None:
+            encoder_hidden_states = model_kwargs["encoder_outputs"].last_hidden_state
+            model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_hidden_states[samples])
+
+        # the delay pattern mask has one row per codebook of each sample
+        num_codebooks = self.decoder.num_codebooks
+        delay_pattern_mask = model_kwargs["decoder_delay_pattern_mask"]
+        delay_pattern_mask = delay_pattern_mask.reshape(-1, num_codebooks, delay_pattern_mask.shape[-1])[samples]
+        model_kwargs["decoder_delay_pattern_mask"] = delay_pattern_mask.flatten(0, 1)
+
+        model_kwargs["past_key_values"].batch_select_indices(samples)
+        return model_kwargs
+
     def _prepare_decoder_input_ids_for_generation(
         self,
         batch_size: int,
@@ -2914,12 +3444,7 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             prompt_hidden_states = model_kwargs["prompt_hidden_states"]
             num_codebooks = self.decoder.num_codebooks
             input = decoder_input_ids.reshape(-1, num_codebooks, decoder_input_ids.shape[-1])
-            inputs_embeds = sum(
-                [
-                    self.decoder.model.decoder.embed_tokens[codebook](input[:, codebook])
-                    for codebook in range(num_codebooks)
-                ]
-            )
+            inputs_embeds = self.decoder.model.decoder.embed_codebooks(input)
             inputs_embeds = torch.cat([prompt_hidden_states, inputs_embeds], dim=1)
             model_kwargs["inputs_embeds"] = inputs_embeds
 
@@ -2959,6 +3484,30 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         model_input_name = model_input_name if model_input_name is not None else self.text_encoder.main_input_name
         encoder_kwargs["return_dict"] = True
         encoder_kwargs[model_input_name] = inputs_tensor
+
+        # 4. optionally look up the outputs of the descriptions that were already encoded
+        uses_text_encoder_cache = (
+            self.text_encoder_cache is not None
+            and model_input_name == "input_ids"
+            and not generation_config.output_attentions
+            and not generation_config.output_hidden_states
+            and all(
+                value is None
+                for argument, value in encoder_kwargs.items()
+                if argument
+                not in ["input_ids", "attention_mask", "output_attentions", "output_hidden_states", "return_dict"]
+            )
+        )
+        if uses_text_encoder_cache:
+            encoder_hidden_states = self._encode_text_with_cache(encoder, encoder_kwargs)
+        else:
+            encoder_hidden_states = self._encode_text(encoder, encoder_kwargs)
+
+        model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+
+        return model_kwargs
+
+    def _encode_text(self, encoder, encoder_kwargs) -> torch.Tensor:
         last_hidden_state = encoder(**encoder_kwargs).last_hidden_state
 
         # we optionnally project last_hidden_state to avoid recomputing every time
@@ -2969,13 +3518,249 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         ):
             encoder_hidden_states = self.enc_to_dec_proj(encoder_hidden_states)
 
-        if model_kwargs["attention_mask"] is not None:
-            encoder_hidden_states = encoder_hidden_states * model_kwargs["attention_mask"][..., None]
+        if encoder_kwargs.get("attention_mask") is not None:
+            encoder_hidden_states = encoder_hidden_states * encoder_kwargs["attention_mask"][..., None]
 
-        model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+        return encoder_hidden_states
+
+    def _encode_text_with_cache(self, encoder, encoder_kwargs) -> torch.Tensor:
+        """
+        Same as `_encode_text`, but only runs the text encoder on the descriptions that are not in
+        `self.text_encoder_cache`, and caches their outputs.
+        """
+        input_ids = encoder_kwargs["input_ids"]
+        attention_mask = encoder_kwargs.get("attention_mask")
+        if attention_mask is not None:
+            token_mask = attention_mask.bool()
+        else:
+            token_mask = torch.ones_like(input_ids, dtype=torch.bool)
+
+        keys = [self.text_encoder_cache.get_key(row_ids, row_mask) for row_ids, row_mask in zip(input_ids, token_mask)]
+        cached_states = [self.text_encoder_cache.get(key) for key in keys]
+
+        # encode each missing description once, even if it appears several times in the batch
+        missing_rows = {}
+        for row_idx, (key, states) in enumerate(zip(keys, cached_states)):
+            if states is None:
+                missing_rows.setdefault(key, row_idx)
+        if missing_rows:
+            rows = torch.tensor(list(missing_rows.values()), device=input_ids.device)
+            missing_kwargs = {**encoder_kwargs, "input_ids": input_ids[rows]}
+            if attention_mask is not None:
+                missing_kwargs["attention_mask"] = attention_mask[rows]
+            missing_hidden_states = self._encode_text(encoder, missing_kwargs)
+
+            new_states = {}
+            for (key, row_idx), hidden_states in zip(missing_rows.items(), missing_hidden_states):
+                new_states[key] = hidden_states[token_mask[row_idx]]
+                self.text_encoder_cache.put(key, new_states[key])
+            cached_states = [new_states[key] if states is None else states for key, states in zip(keys, cached_states)]
+
+        encoder_hidden_states = cached_states[0].new_zeros((*input_ids.shape, cached_states[0].shape[-1]))
+        for row_idx, states in enumerate(cached_states):
+            encoder_hidden_states[row_idx, token_mask[row_idx]] = states.to(encoder_hidden_states.dtype)
+        return encoder_hidden_states
+
+    def enable_text_encoder_cache(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        """
+        Caches the projected text encoder outputs of the descriptions passed to `generate`, so that the text encoder
+        only runs on descriptions it has not seen yet. See [`TextEncoderOutputCache`] for the arguments.
+
+        Returns the cache, whose `hits` and `misses` counters can be inspected.
+        """
+        self.text_encoder_cache = TextEncoderOutputCache(max_entries=max_entries, max_bytes=max_bytes)
+        return self.text_encoder_cache
+
+    def disable_text_encoder_cache(self):
+        """Removes the cache set by [`~ParlerTTSForConditionalGeneration.enable_text_encoder_cache`]."""
+        self.text_encoder_cache = None
+
+    def enable_prompt_prefix_cache(self, max_entries: int = 256, max_bytes: Optional[int] = None):
+        """
+        Caches the self-attention key/value states of the prompts passed to `generate` with
+        `prompt_cross_attention=False`, so that a prompt starting with the same tokens as a previous prompt of the same
+        description only runs the decoder on its remaining tokens. See [`PromptPrefixCache`] for the arguments.
+
+        Only applies to descriptions passed as `input_ids`, with the default dynamic cache. Returns the cache, whose
+        `hits` and `misses` counters can be inspected.
+        """
+        if self.prompt_cross_attention:
+            raise ValueError(
+                "The prompt prefix cache needs `prompt_cross_attention=False`, the prompt is otherwise part of the "
+                "cross-attention states."
+            )
+        self.prompt_prefix_cache = PromptPrefixCache(max_entries=max_entries, max_bytes=max_bytes)
+        return self.prompt_prefix_cache
+
+    def disable_prompt_prefix_cache(self):
+        """Removes the cache set by [`~ParlerTTSForConditionalGeneration.enable_prompt_prefix_cache`]."""
+        self.prompt_prefix_cache = None
+
+    def _get_prompt_prefix_keys(self, inputs_tensor, model_input_name, model_kwargs) -> Optional[List[Tuple]]:
+        """Returns the key of each sample in `self.prompt_prefix_cache`, or `None` if the cache doesn't apply."""
+        if (
+            self.prompt_prefix_cache is None
+            or self.prompt_cross_attention
+            or model_input_name != "input_ids"
+            or "encoder_outputs" in model_kwargs
+            or model_kwargs.get("prompt_input_ids") is None
+            or model_kwargs.get("prompt_hidden_states") is not None
+        ):
+            return None
+
+        attention_mask = model_kwargs.get("attention_mask")
+        prompt_input_ids = model_kwargs["prompt_input_ids"]
+        prompt_attention_mask = model_kwargs.get("prompt_attention_mask")
+        return [
+            self.prompt_prefix_cache.get_key(
+                inputs_tensor[row_idx],
+                attention_mask[row_idx] if attention_mask is not None else None,
+                prompt_input_ids[row_idx],
+                prompt_attention_mask[row_idx] if prompt_attention_mask is not None else None,
+            )
+            for row_idx in range(inputs_tensor.shape[0])
+        ]
+
+    def _prefill_prompt_for_generation(
+        self,
+        model_kwargs,
+        prompt_prefix_keys: Optional[List[Tuple]] = None,
+        prefill_chunk_size: Optional[int] = None,
+    ):
+        """
+        With `prompt_cross_attention=False`, fills the self-attention cache with the states of the prompt before the
+        first decoding step, which then only runs on the decoder input ids.
+
+        The states of the longest prompt prefix that every sample shares with a prompt of `self.prompt_prefix_cache`
+        are loaded from it, the decoder runs on the rest of the prompt, `prefill_chunk_size` positions at a time if
+        specified, and the states of the prompts are cached.
+        """
+        prompt_hidden_states = model_kwargs.get("prompt_hidden_states")
+        past_key_values = model_kwargs.get("past_key_values")
+        if (
+            (prompt_prefix_keys is None and prefill_chunk_size is None)
+            or prompt_hidden_states is None
+            or not isinstance(past_key_values, EncoderDecoderCache)
+            or past_key_values.self_attention_cache.get_seq_length() > 0
+        ):
+            return model_kwargs
+
+        self_attention_cache = past_key_values.self_attention_cache
+        if type(self_attention_cache) is not DynamicCache:
+            # the cached prefixes are loaded in a dynamic cache
+            prompt_prefix_keys = None
+        prompt_length = prompt_hidden_states.shape[1]
+        num_layers = len(self.decoder.model.decoder.layers)
+
+        # 1. load the states of the prefix shared by every sample
+        prefix_length = 0
+        if prompt_prefix_keys is not None:
+            matches = [self.prompt_prefix_cache.match(key) for key in prompt_prefix_keys]
+            prefix_length = min(length for _, length in matches)
+        if prefix_length > 0:
+            for layer_idx in range(num_layers):
+                key_states = torch.stack([states[0][layer_idx][:, :prefix_length] for states, _ in matches])
+                value_states = torch.stack([states[1][layer_idx][:, :prefix_length] for states, _ in matches])
+                self_attention_cache.update(
+                    key_states.to(prompt_hidden_states.dtype), value_states.to(prompt_hidden_states.dtype), layer_idx
+                )
+
+        # 2. run the decoder on the rest of the prompt
+        encoder_outputs = model_kwargs.get("encoder_outputs")
+        chunk_size = prefill_chunk_size if prefill_chunk_size is not None else prompt_length
+        for chunk_start in range(prefix_length, prompt_length, chunk_size):
+            self._prefill_prompt_chunk(
+                prompt_hidden_states,
+                model_kwargs.get("prompt_attention_mask"),
+                encoder_outputs.last_hidden_state if encoder_outputs is not None else None,
+                model_kwargs.get("attention_mask"),
+                past_key_values,
+                chunk_start,
+                min(chunk_start + chunk_size, prompt_length),
+            )
+
+        # 3. cache the prompts that are not cached yet, once per key
+        if prompt_prefix_keys is not None:
+            new_rows = {}
+            for row_idx, (key, (_, length)) in enumerate(zip(prompt_prefix_keys, matches)):
+                if length < len(key[1]):
+                    new_rows.setdefault(key, row_idx)
+            for key, row_idx in new_rows.items():
+                num_prompt_tokens = len(key[1])
+                self.prompt_prefix_cache.put(
+                    key,
+                    [states[row_idx, :, :num_prompt_tokens].clone() for states in self_attention_cache.key_cache],
+                    [states[row_idx, :, :num_prompt_tokens].clone() for states in self_attention_cache.value_cache],
+                )
 
         return model_kwargs
 
+    def _prefill_prompt_chunk(
+        self,
+        prompt_hidden_states: torch.FloatTensor,
+        prompt_attention_mask: Optional[torch.LongTensor],
+        encoder_hidden_states: Optional[torch.FloatTensor],
+        encoder_attention_mask: Optional[torch.LongTensor],
+        past_key_values: EncoderDecoderCache,
+        start: int,
+        end: int,
+    ):
+        """
+        Runs the decoder on the prompt states of positions `start` to `end`, whose previous positions are already in
+        the self-attention cache, and adds their states to the cache.
+        """
+        self.decoder.model.decoder(
+            inputs_embeds=prompt_hidden_states[:, start:end],
+            attention_mask=prompt_attention_mask[:, :end] if prompt_attention_mask is not None else None,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            cache_position=torch.arange(start, end, device=prompt_hidden_states.device),
+        )
+
+    @torch.no_grad()
+    def build_voice_profile(
+        self, input_ids: torch.LongTensor, attention_mask: Optional[torch.LongTensor] = None
+    ) -> ParlerTTSVoiceProfile:
+        """
+        Computes the text encoder outputs and the cross-attention key/value states of a single description, so that
+        they can be saved and passed to `generate(voice_profile=...)` instead of the description.
+
+        Parameters:
+            input_ids (`torch.LongTensor` of shape `(sequence_length,)` or `(1, sequence_length)`):
+                The tokenized description.
+            attention_mask (`torch.LongTensor` of the same shape as `input_ids`, *optional*):
+                Mask of the padding tokens of the description, which are left out of the profile.
+
+        Returns:
+            [`ParlerTTSVoiceProfile`]
+        """
+        if input_ids.dim() == 1:
+            input_ids = input_ids[None]
+            attention_mask = attention_mask[None] if attention_mask is not None else None
+        if input_ids.shape[0] != 1:
+            raise ValueError(f"A voice profile is built from a single description, got {input_ids.shape[0]}.")
+
+        encoder_kwargs = {"input_ids": input_ids, "attention_mask": attention_mask, "return_dict": True}
+        encoder_hidden_states = self._encode_text(self.get_text_encoder(), encoder_kwargs)
+        if attention_mask is not None:
+            encoder_hidden_states = encoder_hidden_states[:, attention_mask[0].bool()]
+
+        key_states, value_states = [], []
+        for layer in self.decoder.model.decoder.layers:
+            cross_attention = layer.encoder_attn
+            key_states.append(
+                cross_attention._shape_key_value(cross_attention.k_proj(encoder_hidden_states), -1, 1)[0]
+            )
+            value_states.append(
+                cross_attention._shape_key_value(cross_attention.v_proj(encoder_hidden_states), -1, 1)[0]
+            )
+
+        return ParlerTTSVoiceProfile(
+            encoder_hidden_states=encoder_hidden_states[0], key_states=key_states, value_states=value_states
+        )
+
     def _prepare_prompt_kwargs_for_generation(self, prompt_input_ids, model_kwargs):
         prompt_hidden_states = self.embed_prompts(prompt_input_ids)
 
@@ -3013,6 +3798,52 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             # we're keeping the prompt attention mask because it has to be prepended to the decoder attention mask on the fly
         return model_kwargs
 
+    def _prepare_cross_attention_cache_for_generation(
+        self, model_kwargs, voice_profile: Optional[ParlerTTSVoiceProfile] = None
+    ):
+        """
+        Shares the cross-attention key/value states between the samples of the batch that have the same encoder
+        outputs, e.g. identical descriptions or `num_return_sequences > 1`, and fills the cross-attention cache with
+        the states of `voice_profile` if specified.
+        """
+        past_key_values = model_kwargs.get("past_key_values")
+        if not isinstance(past_key_values, EncoderDecoderCache) or model_kwargs.get("encoder_outputs") is None:
+            return model_kwargs
+
+        encoder_hidden_states = model_kwargs["encoder_outputs"].last_hidden_state
+        cross_attention_cache = past_key_values.cross_attention_cache
+        if type(cross_attention_cache) is DynamicCache and len(cross_attention_cache) == 0:
+            shared_cross_attention_cache = SharedCrossAttentionCache.from_encoder_outputs(
+                encoder_hidden_states, model_kwargs.get("attention_mask")
+            )
+            if shared_cross_attention_cache is not None:
+                past_key_values.cross_attention_cache = cross_attention_cache = shared_cross_attention_cache
+
+        if voice_profile is not None and not any(past_key_values.is_updated.values()):
+            if isinstance(cross_attention_cache, SharedCrossAttentionCache):
+                encoder_hidden_states = cross_attention_cache.select_unique(encoder_hidden_states)
+            bsz = encoder_hidden_states.shape[0]
+            # with `prompt_cross_attention=True`, the prompt states follow the description and still need projecting
+            prompt_hidden_states = encoder_hidden_states[:, voice_profile.num_tokens :]
+
+            for layer_idx, layer in enumerate(self.decoder.model.decoder.layers):
+                cross_attention = layer.encoder_attn
+                key_states = voice_profile.key_states[layer_idx][None].expand(bsz, -1, -1, -1)
+                value_states = voice_profile.value_states[layer_idx][None].expand(bsz, -1, -1, -1)
+                if prompt_hidden_states.shape[1] > 0:
+                    prompt_key_states = cross_attention._shape_key_value(
+                        cross_attention.k_proj(prompt_hidden_states), -1, bsz
+                    )
+                    prompt_value_states = cross_attention._shape_key_value(
+                        cross_attention.v_proj(prompt_hidden_states), -1, bsz
+                    )
+                    key_states = torch.cat([key_states, prompt_key_states], dim=2)
+                    value_states = torch.cat([value_states, prompt_value_states], dim=2)
+                cross_attention_cache.update(key_states, value_states, layer_idx, {"cache_position": None})
+                past_key_values.is_updated[layer_idx] = True
+
+        return model_kwargs
+
     def _prepare_audio_encoder_kwargs_for_generation(
         self, input_values, model_kwargs, model_input_name: Optional[str] = None
     ):
@@ -3130,6 +3961,10 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             self.config.is_encoder_decoder or model_kwargs.get("encoder_outputs") is not None
         )
 
+        if self._generation_batch_buckets is not None and max_batch_size in self._bucket_caches:
+            # each compiled batch size keeps its own cache, whose tensors the compiled decoding step was captured with
+            self._cache = self._bucket_caches[max_batch_size]
+
         if hasattr(self, "_cache"):
             cache_to_check = self._cache.self_attention_cache if requires_cross_attention_cache else self._cache
 
@@ -3173,8 +4008,134 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 self._cache = EncoderDecoderCache(self._cache, cache_cls(**encoder_kwargs))
         else:
             self._cache.reset()
+
+        if self._generation_batch_buckets is not None:
+            self._bucket_caches[max_batch_size] = self._cache
         return self._cache
 
+    def compile_for_generation(self, buckets: Tuple[int, ...] = (1, 2, 4, 8), mode: str = "reduce-overhead", **kwargs):
+        """
+        Compiles the decoding steps of `generate` with `torch.compile`, and makes `generate` use a static cache.
+
+        After the prompt is prefilled, each decoding step runs through a function whose inputs have fixed shapes and
+        that doesn't synchronize with the host, so that it is compiled, and captured in CUDA graphs with
+        `mode="reduce-overhead"`, once per batch size. The batches passed to `generate` are padded to the smallest of
+        `buckets` they fit in, and each bucket keeps its own static cache, so that the compiled steps are reused across
+        calls without being compiled again. For the shapes to stay the same across calls, the descriptions and the
+        prompts should be padded to a fixed length, and `max_length` kept the same.
+
+        Args:
+            buckets (`Tuple[int, ...]`, *optional*, defaults to `(1, 2, 4, 8)`):
+                Batch sizes that the decoding step is compiled for. Larger batches are not padded, and compile a step
+                of their own.
+            mode (`str`, *optional*, defaults to `"reduce-overhead"`):
+                Compilation mode passed to `torch.compile`.
+            kwargs (`Dict[str, Any]`, *optional*):
+                Other arguments of `torch.compile`, e.g. `fullgraph=True`.
+        """
+        if self.decoder.config._attn_implementation == "flash_attention_2":
+            raise ValueError(
+                "The compiled decoding step relies on 4D attention masks and does not support "
+                "`attn_implementation='flash_attention_2'`. Use `attn_implementation='sdpa'` instead."
+            )
+        self.generation_config.cache_implementation = "static"
+        self._generation_batch_buckets = sorted(buckets)
+        self._bucket_caches = {}
+        self._compiled_decode_step = torch.compile(self._static_decode_step, mode=mode, dynamic=False, **kwargs)
+
+    def _static_decode_step(
+        self,
+        decoder_input_ids: torch.LongTensor,
+        cache_position: torch.LongTensor,
+        key_mask: torch.LongTensor,
+        encoder_hidden_states: torch.FloatTensor,
+        encoder_attention_mask: Optional[torch.FloatTensor],
+        past_key_values: EncoderDecoderCache,
+    ) -> torch.FloatTensor:
+        """
+        Decodes the ids of one step, of shape `(batch_size * num_codebooks, 1)`, at position `cache_position` of the
+        static cache. The shapes of the inputs don't depend on the step, and the attention masks are computed without
+        host synchronization, so that the step is compiled only once. Returns the logits of shape
+        `(batch_size * num_codebooks, 1, vocab_size)`.
+        """
+        # attend to the keys that are not padding, up to the current position
+        key_positions = torch.arange(key_mask.shape[-1], device=key_mask.device)
+        attended = key_mask.bool() & (key_positions <= cache_position)
+        dtype = encoder_hidden_states.dtype
+        attention_mask = torch.zeros(attended.shape, dtype=dtype, device=attended.device)
+        attention_mask = attention_mask.masked_fill(~attended, torch.finfo(dtype).min)[:, None, None, :]
+
+        outputs = self.decoder(
+            input_ids=decoder_input_ids,
+            attention_mask=attention_mask,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=past_key_values,
+            use_cache=True,
+            cache_position=cache_position,
+            num_logits_to_keep=1,
+            return_dict=True,
+        )
+        return outputs.logits
+
+    def _prepare_static_decode_inputs(self, model_kwargs) -> Dict[str, Any]:
+        """
+        Prepares the inputs of `_static_decode_step` that are the same at every decoding step, once the prompt is
+        prefilled: the mask of the self-attention keys over the whole static cache, and the expanded cross-attention
+        mask.
+        """
+        past_key_values = model_kwargs["past_key_values"]
+        encoder_hidden_states = model_kwargs["encoder_outputs"].last_hidden_state
+        batch_size = encoder_hidden_states.shape[0]
+
+        key_mask = torch.ones(
+            (batch_size, past_key_values.self_attention_cache.max_cache_len), dtype=torch.long, device=self.device
+        )
+        prompt_attention_mask = model_kwargs.get("prompt_attention_mask")
+        if prompt_attention_mask is not None:
+            # the prompt is prepended to the decoder inputs
+            key_mask[:, : prompt_attention_mask.shape[1]] = prompt_attention_mask
+
+        encoder_attention_mask = model_kwargs.get("attention_mask")
+        if encoder_attention_mask is not None:
+            encoder_attention_mask = _prepare_4d_attention_mask(
+                encoder_attention_mask, encoder_hidden_states.dtype, tgt_len=1
+            )
+
+        return {
+            "key_mask": key_mask,
+            "encoder_hidden_states": encoder_hidden_states,
+            "encoder_attention_mask": encoder_attention_mask,
+            "past_key_values": past_key_values,
+        }
+
+    def _pad_batch_to_bucket(self, inputs_tensor, model_kwargs, batch_size):
+        """
+        Pads the batch to the smallest batch size that the decoding step is compiled for, by repeating its last
+        sample. Returns the padded `inputs_tensor` and `model_kwargs`, and the padded batch size.
+        """
+        bucket = next((bucket for bucket in self._generation_batch_buckets if bucket >= batch_size), None)
+        if bucket is None:
+            logger.warning_once(
+                f"The batch size {batch_size} is larger than the largest batch size the decoding step is compiled for "
+                f"({self._generation_batch_buckets[-1]}), so it will be compiled again for this batch size."
+            )
+            return inputs_tensor, model_kwargs, batch_size
+        if bucket == batch_size:
+            return inputs_tensor, model_kwargs, batch_size
+
+        def pad(tensor):
+            return torch.cat([tensor, tensor[-1:].expand(bucket - batch_size, *tensor.shape[1:])])
+
+        inputs_tensor = pad(inputs_tensor)
+        for key, value in model_kwargs.items():
+            if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == batch_size:
+                model_kwargs[key] = pad(value)
+        if model_kwargs.get("encoder_outputs") is not None:
+            encoder_hidden_states = model_kwargs["encoder_outputs"].last_hidden_state
+            model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=pad(encoder_hidden_states))
+        return inputs_tensor, model_kwargs, bucket
+
     def freeze_encoders(self, freeze_text_encoder=True):
         if freeze_text_encoder:
             for param in self.text_encoder.parameters():
@@ -3194,6 +4155,10 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         stopping_criteria: Optional[StoppingCriteriaList] = None,
         synced_gpus: Optional[bool] = None,
         streamer: Optional["BaseStreamer"] = None,
+        voice_profile: Optional[ParlerTTSVoiceProfile] = None,
+        return_codes: bool = False,
+        compaction_interval: Optional[int] = None,
+        prefill_chunk_size: Optional[int] = None,
         **kwargs,
     ):
         """
@@ -3237,6 +4202,27 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             streamer (`BaseStreamer`, *optional*):
                 Streamer object that will be used to stream the generated sequences. Generated tokens are passed
                 through `streamer.put(token_ids)` and the streamer is responsible for any further processing.
+            voice_profile (`ParlerTTSVoiceProfile`, *optional*):
+                Precomputed conditioning of a description, built with
+                [`~ParlerTTSForConditionalGeneration.build_voice_profile`]. It replaces the description `input_ids`
+                and is shared by all the samples of the batch.
+            return_codes (`bool`, *optional*, defaults to `False`):
+                Whether to return the audio codes, with the delay pattern reverted, instead of decoding them with the
+                audio encoder. The codes are of shape `(batch_size, num_codebooks, frames)`, the frames with a BOS,
+                PAD or EOS token being padding, and can be decoded later, e.g. with a [`ParlerTTSVocoder`]. The number
+                of audio frames of each sample is returned as `codes_length`: in the output if
+                `return_dict_in_generate=True`, as a tuple `(audio_codes, codes_length)` otherwise.
+            compaction_interval (`int`, *optional*):
+                If set, every `compaction_interval` decoding steps, the samples that are done in every codebook are
+                dropped from the batch, along with their cache, so that the remaining steps only decode the samples
+                that are still running. The outputs are returned in the original order, and are the same with greedy
+                decoding. Needs the default dynamic cache, and is not applied when `output_scores`, `output_logits`,
+                `output_attentions` or `output_hidden_states` is set.
+            prefill_chunk_size (`int`, *optional*):
+                With `prompt_cross_attention=False`, the prompt is run through the decoder `prefill_chunk_size` tokens
+                at a time before the first decoding step, instead of along with it in a single forward pass. This
+                bounds the size of the activations and of the attention mask of long prompts, at the cost of more
+                forward passes.
             kwargs (`Dict[str, Any]`, *optional*):
                 Ad hoc parametrization of `generate_config` and/or additional model-specific kwargs that will be
                 forwarded to the `forward` function of the model. If the model is an encoder-decoder model, encoder
@@ -3271,6 +4257,24 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
             # wrap the unconditional outputs as a BaseModelOutput for compatibility with the rest of generate
             model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=model_kwargs["encoder_outputs"][0])
 
+        if prefill_chunk_size is not None and prefill_chunk_size < 1:
+            raise ValueError(f"`prefill_chunk_size` should be at least 1, got {prefill_chunk_size}.")
+
+        if voice_profile is not None:
+            if inputs is not None or model_kwargs.get("input_ids") is not None or "encoder_outputs" in model_kwargs:
+                raise ValueError(
+                    "`voice_profile` replaces the description, `inputs`, `input_ids` and `encoder_outputs` can't be "
+                    "passed along with it."
+                )
+            voice_profile = voice_profile.to(device=self.device, dtype=self.dtype)
+            prompt_input_ids = model_kwargs.get("prompt_input_ids")
+            profile_batch_size = prompt_input_ids.shape[0] if prompt_input_ids is not None else 1
+            encoder_hidden_states = voice_profile.encoder_hidden_states[None].expand(profile_batch_size, -1, -1)
+            model_kwargs["encoder_outputs"] = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+            model_kwargs["attention_mask"] = torch.ones(
+                encoder_hidden_states.shape[:2], dtype=torch.long, device=self.device
+            )
+
         # 2. Set generation parameters if not already defined
         logits_processor = logits_processor if logits_processor is not None else LogitsProcessorList()
         stopping_criteria = stopping_criteria if stopping_criteria is not None else StoppingCriteriaList()
@@ -3287,12 +4291,26 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
 
         # 4. Define other model kwargs
         model_kwargs["use_cache"] = generation_config.use_cache
+        if "num_logits_to_keep" not in model_kwargs:
+            # only the logits of the last position are sampled from
+            model_kwargs["num_logits_to_keep"] = 1
 
         if model_kwargs.get("attention_mask", None) is None and requires_attention_mask:
             model_kwargs["attention_mask"] = self._prepare_attention_mask_for_generation(
                 inputs_tensor, generation_config._pad_token_tensor, generation_config._eos_token_tensor
             )
 
+        # pad the batch to a batch size that the decoding step is compiled for, see `compile_for_generation`
+        generation_batch_size = batch_size
+        if self._generation_batch_buckets is not None and "decoder_input_ids" not in model_kwargs:
+            inputs_tensor, model_kwargs, generation_batch_size = self._pad_batch_to_bucket(
+                inputs_tensor, model_kwargs, batch_size
+            )
+        num_padding_sequences = (
+            (generation_batch_size - batch_size) * self.decoder.num_codebooks * generation_config.num_return_sequences
+        )
+        prompt_prefix_keys = self._get_prompt_prefix_keys(inputs_tensor, model_input_name, model_kwargs)
+
         if "encoder_outputs" not in model_kwargs:
             # encoder_outputs are created and added to `model_kwargs`
             model_kwargs = self._prepare_text_encoder_kwargs_for_generation(
@@ -3314,7 +4332,7 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
 
         # 5. Prepare `input_ids` which will be used for auto-regressive generation
         input_ids, model_kwargs = self._prepare_decoder_input_ids_for_generation(
-            batch_size=batch_size,
+            batch_size=generation_batch_size,
             model_input_name=model_input_name,
             model_kwargs=model_kwargs,
             decoder_start_token_id=generation_config._decoder_start_token_tensor,
@@ -3357,10 +4375,21 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                     max_cache_len = self.generation_config.max_length
                 model_kwargs["past_key_values"] = self._get_cache(
                     generation_config.cache_implementation,
-                    getattr(generation_config, "num_beams", 1) * batch_size,
+                    getattr(generation_config, "num_beams", 1) * generation_batch_size,
                     max_cache_len,
                     model_kwargs,
                 )
+            elif generation_config.cache_implementation == "paged":
+                # self-attention states grow block by block, cross-attention states are computed once
+                model_kwargs["past_key_values"] = EncoderDecoderCache(
+                    PagedCache(
+                        self.config.decoder,
+                        max_batch_size=getattr(generation_config, "num_beams", 1) * generation_batch_size,
+                        device=self.device,
+                        dtype=self.dtype,
+                    ),
+                    DynamicCache(),
+                )
             elif generation_config.cache_implementation == "quantized":
                 raise ValueError(
                     "This model does not support the quantized cache. If you want your model to support quantized "
@@ -3398,7 +4427,7 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
 
         # input_ids are ready to be placed on the streamer (if used)
         if streamer is not None:
-            streamer.put(input_ids.cpu())
+            streamer.put(input_ids[: input_ids.shape[0] - num_padding_sequences].cpu())
 
         # 7. determine generation mode
         is_greedy_gen_mode = (
@@ -3426,6 +4455,21 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         stopping_criteria = self._get_stopping_criteria(
             generation_config=generation_config, stopping_criteria=stopping_criteria
         )
+        past_key_values = model_kwargs.get("past_key_values")
+        if (
+            isinstance(past_key_values, EncoderDecoderCache)
+            and isinstance(past_key_values.self_attention_cache, PagedCache)
+            and generation_config._eos_token_tensor is not None
+        ):
+            # return the cache blocks of a sample to the pool as soon as all of its codebooks are done
+            stopping_criteria.append(
+                PagedCacheReleaseCriteria(
+                    past_key_values.self_attention_cache,
+                    num_codebooks=self.decoder.num_codebooks,
+                    eos_token_id=generation_config._eos_token_tensor,
+                    pad_token_id=generation_config._pad_token_tensor,
+                )
+            )
 
         if is_greedy_gen_mode:
             if generation_config.num_return_sequences > 1:
@@ -3434,6 +4478,9 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                     f"but is {generation_config.num_return_sequences}."
                 )
 
+            model_kwargs = self._prepare_cross_attention_cache_for_generation(model_kwargs, voice_profile)
+            model_kwargs = self._prefill_prompt_for_generation(model_kwargs, prompt_prefix_keys, prefill_chunk_size)
+
             # 10. run greedy search
             outputs = self._sample(
                 input_ids,
@@ -3442,6 +4489,8 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 generation_config=generation_config,
                 synced_gpus=synced_gpus,
                 streamer=streamer,
+                num_padding_sequences=num_padding_sequences,
+                compaction_interval=compaction_interval,
                 **model_kwargs,
             )
 
@@ -3457,6 +4506,13 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 **model_kwargs,
             )
 
+            model_kwargs = self._prepare_cross_attention_cache_for_generation(model_kwargs, voice_profile)
+            if prompt_prefix_keys is not None:
+                prompt_prefix_keys = [
+                    key for key in prompt_prefix_keys for _ in range(generation_config.num_return_sequences)
+                ]
+            model_kwargs = self._prefill_prompt_for_generation(model_kwargs, prompt_prefix_keys, prefill_chunk_size)
+
             # 11. run sample
             outputs = self._sample(
                 input_ids,
@@ -3466,6 +4522,8 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
                 generation_config=generation_config,
                 synced_gpus=synced_gpus,
                 streamer=streamer,
+                num_padding_sequences=num_padding_sequences,
+                compaction_interval=compaction_interval,
                 **model_kwargs,
             )
 
@@ -3480,55 +4538,72 @@ class ParlerTTSForConditionalGeneration(PreTrainedModel):
         else:
             output_ids = outputs
 
-        # Apply the pattern mask to the final ids
-        output_ids = self.decoder.apply_delay_pattern_mask(output_ids, model_kwargs["decoder_delay_pattern_mask"])
-
-        # Revert the pattern delay mask by filtering the eos and bos token ids from the delay pattern mask
-        _, mask = self.decoder.build_delay_pattern_mask(
-            input_ids,
-            bos_token_id=generation_config._bos_token_tensor,
-            pad_token_id=generation_config._pad_token_tensor,
-            max_length=output_ids.shape[1],
+        # Apply the pattern mask to the final ids, the rows padding the batch are not returned
+        output_ids = self.decoder.apply_delay_pattern_mask(
+            output_ids, model_kwargs["decoder_delay_pattern_mask"][: output_ids.shape[0]]
         )
 
-        mask = (mask != generation_config.bos_token_id) & (mask != generation_config.pad_token_id)
-        output_ids = output_ids[mask].reshape(batch_size, self.decoder.num_codebooks, -1)
+        # Revert the pattern delay mask by removing the bos and eos padding of each codebook
+        output_ids = revert_delay_pattern_mask(output_ids, self.decoder.num_codebooks).reshape(
+            batch_size, self.decoder.num_codebooks, -1
+        )
 
         # append the frame dimension back to the audio codes
         output_ids = output_ids[None, ...]
 
+        if return_codes:
+            audio_codes = output_ids[0]
+            codes_length = (audio_codes < self.audio_encoder.config.codebook_size).all(dim=1).sum(dim=-1).tolist()
+            if generation_config.return_dict_in_generate:
+                outputs["codes_length"] = codes_length
+                outputs.sequences = audio_codes
+                return outputs
+            else:
+                return audio_codes, codes_length
+
         audio_scales = model_kwargs.get("audio_scales")
         if audio_scales is None:
             audio_scales = [None] * batch_size
 
-        decode_sequentially = (
-            generation_config.bos_token_id in output_ids
-            or generation_config.pad_token_id in output_ids
-            or generation_config.eos_token_id in output_ids
-        )
-        if not decode_sequentially:
+        if isinstance(self.audio_encoder, DACModel):
+            # the frames with a BOS, PAD or EOS token are masked out by DAC, which decodes the batch at once
             output_values = self.audio_encoder.decode(
                 output_ids,
                 audio_scales=audio_scales,
             ).audio_values.squeeze(1)
-            output_lengths = [audio.shape[0] for audio in output_values]
+            num_frames = (output_ids[0] < self.audio_encoder.config.codebook_size).all(dim=1).sum(dim=-1)
+            # samples without any audio frame are a single zero
+            output_lengths = [max(length * self.audio_encoder.hop_length, 1) for length in num_frames.tolist()]
+            output_values = output_values[:, : max(output_lengths)]
         else:
-            output_values = []
-            for sample_id in range(batch_size):
-                sample = output_ids[:, sample_id]
-                sample_mask = (sample >= self.audio_encoder.config.codebook_size).sum(dim=(0, 1)) == 0
-                if sample_mask.sum() > 0:
-                    sample = sample[:, :, sample_mask]
-                    sample = self.audio_encoder.decode(sample[None, ...], [audio_scales[sample_id]]).audio_values
-                    output_values.append(sample.transpose(0, 2))
-                else:
-                    output_values.append(torch.zeros((1, 1, 1)).to(self.device))
-            output_lengths = [audio.shape[0] for audio in output_values]
-            output_values = (
-                torch.nn.utils.rnn.pad_sequence(output_values, batch_first=True, padding_value=0)
-                .squeeze(-1)
-                .squeeze(-1)
+            decode_sequentially = (
+                generation_config.bos_token_id in output_ids
+                or generation_config.pad_token_id in output_ids
+                or generation_config.eos_token_id in output_ids
             )
+            if not decode_sequentially:
+                output_values = self.audio_encoder.decode(
+                    output_ids,
+                    audio_scales=audio_scales,
+                ).audio_values.squeeze(1)
+                output_lengths = [audio.shape[0] for audio in output_values]
+            else:
+                output_values = []
+                for sample_id in range(batch_size):
+                    sample = output_ids[:, sample_id]
+                    sample_mask = (sample >= self.audio_encoder.config.codebook_size).sum(dim=(0, 1)) == 0
+                    if sample_mask.sum() > 0:
+                        sample = sample[:, :, sample_mask]
+                        sample = self.audio_encoder.decode(sample[None, ...], [audio_scales[sample_id]]).audio_values
+                        output_values.append(sample.transpose(0, 2))
+                    else:
+                        output_values.append(torch.zeros((1, 1, 1)).to(self.device))
+                output_lengths = [audio.shape[0] for audio in output_values]
+                output_values = (
+                    torch.nn.utils.rnn.pad_sequence(output_values, batch_first=True, padding_value=0)
+                    .squeeze(-1)
+                    .squeeze(-1)
+                )
         if generation_config.return_dict_in_generate:
             outputs["audios_length"] = output_lengths
             outputs.sequences = output_values
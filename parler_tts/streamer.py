@@ -1,14 +1,30 @@
-
+from .dac_wrapper import DACModel
 from .modeling_parler_tts import ParlerTTSForConditionalGeneration
+from transformers.generation.stopping_criteria import StoppingCriteria, StoppingCriteriaList
 from transformers.generation.streamers import BaseStreamer
-from typing import Optional
+from typing import Any, Dict, List, Optional, Tuple
 import torch
 import numpy as np
+import asyncio
 import math
+import threading
+import time
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from queue import Queue
 
 
 class ParlerTTSStreamer(BaseStreamer):
+    batch_size = 1
+    # number of chunks waiting for the background decoding, beyond which the generation waits
+    max_pending_chunks = 2
+    # pool decoding the chunks of all the streamers, see `get_decode_executor`
+    _decode_executor = None
+    _decode_executor_lock = threading.Lock()
+    # CUDA stream of each decoding thread
+    _decode_streams = threading.local()
+    # with a `target_latency`, margin kept on the time to produce a chunk compared to the time to play it
+    realtime_margin = 1.2
+
     def __init__(
         self,
         model: ParlerTTSForConditionalGeneration,
@@ -16,11 +32,28 @@ class ParlerTTSStreamer(BaseStreamer):
         play_steps: Optional[int] = 10,
         stride: Optional[int] = None,
         timeout: Optional[float] = None,
+        decode_in_background: bool = True,
+        target_latency: Optional[float] = None,
+        max_play_steps: Optional[int] = None,
     ):
         """
         Streamer that stores playback-ready audio in a queue, to be used by a downstream application as an iterator. This is
         useful for applications that benefit from accessing the generated audio in a non-blocking way (e.g. in an interactive
         Gradio demo).
+
+        The audio is decoded incrementally: every `play_steps` generation steps, only the new frames are decoded, along
+        with the frames of their left and right context that the codec decoder depends on. The chunks are therefore the
+        exact samples of the audio decoded at once, and each of them costs the same whatever the length of the audio
+        already generated. The audio of a frame is only played once the frames of its right context are generated.
+
+        By default, the chunks are decoded on a pool of threads shared by all the streamers, on their own CUDA stream
+        when decoding on GPU, so that the generation goes on while the previous chunk is decoded. The chunks of a
+        streamer are decoded in order, one at a time.
+
+        With a `target_latency`, the number of steps of each chunk is chosen online from the measured duration of the
+        generation steps and of the codec decoding: the first chunk is played as late as the latency target allows, and
+        the next ones are as small as possible while generating them stays faster than playing them. The resulting
+        schedule is reported by `metrics`.
         Parameters:
             model (`ParlerTTSForConditionalGeneration`):
                 The Parler-TTS model used to generate the audio waveform.
@@ -31,12 +64,19 @@ class ParlerTTSStreamer(BaseStreamer):
                 mean the first chunk is ready faster, but will require more codec decoding steps overall. This value
                 should be tuned to your device and latency requirements.
             stride (`int`, *optional*):
-                The window (stride) between adjacent audio samples. Using a stride between adjacent audio samples reduces
-                the hard boundary between them, giving smoother playback. If `None`, will default to a value equivalent to
-                play_steps // 6 in the audio space.
+                Deprecated and not used anymore: chunks are decoded with all the context they depend on, so adjacent
+                chunks no longer need to overlap.
             timeout (`int`, *optional*):
                 The timeout for the audio queue. If `None`, the queue will block indefinitely. Useful to handle exceptions
                 in `.generate()`, when it is called in a separate thread.
+            decode_in_background (`bool`, *optional*, defaults to `True`):
+                Whether to decode the chunks on the shared decoding pool rather than in the generation loop.
+            target_latency (`float`, *optional*):
+                If set, the time to first audio to aim for, in seconds, and `play_steps` is adapted online instead of
+                being fixed.
+            max_play_steps (`int`, *optional*):
+                With a `target_latency`, the maximum number of generation steps of a chunk. If `None`, will default to
+                one second of audio.
         """
         self.decoder = model.decoder
         self.audio_encoder = model.audio_encoder
@@ -45,84 +85,354 @@ class ParlerTTSStreamer(BaseStreamer):
 
         # variables used in the streaming process
         self.play_steps = play_steps
-        if stride is not None:
-            self.stride = stride
+        self.stride = stride
+        self.num_codebooks = self.decoder.num_codebooks
+        if hasattr(self.audio_encoder, "hop_length"):
+            self.hop_length = self.audio_encoder.hop_length
         else:
-            hop_length = math.floor(self.audio_encoder.config.sampling_rate / self.audio_encoder.config.frame_rate)
-            self.stride = hop_length * (play_steps - self.decoder.num_codebooks) // 6
+            self.hop_length = math.floor(self.audio_encoder.config.sampling_rate / self.audio_encoder.config.frame_rate)
+        # number of frames on each side of a frame that its audio depends on. Audio encoders that don't expose it, such
+        # as Encodec, decode all the frames of a sample every chunk and play the new ones as soon as they are generated
+        self.full_window = not hasattr(self.audio_encoder, "decoder_receptive_field")
+        self.context_frames = 0 if self.full_window else self.audio_encoder.decoder_receptive_field
+        # last `num_codebooks` generated tokens of each codebook, enough to complete the next frame of the delay
+        # pattern
         self.token_cache = None
-        self.to_yield = 0
+        self.num_tokens = 0
+        # for each sample, codes of the frames that are not played yet, and of the `context_frames` frames before them
+        self.frames = [torch.zeros((self.num_codebooks, 0), dtype=torch.long) for _ in range(self.batch_size)]
+        self.frames_offset = [0] * self.batch_size
+        self.num_played_frames = [0] * self.batch_size
+        self.finished = [False] * self.batch_size
+
+        # variables used by the background decoding
+        self.decode_in_background = decode_in_background
+        # chunks submitted and not decoded yet, and the future of the last one, which the next one is chained to
+        self.pending_chunks = threading.Semaphore(self.max_pending_chunks)
+        self.last_decode = None
+        self.decode_error = None
+
+        # variables used to schedule the chunks
+        self.target_latency = target_latency
+        self.frame_duration = self.hop_length / self.audio_encoder.config.sampling_rate
+        self.max_play_steps = max_play_steps if max_play_steps is not None else round(1 / self.frame_duration)
+        self.next_chunk_tokens = play_steps
+        self.last_chunk_tokens = 0
+        self.chunk_play_steps = []
+        self.start_time = None
+        self.last_put_time = None
+        self.time_to_first_audio = None
+        # moving averages of the duration of a generation step, and of the codec decoding of a frame
+        self.step_time = None
+        self.decode_time_per_frame = None
 
         # varibles used in the thread process
         self.audio_queue = Queue()
         self.stop_signal = None
         self.timeout = timeout
 
-    def apply_delay_pattern_mask(self, input_ids):
-        # build the delay pattern mask for offsetting each codebook prediction by 1 (this behaviour is specific to Parler)
-        _, delay_pattern_mask = self.decoder.build_delay_pattern_mask(
-            input_ids[:, :1],
-            bos_token_id=self.generation_config.bos_token_id,
-            pad_token_id=self.generation_config.decoder_start_token_id,
-            max_length=input_ids.shape[-1],
-        )
-        # apply the pattern mask to the input ids
-        input_ids = self.decoder.apply_delay_pattern_mask(input_ids, delay_pattern_mask)
-
-        # revert the pattern delay mask by filtering the pad token id
-        mask = (delay_pattern_mask != self.generation_config.bos_token_id) & (delay_pattern_mask != self.generation_config.pad_token_id)
-        input_ids = input_ids[mask].reshape(1, self.decoder.num_codebooks, -1)
-        # append the frame dimension back to the audio codes
-        input_ids = input_ids[None, ...]
-
-        # send the input_ids to the correct device
-        input_ids = input_ids.to(self.audio_encoder.device)
-
-        decode_sequentially = (
-            self.generation_config.bos_token_id in input_ids
-            or self.generation_config.pad_token_id in input_ids
-            or self.generation_config.eos_token_id in input_ids
-        )
-        if not decode_sequentially:
-            output_values = self.audio_encoder.decode(
-                input_ids,
-                audio_scales=[None],
+    def add_tokens(self, input_ids: torch.LongTensor) -> List[int]:
+        """
+        Adds generated tokens of shape `(batch_size, num_codebooks, num_tokens)` and stores the frames they complete.
+        With the delay pattern, the `k`-th codebook of a frame is generated `k` steps after its first codebook.
+
+        Returns the indices of the samples whose audio ended with these tokens.
+        """
+        ended = []
+        for column in input_ids.cpu().unbind(dim=-1):
+            if self.token_cache is None:
+                self.token_cache = column[..., None]
+            else:
+                self.token_cache = torch.cat([self.token_cache, column[..., None]], dim=-1)[..., -self.num_codebooks :]
+            self.num_tokens += 1
+
+            # the first token of each codebook is the BOS token, frames start after it
+            if self.num_tokens <= self.num_codebooks:
+                continue
+            frames = self.token_cache.diagonal(dim1=1, dim2=2)
+            # frames containing BOS, pad or EOS tokens are not decoded, and the audio ends with the EOS of the first
+            # codebook, which is followed by pad tokens
+            is_valid = (frames < self.audio_encoder.config.codebook_size).all(dim=-1).tolist()
+            is_last = (frames[:, 0] >= self.audio_encoder.config.codebook_size).tolist()
+            for batch_index in range(len(frames)):
+                if self.finished[batch_index] or batch_index in ended:
+                    continue
+                if is_valid[batch_index]:
+                    self.frames[batch_index] = torch.cat(
+                        [self.frames[batch_index], frames[batch_index, :, None]], dim=-1
+                    )
+                elif is_last[batch_index]:
+                    ended.append(batch_index)
+        return ended
+
+    def _decode(self, audio_codes: List[torch.LongTensor], stream_end: bool = False) -> List[torch.Tensor]:
+        if not isinstance(self.audio_encoder, DACModel):
+            # only DAC masks the padding frames, the other audio encoders decode each sample on its own
+            return [
+                self.audio_encoder.decode(codes[None, None].to(self.audio_encoder.device), [None]).audio_values[0, 0]
+                for codes in audio_codes
+            ]
+        # right-pad the codes to decode them as a batch, the samples of each frame only depend on their context
+        lengths = [codes.shape[-1] for codes in audio_codes]
+        padded_codes = audio_codes[0].new_zeros((len(audio_codes), self.num_codebooks, max(lengths)))
+        for batch_index, codes in enumerate(audio_codes):
+            padded_codes[batch_index, :, : lengths[batch_index]] = codes
+        padded_codes = padded_codes.to(self.audio_encoder.device)
+        # at the end of the stream, the last frames are played and must not see the padding
+        padding_mask = None
+        if stream_end:
+            frames = torch.arange(max(lengths), device=padded_codes.device)
+            padding_mask = frames < torch.tensor(lengths, device=padded_codes.device)[:, None]
+        audio_values = self.audio_encoder.decode(
+            padded_codes[None], [None] * len(audio_codes), padding_mask=padding_mask
+        ).audio_values
+        return [audio[0, : length * self.hop_length] for audio, length in zip(audio_values, lengths)]
+
+    def pop_frames(
+        self, batch_indices: List[int], stream_end: bool = False
+    ) -> Dict[int, Optional[Tuple[torch.LongTensor, int, int]]]:
+        """
+        Pops the frames of the samples at `batch_indices` that are ready to be played, i.e. all of them at the end of
+        the stream, and otherwise the ones followed by `context_frames` frames. For each sample, returns the codes to
+        decode, with their context, and the range of the frames to play within them, or `None` if there are none.
+        """
+        windows = {}
+        for batch_index in batch_indices:
+            frames, offset = self.frames[batch_index], self.frames_offset[batch_index]
+            num_played_frames = self.num_played_frames[batch_index]
+            end = offset + frames.shape[-1] if stream_end else offset + frames.shape[-1] - self.context_frames
+            if end <= num_played_frames:
+                windows[batch_index] = None
+                continue
+            # decode the frames to play with their context, then only keep their samples
+            start = offset if self.full_window else max(num_played_frames - self.context_frames, offset)
+            windows[batch_index] = (frames[:, start - offset :], num_played_frames - start, end - start)
+            self.num_played_frames[batch_index] = end
+
+            # only keep the left context of the frames that are not played yet
+            new_offset = offset if self.full_window else max(end - self.context_frames, offset)
+            self.frames[batch_index] = frames[:, new_offset - offset :]
+            self.frames_offset[batch_index] = new_offset
+        return windows
+
+    @torch.no_grad()
+    def decode_frames(self, windows: Dict[int, Optional[Tuple]], stream_end: bool = False) -> Dict[int, np.ndarray]:
+        """Decodes the frames popped by [`~ParlerTTSStreamer.pop_frames`] into the audio of each sample."""
+        bounds = {batch_index: window[1:] for batch_index, window in windows.items() if window is not None}
+        audio_codes = [window[0] for window in windows.values() if window is not None]
+
+        audio_values = self._decode(audio_codes, stream_end=stream_end) if len(audio_codes) > 0 else []
+
+        outputs = {batch_index: np.zeros(0, dtype=np.float32) for batch_index in windows}
+        for (batch_index, (start, end)), audio in zip(bounds.items(), audio_values):
+            outputs[batch_index] = audio[start * self.hop_length : end * self.hop_length].cpu().float().numpy()
+        return outputs
+
+    def play_frames(self, windows: Dict[int, Optional[Tuple]], stream_end: bool = False):
+        """Decodes the popped frames and sends their audio downstream."""
+        start_time = time.perf_counter()
+        outputs = self.decode_frames(windows, stream_end=stream_end)
+        num_frames = sum(window[0].shape[-1] for window in windows.values() if window is not None)
+        if num_frames > 0:
+            self.decode_time_per_frame = self._moving_average(
+                self.decode_time_per_frame, (time.perf_counter() - start_time) / num_frames
             )
-        else:
-            sample = input_ids[:, 0]
-            sample_mask = (sample >= self.audio_encoder.config.codebook_size).sum(dim=(0, 1)) == 0
-            sample = sample[:, :, sample_mask]
-            output_values = self.audio_encoder.decode(sample[None, ...], [None])
 
-        audio_values = output_values.audio_values[0, 0]
-        return audio_values.cpu().float().numpy()
+        for batch_index, audio_values in outputs.items():
+            if len(audio_values) > 0 and self.time_to_first_audio is None:
+                self.time_to_first_audio = time.perf_counter() - self.start_time
+            if len(audio_values) > 0 or stream_end:
+                self.on_finalized_audio(audio_values, stream_end=stream_end, batch_index=batch_index)
+
+    @staticmethod
+    def _moving_average(average: Optional[float], value: float, decay: float = 0.9) -> float:
+        return value if average is None else decay * average + (1 - decay) * value
+
+    def _is_chunk_ready(self) -> bool:
+        if self.target_latency is None or len(self.chunk_play_steps) > 0:
+            return self.num_tokens >= self.next_chunk_tokens
+
+        # play the first chunk as soon as waiting for one more step would miss the latency target
+        num_playable_frames = sum(
+            max(offset + frames.shape[-1] - self.context_frames - num_played_frames, 0)
+            for frames, offset, num_played_frames, finished in zip(
+                self.frames, self.frames_offset, self.num_played_frames, self.finished
+            )
+            if not finished
+        )
+        if num_playable_frames == 0:
+            return False
+        decode_time = (self.decode_time_per_frame or 0.0) * (num_playable_frames + 2 * self.context_frames)
+        elapsed_time = time.perf_counter() - self.start_time
+        return elapsed_time + (self.step_time or 0.0) + decode_time >= self.target_latency
+
+    def _get_play_steps(self) -> int:
+        """Number of generation steps of the next chunk."""
+        if self.target_latency is None:
+            return self.play_steps
+        if self.step_time is None:
+            return self.max_play_steps
+
+        # generating n frames takes n * step_time, decoding them with their context
+        # (n + 2 * context_frames) * decode_time_per_frame for each stream, and playing them n * frame_duration
+        num_streams = max(self.finished.count(False), 1)
+        decode_time_per_frame = num_streams * (self.decode_time_per_frame or 0.0)
+        slack = self.frame_duration - self.realtime_margin * (self.step_time + decode_time_per_frame)
+        if slack <= 0:
+            # generating is slower than playing, at least amortize the decoding
+            return self.max_play_steps
+        play_steps = math.ceil(self.realtime_margin * 2 * self.context_frames * decode_time_per_frame / slack)
+        return min(max(play_steps, 1), self.max_play_steps)
+
+    @property
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Measurements of the stream: the time to first audio, the moving averages of the duration of a generation step
+        and of the decoding of a frame, the real-time factor of the generation, and the number of generation steps of
+        each chunk.
+        """
+        return {
+            "time_to_first_audio": self.time_to_first_audio,
+            "step_time": self.step_time,
+            "decode_time_per_frame": self.decode_time_per_frame,
+            "real_time_factor": self.step_time / self.frame_duration if self.step_time is not None else None,
+            "play_steps": list(self.chunk_play_steps),
+        }
+
+    @classmethod
+    def get_decode_executor(cls, max_workers: int = 4) -> Executor:
+        """
+        Returns the executor decoding the chunks of all the streamers, created with `max_workers` threads when first
+        used. It is separate from the executor running the generations of [`AsyncParlerTTSStreamer`], which wait for
+        their chunks to be decoded.
+        """
+        with ParlerTTSStreamer._decode_executor_lock:
+            if ParlerTTSStreamer._decode_executor is None:
+                ParlerTTSStreamer._decode_executor = ThreadPoolExecutor(
+                    max_workers=max_workers, thread_name_prefix="parler-tts-decode"
+                )
+            return ParlerTTSStreamer._decode_executor
+
+    def _get_decode_stream(self) -> Optional["torch.cuda.Stream"]:
+        """Returns the CUDA stream of the current decoding thread, or `None` when not decoding on GPU."""
+        device = self.audio_encoder.device
+        if device.type != "cuda":
+            return None
+        streams = getattr(self._decode_streams, "streams", None)
+        if streams is None:
+            streams = self._decode_streams.streams = {}
+        if device not in streams:
+            streams[device] = torch.cuda.Stream(device)
+        return streams[device]
+
+    def _decode_chunk(self, windows: Dict[int, Optional[Tuple]], stream_end: bool, done: Future):
+        try:
+            if self.decode_error is None:
+                decode_stream = self._get_decode_stream()
+                if decode_stream is not None:
+                    with torch.cuda.stream(decode_stream):
+                        self.play_frames(windows, stream_end=stream_end)
+                else:
+                    self.play_frames(windows, stream_end=stream_end)
+        except Exception as error:
+            # raised by the generation loop at its next chunk
+            self.decode_error = error
+        finally:
+            self._chunk_done(done)
+
+    def _chunk_done(self, done: Future):
+        """Lets the generation submit one more chunk, and the next chunk of the stream be decoded."""
+        self.pending_chunks.release()
+        done.set_result(None)
+
+    def _submit_frames(self, windows: Dict[int, Optional[Tuple]], stream_end: bool = False):
+        if self.decode_error is not None:
+            raise self.decode_error
+        if not self.decode_in_background:
+            self.play_frames(windows, stream_end=stream_end)
+            return
+        # blocks the generation while `max_pending_chunks` chunks are waiting to be decoded
+        self.pending_chunks.acquire()
+        executor = self.get_decode_executor()
+        previous, done = self.last_decode, Future()
+        self.last_decode = done
+        if previous is None:
+            executor.submit(self._decode_chunk, windows, stream_end, done)
+        else:
+            # the chunks of a stream are decoded in order: each one is submitted once the previous one is decoded
+            previous.add_done_callback(lambda _: executor.submit(self._decode_chunk, windows, stream_end, done))
 
     def put(self, value):
         batch_size = value.shape[0] // self.decoder.num_codebooks
-        if batch_size > 1:
-            raise ValueError("ParlerTTSStreamer only supports batch size 1")
+        if batch_size != self.batch_size:
+            if self.batch_size == 1:
+                raise ValueError("ParlerTTSStreamer only supports batch size 1, use ParlerTTSBatchStreamer instead")
+            raise ValueError(f"Expected the tokens of {self.batch_size} samples, got {batch_size}")
 
-        if self.token_cache is None:
-            self.token_cache = value
-        else:
-            self.token_cache = torch.concatenate([self.token_cache, value[:, None]], dim=-1)
+        now = time.perf_counter()
+        if self.start_time is None:
+            self.start_time = now
+        elif self.num_tokens > 1:
+            # the first interval also includes the text encoder and the prefill
+            self.step_time = self._moving_average(self.step_time, now - self.last_put_time)
+        self.last_put_time = now
 
-        if self.token_cache.shape[-1] % self.play_steps == 0:
-            audio_values = self.apply_delay_pattern_mask(self.token_cache)
-            self.on_finalized_audio(audio_values[self.to_yield : -self.stride])
-            self.to_yield += len(audio_values) - self.to_yield - self.stride
+        # samples whose audio is complete are flushed right away
+        ended = self.add_tokens(value.reshape(batch_size, self.num_codebooks, -1))
+        if len(ended) > 0:
+            for batch_index in ended:
+                self.finished[batch_index] = True
+            self._submit_frames(self.pop_frames(ended, stream_end=True), stream_end=True)
+
+        if self._is_chunk_ready():
+            batch_indices = [batch_index for batch_index in range(batch_size) if not self.finished[batch_index]]
+            self._submit_frames(self.pop_frames(batch_indices))
+            self.chunk_play_steps.append(self.num_tokens - self.last_chunk_tokens)
+            self.last_chunk_tokens = self.num_tokens
+            self.next_chunk_tokens = self.num_tokens + self._get_play_steps()
 
     def end(self):
         """Flushes any remaining cache and appends the stop symbol."""
-        if self.token_cache is not None:
-            audio_values = self.apply_delay_pattern_mask(self.token_cache)
+        batch_indices = [batch_index for batch_index in range(self.batch_size) if not self.finished[batch_index]]
+        for batch_index in batch_indices:
+            self.finished[batch_index] = True
+        self._submit_frames(self.pop_frames(batch_indices, stream_end=True), stream_end=True)
+        if self.last_decode is not None:
+            # wait for the last chunks, and raise if decoding them failed
+            self.last_decode.result()
+            self.last_decode = None
+            if self.decode_error is not None:
+                raise self.decode_error
+
+    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False, batch_index: int = 0):
+        """Put the new audio in the queue. If the stream is ending, also put a stop signal in the queue."""
+        self.audio_queue.put(audio, timeout=self.timeout)
+        if stream_end:
+            self.audio_queue.put(self.stop_signal, timeout=self.timeout)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.audio_queue.get(timeout=self.timeout)
+        if not isinstance(value, np.ndarray) and value == self.stop_signal:
+            raise StopIteration()
         else:
-            audio_values = np.zeros(self.to_yield)
+            return value
 
-        self.on_finalized_audio(audio_values[self.to_yield :], stream_end=True)
 
-    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False):
-        """Put the new audio in the queue. If the stream is ending, also put a stop signal in the queue."""
+class ParlerTTSAudioStream:
+    """
+    Iterator over the audio chunks of one sample of a [`ParlerTTSBatchStreamer`], which stops once the audio of the
+    sample is complete.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.audio_queue = Queue()
+        self.stop_signal = None
+        self.timeout = timeout
+
+    def put(self, audio: np.ndarray, stream_end: bool = False):
         self.audio_queue.put(audio, timeout=self.timeout)
         if stream_end:
             self.audio_queue.put(self.stop_signal, timeout=self.timeout)
@@ -135,4 +445,248 @@ class ParlerTTSStreamer(BaseStreamer):
         if not isinstance(value, np.ndarray) and value == self.stop_signal:
             raise StopIteration()
         else:
-            return value
\ No newline at end of file
+            return value
+
+
+class ParlerTTSBatchStreamer(ParlerTTSStreamer):
+    def __init__(
+        self,
+        model: ParlerTTSForConditionalGeneration,
+        batch_size: int,
+        device: Optional[str] = None,
+        play_steps: Optional[int] = 10,
+        timeout: Optional[float] = None,
+        decode_in_background: bool = True,
+        target_latency: Optional[float] = None,
+        max_play_steps: Optional[int] = None,
+    ):
+        """
+        Streamer for batched generation, which sends the audio of each sample to its own queue: `streams[i]` iterates
+        over the audio chunks of the `i`-th sample. The chunks of all the samples are decoded together, and the stream
+        of a sample stops as soon as its audio is complete, without waiting for the rest of the batch.
+
+        ```python
+        >>> streamer = ParlerTTSBatchStreamer(model, batch_size=len(prompts), play_steps=43)
+        >>> thread = Thread(target=model.generate, kwargs=dict(**inputs, streamer=streamer))
+        >>> thread.start()
+        >>> for audio_chunk in streamer.streams[0]:
+        ...     play(audio_chunk)
+        ```
+
+        Parameters:
+            model (`ParlerTTSForConditionalGeneration`):
+                The Parler-TTS model used to generate the audio waveform.
+            batch_size (`int`):
+                The number of samples generated together.
+            device (`str`, *optional*):
+                The torch device on which to run the computation. If `None`, will default to the device of the model.
+            play_steps (`int`, *optional*, defaults to 10):
+                The number of generation steps with which to return the generated audio arrays.
+            timeout (`int`, *optional*):
+                The timeout for the audio queues. If `None`, the queues will block indefinitely.
+            decode_in_background (`bool`, *optional*, defaults to `True`):
+                Whether to decode the chunks on the shared decoding pool rather than in the generation loop.
+            target_latency (`float`, *optional*):
+                If set, the time to first audio to aim for, in seconds, and `play_steps` is adapted online instead of
+                being fixed.
+            max_play_steps (`int`, *optional*):
+                With a `target_latency`, the maximum number of generation steps of a chunk. If `None`, will default to
+                one second of audio.
+        """
+        self.batch_size = batch_size
+        super().__init__(
+            model,
+            device=device,
+            play_steps=play_steps,
+            timeout=timeout,
+            decode_in_background=decode_in_background,
+            target_latency=target_latency,
+            max_play_steps=max_play_steps,
+        )
+        self.streams = [ParlerTTSAudioStream(timeout=timeout) for _ in range(batch_size)]
+
+    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False, batch_index: int = 0):
+        """Put the new audio in the queue of its sample. If its stream is ending, also put a stop signal in it."""
+        self.streams[batch_index].put(audio, stream_end=stream_end)
+
+    def __iter__(self):
+        raise TypeError("Iterate over the stream of each sample instead, `streamer.streams[i]` for the `i`-th sample.")
+
+
+class CancelledStreamCriteria(StoppingCriteria):
+    """Stops the generation of an [`AsyncParlerTTSStreamer`] once its consumer cancelled it."""
+
+    def __init__(self, streamer: "AsyncParlerTTSStreamer"):
+        self.streamer = streamer
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.streamer.cancelled, dtype=torch.bool, device=input_ids.device)
+
+
+class AsyncParlerTTSStreamer(ParlerTTSStreamer):
+    _default_executor = None
+    _default_executor_lock = threading.Lock()
+
+    def __init__(
+        self,
+        model: ParlerTTSForConditionalGeneration,
+        device: Optional[str] = None,
+        play_steps: Optional[int] = 10,
+        max_queue_size: int = 8,
+        executor: Optional[Executor] = None,
+        decode_in_background: bool = True,
+        target_latency: Optional[float] = None,
+        max_play_steps: Optional[int] = None,
+    ):
+        """
+        Streamer to consume the generated audio from asyncio code, with `async for`. [`~AsyncParlerTTSStreamer.start`]
+        runs the generation on an executor shared by all the streams, the default one having `max_workers=4` threads.
+
+        At most `max_queue_size` chunks wait for the consumer: beyond that, the generation waits for the consumer to
+        catch up. When the consumer stops iterating, e.g. because its task is cancelled when a client disconnects, the
+        generation stops at its next step.
+
+        ```python
+        >>> async def stream(text, description):
+        ...     streamer = AsyncParlerTTSStreamer(model, play_steps=43)
+        ...     async with streamer:
+        ...         streamer.start(**tokenize(text, description))
+        ...         async for audio_chunk in streamer:
+        ...             yield audio_chunk
+        ```
+
+        Parameters:
+            model (`ParlerTTSForConditionalGeneration`):
+                The Parler-TTS model used to generate the audio waveform.
+            device (`str`, *optional*):
+                The torch device on which to run the computation. If `None`, will default to the device of the model.
+            play_steps (`int`, *optional*, defaults to 10):
+                The number of generation steps with which to return the generated audio array.
+            max_queue_size (`int`, *optional*, defaults to 8):
+                The number of chunks waiting for the consumer beyond which the generation is paused.
+            executor (`concurrent.futures.Executor`, *optional*):
+                The executor running the generation. If `None`, will default to an executor shared by all the streams.
+            decode_in_background (`bool`, *optional*, defaults to `True`):
+                Whether to decode the chunks on the shared decoding pool rather than in the generation loop.
+            target_latency (`float`, *optional*):
+                If set, the time to first audio to aim for, in seconds, and `play_steps` is adapted online instead of
+                being fixed.
+            max_play_steps (`int`, *optional*):
+                With a `target_latency`, the maximum number of generation steps of a chunk. If `None`, will default to
+                one second of audio.
+        """
+        super().__init__(
+            model,
+            device=device,
+            play_steps=play_steps,
+            decode_in_background=decode_in_background,
+            target_latency=target_latency,
+            max_play_steps=max_play_steps,
+        )
+        self.model = model
+        self.max_queue_size = max_queue_size
+        self.executor = executor if executor is not None else self.get_default_executor()
+        self.cancelled = False
+        self.generation = None
+        self.loop = None
+        # future of the last chunk put in the queue from the decoding pool
+        self.last_put = None
+
+    @classmethod
+    def get_default_executor(cls, max_workers: int = 4) -> Executor:
+        """Returns the executor shared by the streams, created with `max_workers` threads when first used."""
+        with cls._default_executor_lock:
+            if cls._default_executor is None:
+                cls._default_executor = ThreadPoolExecutor(
+                    max_workers=max_workers, thread_name_prefix="parler-tts-stream"
+                )
+            return cls._default_executor
+
+    def start(self, **generation_kwargs) -> asyncio.Future:
+        """
+        Starts `model.generate(**generation_kwargs)` on the executor, streaming its audio to this streamer. Must be
+        called from the event loop consuming the stream. Returns the future of the generation.
+        """
+        if self.generation is not None:
+            raise ValueError("The generation of this streamer was already started.")
+        self.loop = asyncio.get_running_loop()
+        self.audio_queue = asyncio.Queue(maxsize=self.max_queue_size)
+
+        stopping_criteria = StoppingCriteriaList(generation_kwargs.pop("stopping_criteria", None) or [])
+        stopping_criteria.append(CancelledStreamCriteria(self))
+        generation_kwargs.update(streamer=self, stopping_criteria=stopping_criteria)
+        self.generation = self.loop.run_in_executor(self.executor, self._generate, generation_kwargs)
+        return self.generation
+
+    def _generate(self, generation_kwargs):
+        try:
+            return self.model.generate(**generation_kwargs)
+        except BaseException as exception:
+            # let the consumer know why the stream ended
+            self._put(exception)
+            raise
+
+    def _put(self, value, wait: bool = True):
+        # with `wait`, blocks the calling thread while the queue is full
+        if self.cancelled:
+            return
+        put = asyncio.run_coroutine_threadsafe(self.audio_queue.put(value), self.loop)
+        if wait:
+            put.result()
+        else:
+            self.last_put = put
+
+    def on_finalized_audio(self, audio: np.ndarray, stream_end: bool = False, batch_index: int = 0):
+        """Put the new audio in the queue. If the stream is ending, also put a stop signal in the queue."""
+        # the threads of the shared decoding pool don't wait for the consumer, see `_chunk_done`
+        self._put(audio, wait=not self.decode_in_background)
+        if stream_end:
+            self._put(self.stop_signal, wait=not self.decode_in_background)
+
+    def _chunk_done(self, done: Future):
+        # the chunk only counts as decoded once its audio is in the queue, so that the generation waits for the
+        # consumer through `max_pending_chunks`
+        last_put, self.last_put = self.last_put, None
+        if last_put is None:
+            super()._chunk_done(done)
+        else:
+            last_put.add_done_callback(lambda _: super(AsyncParlerTTSStreamer, self)._chunk_done(done))
+
+    def cancel(self):
+        """Stops the generation at its next step, and drops the audio that was not consumed."""
+        self.cancelled = True
+        # unblock the generation thread if it is waiting for room in the queue
+        while not self.audio_queue.empty():
+            self.audio_queue.get_nowait()
+
+    async def aclose(self):
+        """Cancels the stream if it is not finished, and waits for the end of its generation."""
+        self.cancel()
+        if self.generation is not None:
+            await asyncio.gather(self.generation, return_exceptions=True)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def __iter__(self):
+        raise TypeError("AsyncParlerTTSStreamer is consumed with `async for`.")
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.generation is None:
+            raise ValueError("Call `start` before iterating over the stream.")
+        try:
+            value = await self.audio_queue.get()
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+        if isinstance(value, BaseException):
+            raise value
+        if not isinstance(value, np.ndarray) and value == self.stop_signal:
+            raise StopAsyncIteration()
+        return value
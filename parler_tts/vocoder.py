@@ -0,0 +1,158 @@
+import itertools
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, List, Optional
+
+import torch
+from transformers import PreTrainedModel
+
+from .cache_utils import pad_to_length
+from .continuous_batching import ParlerTTSRequestOutput
+
+
+@dataclass
+class _PendingCodes:
+    request_id: Any
+    audio_codes: torch.LongTensor
+    frame_mask: torch.BoolTensor
+
+
+class ParlerTTSVocoder:
+    r"""
+    Batched decoding of audio codes into waveforms, separate from the generation of the codes.
+
+    Audio codes returned by [`~ParlerTTSForConditionalGeneration.generate`] with `return_codes=True`, or by a
+    [`ParlerTTSContinuousBatchingEngine`] created with `decode_audio=False`, are queued with
+    [`~ParlerTTSVocoder.add_request`]. At every call to [`~ParlerTTSVocoder.step`], up to `max_batch_size` queued
+    sequences, possibly from different generate calls and of different lengths, are decoded in a single call to the
+    audio encoder. The audio of each sequence is the same as decoding it alone.
+
+    The vocoder only holds the audio encoder, so that it can run on its own device or process, and be sized
+    independently of the decoder generating the codes. Requests can be added from another thread than the one calling
+    `step`.
+
+    Parameters:
+        audio_encoder (`PreTrainedModel`):
+            The audio encoder of the Parler-TTS model, e.g. `model.audio_encoder`.
+        max_batch_size (`int`, *optional*, defaults to 32):
+            Maximum number of sequences decoded in one call to the audio encoder.
+
+    Example:
+
+    ```python
+    >>> vocoder = ParlerTTSVocoder(model.audio_encoder, max_batch_size=64)
+    >>> audio_codes, codes_length = model.generate(
+    ...     input_ids=input_ids, prompt_input_ids=prompt_input_ids, return_codes=True
+    ... )
+    >>> for codes in audio_codes:
+    ...     vocoder.add_request(codes)
+    >>> while vocoder.has_unfinished_requests():
+    ...     for output in vocoder.step():
+    ...         print(output.request_id, output.audio_values.shape)
+    ```
+    """
+
+    def __init__(self, audio_encoder: PreTrainedModel, max_batch_size: int = 32):
+        self.audio_encoder = audio_encoder
+        self.max_batch_size = max_batch_size
+        self.codebook_size = audio_encoder.config.codebook_size
+
+        self._waiting = deque()
+        self._request_counter = itertools.count()
+
+    @property
+    def num_waiting(self) -> int:
+        """Number of sequences waiting to be decoded."""
+        return len(self._waiting)
+
+    def has_unfinished_requests(self) -> bool:
+        return self.num_waiting > 0
+
+    def add_request(self, audio_codes: torch.LongTensor, request_id: Optional[Any] = None):
+        """
+        Queues a sequence of audio codes to decode.
+
+        Args:
+            audio_codes (`torch.LongTensor` of shape `(num_codebooks, frames)`):
+                Audio codes with the delay pattern reverted. The frames with a BOS, PAD or EOS token are not decoded.
+            request_id (`Any`, *optional*):
+                Identifier reported in the [`ParlerTTSRequestOutput`]. Defaults to an increasing integer.
+
+        Returns:
+            The request identifier.
+        """
+        audio_codes = torch.as_tensor(audio_codes, device=self.audio_encoder.device)
+        if audio_codes.dim() != 2:
+            raise ValueError(
+                f"Expected audio codes of shape `(num_codebooks, frames)`, but got a tensor of shape "
+                f"{tuple(audio_codes.shape)}."
+            )
+        frame_mask = (audio_codes < self.codebook_size).all(dim=0)
+
+        request_id = request_id if request_id is not None else next(self._request_counter)
+        self._waiting.append(_PendingCodes(request_id=request_id, audio_codes=audio_codes, frame_mask=frame_mask))
+        return request_id
+
+    @torch.no_grad()
+    def step(self) -> List[ParlerTTSRequestOutput]:
+        """
+        Decodes up to `max_batch_size` waiting sequences, in the order they were added, in a single call to the audio
+        encoder.
+
+        Returns:
+            `List[ParlerTTSRequestOutput]`: the decoded sequences, whose `audio_values` are trimmed to their length.
+            Sequences without any audio frame are a single zero, as in `generate`.
+        """
+        requests = []
+        while self._waiting and len(requests) < self.max_batch_size:
+            requests.append(self._waiting.popleft())
+        if not requests:
+            return []
+
+        # pad the sequences with masked frames, which the audio encoder skips
+        num_frames = max(request.audio_codes.shape[-1] for request in requests)
+        audio_codes = torch.stack([pad_to_length(request.audio_codes, -1, num_frames) for request in requests])
+        padding_mask = torch.stack(
+            [pad_to_length(request.frame_mask, -1, num_frames, fill_value=False) for request in requests]
+        )
+
+        lengths = padding_mask.sum(dim=-1).tolist()
+        if max(lengths) == 0:
+            audio_values = torch.zeros((len(requests), 1), device=self.audio_encoder.device)
+            samples_per_frame = 0
+        else:
+            audio_values = self.audio_encoder.decode(
+                audio_codes[None], [None] * len(requests), padding_mask=padding_mask
+            ).audio_values.squeeze(1)
+            samples_per_frame = audio_values.shape[-1] // num_frames
+
+        outputs = []
+        for request, audio_values_, length in zip(requests, audio_values, lengths):
+            audio_length = max(length * samples_per_frame, 1)
+            outputs.append(
+                ParlerTTSRequestOutput(
+                    request_id=request.request_id,
+                    audio_codes=request.audio_codes,
+                    audio_values=audio_values_[:audio_length],
+                )
+            )
+        return outputs
+
+    def vocode(self, audio_codes: List[torch.LongTensor]) -> List[torch.FloatTensor]:
+        """
+        Decodes a list of sequences of audio codes, `max_batch_size` at a time.
+
+        Args:
+            audio_codes (`List[torch.LongTensor]`):
+                Sequences of audio codes of shape `(num_codebooks, frames)`, e.g. the rows of the codes returned by
+                `generate` with `return_codes=True`.
+
+        Returns:
+            `List[torch.FloatTensor]`: the audio of each sequence, in the order of `audio_codes`.
+        """
+        request_ids = [self.add_request(codes) for codes in audio_codes]
+        outputs = {}
+        while self.has_unfinished_requests():
+            for output in self.step():
+                outputs[output.request_id] = output
+        return [outputs[request_id].audio_values for request_id in request_ids]
@@ -0,0 +1,70 @@
+import os
+from dataclasses import dataclass
+from typing import List, Optional, Union
+
+import torch
+from safetensors import safe_open
+from safetensors.torch import save_file
+
+
+_FORMAT_VERSION = "1"
+
+
+@dataclass
+class ParlerTTSVoiceProfile:
+    """
+    Conditioning of Parler-TTS computed once for a description, built with
+    [`~ParlerTTSForConditionalGeneration.build_voice_profile`] and consumed by `generate(voice_profile=...)`, which then
+    skips both the text encoder and the cross-attention key/value projections of the description.
+
+    Profiles are saved as safetensors files, which are memory-mapped when loaded: processes loading the same profile on
+    CPU share its pages through the page cache.
+
+    Args:
+        encoder_hidden_states (`torch.FloatTensor` of shape `(num_tokens, hidden_size)`):
+            Projected text encoder outputs of the description, without padding.
+        key_states (`List[torch.FloatTensor]`):
+            Cross-attention keys of each decoder layer, of shape `(num_key_value_heads, num_tokens, head_dim)`.
+        value_states (`List[torch.FloatTensor]`):
+            Cross-attention values of each decoder layer, of shape `(num_key_value_heads, num_tokens, head_dim)`.
+    """
+
+    encoder_hidden_states: torch.FloatTensor
+    key_states: List[torch.FloatTensor]
+    value_states: List[torch.FloatTensor]
+
+    @property
+    def num_tokens(self) -> int:
+        return self.encoder_hidden_states.shape[0]
+
+    def to(self, device: Union[torch.device, str, None] = None, dtype: Optional[torch.dtype] = None):
+        """Returns a copy of the profile on `device` and in `dtype`. Tensors already matching them are not copied."""
+        return ParlerTTSVoiceProfile(
+            encoder_hidden_states=self.encoder_hidden_states.to(device=device, dtype=dtype),
+            key_states=[states.to(device=device, dtype=dtype) for states in self.key_states],
+            value_states=[states.to(device=device, dtype=dtype) for states in self.value_states],
+        )
+
+    def save(self, path: Union[str, os.PathLike]):
+        """Saves the profile as a safetensors file at `path`."""
+        tensors = {"encoder_hidden_states": self.encoder_hidden_states.contiguous()}
+        for layer_idx, (key_states, value_states) in enumerate(zip(self.key_states, self.value_states)):
+            tensors[f"cross_attention.{layer_idx}.key"] = key_states.contiguous()
+            tensors[f"cross_attention.{layer_idx}.value"] = value_states.contiguous()
+        metadata = {"format_version": _FORMAT_VERSION, "num_layers": str(len(self.key_states))}
+        save_file({name: tensor.cpu() for name, tensor in tensors.items()}, path, metadata=metadata)
+
+    @classmethod
+    def load(cls, path: Union[str, os.PathLike], device: Union[torch.device, str] = "cpu") -> "ParlerTTSVoiceProfile":
+        """Loads a profile saved with [`~ParlerTTSVoiceProfile.save`] on `device`."""
+        device = str(device)
+        with safe_open(path, framework="pt", device=device) as f:
+            metadata = f.metadata() or {}
+            if metadata.get("format_version") != _FORMAT_VERSION:
+                raise ValueError(f"{path} is not a Parler-TTS voice profile, or was saved by an unsupported version.")
+            num_layers = int(metadata["num_layers"])
+            return cls(
+                encoder_hidden_states=f.get_tensor("encoder_hidden_states"),
+                key_states=[f.get_tensor(f"cross_attention.{layer_idx}.key") for layer_idx in range(num_layers)],
+                value_states=[f.get_tensor(f"cross_attention.{layer_idx}.value") for layer_idx in range(num_layers)],
+            )
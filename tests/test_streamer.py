@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import torch
+
+from parler_tts import AsyncParlerTTSStreamer, ParlerTTSStreamer
+
+
+NUM_CODEBOOKS = 2
+CODEBOOK_SIZE = 1024
+HOP_LENGTH = 4
+
+
+class FakeAudioEncoder:
+    """
+    Decodes each frame into `HOP_LENGTH` samples equal to the code of its first codebook. Like Encodec, it exposes
+    neither its hop length nor its receptive field.
+    """
+
+    device = torch.device("cpu")
+    config = SimpleNamespace(sampling_rate=16, frame_rate=16 / HOP_LENGTH, codebook_size=CODEBOOK_SIZE)
+
+    def __init__(self):
+        self.max_threads = 0
+        self.lock = threading.Lock()
+
+    def decode(self, audio_codes, audio_scales, padding_mask=None):
+        with self.lock:
+            self.max_threads = max(self.max_threads, threading.active_count())
+        time.sleep(0.005)
+        audio_values = audio_codes[0, :, :1].float().repeat_interleave(HOP_LENGTH, dim=-1)
+        return SimpleNamespace(audio_values=audio_values)
+
+
+class FakeDACAudioEncoder(FakeAudioEncoder):
+    """Exposes its hop length and receptive field, like DAC."""
+
+    hop_length = HOP_LENGTH
+    decoder_receptive_field = 2
+
+
+class FakeModel:
+    """Streams `num_steps` columns of the delay pattern, the frame `f` having code `f` in every codebook."""
+
+    def __init__(self, num_steps):
+        self.num_steps = num_steps
+        self.decoder = SimpleNamespace(num_codebooks=NUM_CODEBOOKS)
+        self.audio_encoder = FakeDACAudioEncoder()
+        self.generation_config = None
+        self.device = torch.device("cpu")
+
+    def generate(self, streamer, stopping_criteria=None):
+        for column in range(self.num_steps):
+            codes = [column - codebook - 1 for codebook in range(NUM_CODEBOOKS)]
+            codes = [code if code >= 0 else CODEBOOK_SIZE for code in codes]
+            streamer.put(torch.tensor(codes)[:, None])
+        streamer.end()
+
+
+def test_async_streams_share_a_bounded_decoding_pool():
+    num_streams, num_steps = 16, 40
+    model = FakeModel(num_steps)
+    # one generation thread per stream, so that all the streams run at once
+    executor = ThreadPoolExecutor(max_workers=num_streams)
+    threads_before = threading.active_count()
+
+    async def stream():
+        streamer = AsyncParlerTTSStreamer(model, play_steps=3, executor=executor)
+        async with streamer:
+            streamer.start()
+            chunks = [chunk async for chunk in streamer]
+        return torch.cat([torch.from_numpy(chunk) for chunk in chunks])
+
+    async def run():
+        return await asyncio.gather(*[stream() for _ in range(num_streams)])
+
+    audios = asyncio.run(run())
+    executor.shutdown()
+
+    # the chunks of every stream are decoded on the same pool of 4 threads
+    assert model.audio_encoder.max_threads <= threads_before + num_streams + 4
+    assert len([thread for thread in threading.enumerate() if thread.name.startswith("parler-tts-decode")]) <= 4
+
+    # the chunks of each stream are played in order
+    expected = torch.arange(num_steps - NUM_CODEBOOKS).float().repeat_interleave(HOP_LENGTH)
+    for audio in audios:
+        assert torch.equal(audio, expected)
+
+
+def test_decode_errors_are_raised_by_the_generation():
+    model = FakeModel(num_steps=20)
+    model.audio_encoder.decode = lambda *args, **kwargs: 1 / 0
+    streamer = ParlerTTSStreamer(model, play_steps=3)
+
+    try:
+        model.generate(streamer)
+    except ZeroDivisionError:
+        pass
+    else:
+        raise AssertionError("the decoding error was not raised")
+
+
+def test_audio_encoders_without_receptive_field_are_decoded_in_full_windows():
+    model = FakeModel(num_steps=20)
+    model.audio_encoder = FakeAudioEncoder()
+    streamer = ParlerTTSStreamer(model, play_steps=3, decode_in_background=False)
+    assert streamer.hop_length == HOP_LENGTH
+    assert streamer.full_window
+
+    model.generate(streamer)
+    audio = torch.cat([torch.from_numpy(chunk) for chunk in streamer])
+    expected = torch.arange(20 - NUM_CODEBOOKS).float().repeat_interleave(HOP_LENGTH)
+    assert torch.equal(audio, expected)
@@ -88,6 +88,12 @@ class ModelArguments:
             "help": "If not specified, the cross-attention implementation will be the same as `_attn_implementation`. If `always_eager`, it will always be the eager implementation. If `always_sdpa`, it will always be the sdpa implementation."
         },
     )
+    loss_chunk_size: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "If specified, the loss is computed over chunks of `loss_chunk_size` positions whose logits are recomputed during the backward pass, which lowers the peak memory of long samples."
+        },
+    )
     prompt_padding_side: Optional[str] = field(
         default="left",
         metadata={
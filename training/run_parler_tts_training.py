@@ -311,7 +311,8 @@ def main():
         {
             "cross_attention_implementation_strategy": model_args.cross_attention_implementation_strategy
             if model_args.cross_attention_implementation_strategy is not None
-            else None
+            else None,
+            "loss_chunk_size": model_args.loss_chunk_size,
         }
     )
     config.update(